@@ -0,0 +1,195 @@
+# Copyright 2021, Blue Brain Project, EPFL
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Script that measures the start-up time of the pipeline entry points."""
+from __future__ import annotations
+
+import argparse
+import logging
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+logger = logging.getLogger("benchmark-imports")
+
+SCRIPTS_DIR = Path(__file__).resolve().parent
+
+ENTRY_POINTS = (
+    "full_pipeline",
+    "download_gene",
+    "nissl_to_ccfv3",
+    "gene_to_nissl",
+    "interpolate_gene",
+    "qc",
+    "nissl_symmetry",
+)
+
+
+def parse_args():
+    """Parse arguments."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "entry_points",
+        type=str,
+        nargs="*",
+        default=ENTRY_POINTS,
+        help="""\
+        Names of the scripts to benchmark. By default, all the entry points
+        of the pipeline.
+        """,
+    )
+    parser.add_argument(
+        "-n",
+        "--n-runs",
+        type=int,
+        default=5,
+        help="""\
+        Number of times every script is started.
+        """,
+    )
+    parser.add_argument(
+        "--max-time",
+        type=float,
+        default=1.0,
+        help="""\
+        Start-up time (in seconds) above which a script is reported as too
+        slow.
+        """,
+    )
+    parser.add_argument(
+        "--import-time",
+        action="store_true",
+        help="""\
+        If True, the slowest imports of every script are reported too,
+        as measured by `python -X importtime`.
+        """,
+    )
+    return parser.parse_args()
+
+
+def time_help(script_path: Path, n_runs: int) -> list[float]:
+    """Measure the wall time of `python <script> --help`.
+
+    Parameters
+    ----------
+    script_path
+        Path to the script.
+    n_runs
+        Number of runs.
+
+    Returns
+    -------
+    timings : list[float]
+        Wall time of every run, in seconds.
+
+    Raises
+    ------
+    RuntimeError
+        When the script exits with an error.
+    """
+    timings = []
+    for _ in range(n_runs):
+        start = time.perf_counter()
+        result = subprocess.run(
+            [sys.executable, str(script_path), "--help"],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            text=True,
+        )
+        timings.append(time.perf_counter() - start)
+        if result.returncode:
+            raise RuntimeError(result.stderr.strip().splitlines()[-1])
+    return timings
+
+
+def slowest_imports(script_path: Path, n_imports: int = 5) -> list[tuple[str, float]]:
+    """Find the slowest imports of `python <script> --help`.
+
+    Parameters
+    ----------
+    script_path
+        Path to the script.
+    n_imports
+        Number of imports to report.
+
+    Returns
+    -------
+    imports : list[tuple[str, float]]
+        Name and cumulative import time (in seconds) of the slowest
+        top-level imports.
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", str(script_path), "--help"],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        text=True,
+    )
+    imports = []
+    for line in result.stderr.splitlines():
+        # Lines look like "import time:  self [us] | cumulative | name"
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        # Nested imports are indented, only the top-level ones are kept
+        if name.startswith("  "):
+            continue
+        imports.append((name.strip(), int(cumulative) / 1e6))
+    return sorted(imports, key=lambda x: x[1], reverse=True)[:n_imports]
+
+
+def main(
+    entry_points: list[str] = ENTRY_POINTS,
+    n_runs: int = 5,
+    max_time: float = 1.0,
+    import_time: bool = False,
+) -> int:
+    """Implement main function."""
+    too_slow = []
+    for name in entry_points:
+        script_path = SCRIPTS_DIR / f"{name}.py"
+        try:
+            timings = time_help(script_path, n_runs)
+        except RuntimeError as exc:
+            logger.error(f"{name}: Failed to start ({exc})")
+            too_slow.append(name)
+            continue
+
+        median = statistics.median(timings)
+        logger.info(
+            f"{name}: {median:.3f}s (median of {n_runs}, min {min(timings):.3f}s)"
+        )
+        if median > max_time:
+            too_slow.append(name)
+        if import_time:
+            for module, seconds in slowest_imports(script_path):
+                logger.info(f"    {module}: {seconds:.3f}s")
+
+    if too_slow:
+        logger.warning(
+            f"{', '.join(too_slow)} failed or took more than {max_time}s to start"
+        )
+        return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
+    )
+    args = parse_args()
+    kwargs = vars(args)
+    sys.exit(main(**kwargs))
@@ -13,29 +13,71 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from __future__ import annotations
+
 import argparse
+import sys
 from collections import OrderedDict
 from pathlib import Path
+from typing import Sequence
 
 import nrrd
 import numpy as np
 
-# Match voxcell requirements:
-HEADER = OrderedDict(
-    [
-        ("type", "uint32"),
-        ("dimension", None),
-        ("space dimension", 3),
-        ("sizes", None),
-        (
-            "space directions",
-            np.array([[25.0, 0.0, 0.0], [0.0, 25.0, 0.0], [0.0, 0.0, 25.0]]),
-        ),
-        ("endian", "little"),
-        ("encoding", "gzip"),
-        ("space origin", np.array([0.0, 0.0, 0.0])),
-    ]
-)
+# NRRD names of the numpy types that differ from the numpy names
+NRRD_TYPES = {"float32": "float", "float64": "double"}
+
+
+def make_header(
+    array: np.ndarray,
+    spacing: float | Sequence[float],
+    origin: Sequence[float] | None = None,
+) -> OrderedDict:
+    """Build the NRRD header of a volume, matching voxcell requirements.
+
+    A new header is built for every volume, so that volumes can be written
+    concurrently by several threads.
+
+    Parameters
+    ----------
+    array
+        Volume to write. Its first three axes are spatial, the other ones
+        (e.g. RGB channels) are written as vector axes.
+    spacing
+        Voxel size in micrometers, either the same for the three spatial
+        axes or one per axis.
+    origin
+        Position of the first voxel in micrometers. If None, the origin.
+
+    Returns
+    -------
+    header : OrderedDict
+        Header to give to `nrrd.write`.
+    """
+    n_spatial = min(array.ndim, 3)
+    spacing = np.broadcast_to(np.asarray(spacing, dtype=float), (n_spatial,))
+    space_directions = np.full((array.ndim, n_spatial), np.nan)
+    space_directions[:n_spatial] = np.diag(spacing)
+    if origin is None:
+        origin = np.zeros(n_spatial)
+
+    header = OrderedDict(
+        [
+            ("type", NRRD_TYPES.get(array.dtype.name, array.dtype.name)),
+            ("dimension", array.ndim),
+            ("space dimension", n_spatial),
+            ("sizes", np.array(array.shape)),
+            ("space directions", space_directions),
+            ("endian", "little"),
+            ("encoding", "gzip"),
+            ("space origin", np.array(origin, dtype=float)),
+        ]
+    )
+    if array.ndim > n_spatial:
+        header["kinds"] = ["domain"] * n_spatial + ["vector"] * (
+            array.ndim - n_spatial
+        )
+    return header
 
 
 def parse_args():
@@ -46,7 +88,6 @@ def parse_args():
     args : argparse.Namespace
         The parsed command line arguments.
     """
-    """Parse arguments."""
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "input_path",
@@ -63,27 +104,61 @@ def parse_args():
         """,
     )
     parser.add_argument(
-        "-h",
         "--header",
-        type=Path,
-        help=f"""\
-        If specified, the header {HEADER} is saved.
+        action="store_true",
+        help="""\
+        If True, a header matching voxcell requirements (type, sizes, voxel
+        size and origin) is saved.
+        """,
+    )
+    parser.add_argument(
+        "--spacing",
+        type=float,
+        default=25.0,
+        help="""\
+        Voxel size in micrometers written in the header.
+        """,
+    )
+    parser.add_argument(
+        "--preview-levels",
+        type=int,
+        nargs="+",
+        metavar="FACTOR",
+        help="""\
+        If specified, downsampled previews of the volume are saved too, one
+        per factor (e.g. 2 4 8), averaging blocks of FACTOR voxels per axis.
+        They are saved next to the output as <name>-preview<FACTOR>x.nrrd.
         """,
     )
     return parser.parse_args()
 
 
-def main(input_path: Path, output_path: Path, header: bool) -> int:
+def main(
+    input_path: Path,
+    output_path: Path,
+    header: bool,
+    spacing: float = 25.0,
+    preview_levels: list[int] | None = None,
+) -> int:
+    from utils import compute_previews, preview_path
 
-    array = np.load(input_path)
+    # Memory-mapped, so that the previews are computed slab by slab
+    array = np.load(input_path, mmap_mode="r")
     if header:
-        HEADER["dimension"] = len(array.shape)
-        HEADER["sizes"] = np.array(array.shape)
-        nrrd.write(str(output_path), array, header=HEADER)
+        nrrd.write(str(output_path), array, header=make_header(array, spacing))
     else:
         nrrd.write(str(output_path), array)
+
+    previews = compute_previews(array, preview_levels or [])
+    for factor, preview in previews.items():
+        path = preview_path(output_path, factor)
+        if header:
+            preview_header = make_header(preview, spacing * factor)
+            nrrd.write(str(path), preview, header=preview_header)
+        else:
+            nrrd.write(str(path), preview)
     return 0
 
 
 if __name__ == "__main__":
-    main(**vars(parse_args()))
+    sys.exit(main(**vars(parse_args())))
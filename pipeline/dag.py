@@ -0,0 +1,362 @@
+# Copyright 2021, Blue Brain Project, EPFL
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Description of the pipeline as a graph of stages and its scheduler."""
+from __future__ import annotations
+
+import logging
+import shlex
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Callable
+
+if TYPE_CHECKING:
+    from executors import Executor
+
+logger = logging.getLogger("dag")
+
+
+@dataclass
+class Stage:
+    """One stage of the pipeline.
+
+    Attributes
+    ----------
+    name
+        Unique name of the stage.
+    func
+        Function running the stage, usually the `main` of a pipeline script.
+        It is called with `kwargs` and returns an exit code.
+    kwargs
+        Keyword arguments given to `func`.
+    inputs
+        Files read by the stage. Stages producing one of these files are
+        dependencies of this stage.
+    outputs
+        Files written by the stage. If they all exist, the stage is skipped.
+    command
+        Command line equivalent to the stage, used in the emitted plans.
+    cpus
+        Number of CPUs used by the stage.
+    memory
+        Peak memory used by the stage, in GB.
+    """
+
+    name: str
+    func: Callable[..., int]
+    kwargs: dict[str, Any] = field(default_factory=dict)
+    inputs: list[Path] = field(default_factory=list)
+    outputs: list[Path] = field(default_factory=list)
+    command: list[str] = field(default_factory=list)
+    cpus: int = 1
+    memory: float = 0.0
+
+
+class Pipeline:
+    """Directed acyclic graph of stages.
+
+    The dependencies between stages are not declared explicitly, they are
+    derived from the inputs and outputs of every stage.
+    """
+
+    def __init__(self) -> None:
+        self.stages = {}
+
+    def add(self, stage: Stage) -> Stage:
+        """Add a stage to the pipeline.
+
+        Raises
+        ------
+        ValueError
+            When a stage with the same name or producing the same output
+            is already part of the pipeline.
+        """
+        if stage.name in self.stages:
+            raise ValueError(f"The stage {stage.name} is already in the pipeline.")
+        for other in self.stages.values():
+            common = set(stage.outputs) & set(other.outputs)
+            if common:
+                raise ValueError(
+                    f"The stages {stage.name} and {other.name} both produce "
+                    f"{sorted(str(path) for path in common)}."
+                )
+        self.stages[stage.name] = stage
+        return stage
+
+    def dependencies(self, stage: Stage) -> list[str]:
+        """Find the names of the stages producing the inputs of a stage."""
+        inputs = set(stage.inputs)
+        return [
+            other.name
+            for other in self.stages.values()
+            if other is not stage and inputs & set(other.outputs)
+        ]
+
+    def topological_order(self) -> list[str]:
+        """Sort the stages so that every stage comes after its dependencies.
+
+        Raises
+        ------
+        ValueError
+            When the stages have circular dependencies.
+        """
+        dependencies = {
+            name: set(self.dependencies(stage)) for name, stage in self.stages.items()
+        }
+        order = []
+        while dependencies:
+            ready = [name for name, deps in dependencies.items() if not deps]
+            if not ready:
+                raise ValueError(
+                    f"The stages {sorted(dependencies)} have circular dependencies."
+                )
+            for name in ready:
+                order.append(name)
+                del dependencies[name]
+            for deps in dependencies.values():
+                deps.difference_update(ready)
+        return order
+
+    def final_outputs(self) -> list[Path]:
+        """List the outputs that are not read by any stage."""
+        inputs = {path for stage in self.stages.values() for path in stage.inputs}
+        return [
+            path
+            for name in self.topological_order()
+            for path in self.stages[name].outputs
+            if path not in inputs
+        ]
+
+    def run(
+        self,
+        n_cpus: int = 1,
+        max_memory: float | None = None,
+        force: bool = False,
+        executor: Executor | None = None,
+    ) -> int:
+        """Run the stages, independent stages being run concurrently.
+
+        A stage is started as soon as all its dependencies are done and
+        enough CPUs and memory are available. A stage requiring more than
+        the budget is only run alone.
+
+        Stages can save their outputs in the background (see
+        `utils.save_volume_async`). Their dependencies then start with the
+        outputs still in memory, and they are only done once their outputs
+        are on disk.
+
+        The scheduling is always done by the current process, but the
+        stages themselves can be run elsewhere by an executor.
+
+        Parameters
+        ----------
+        n_cpus
+            Number of CPUs that the running stages can use altogether.
+        max_memory
+            Memory in GB that the running stages can use altogether.
+            If None, the memory is not limited.
+        force
+            If True, the stages are run even if their outputs exist.
+        executor
+            If specified, the stages are run by this executor (e.g. on a
+            dask cluster), see `executors`. Otherwise, they are run by
+            threads of the current process.
+
+        Returns
+        -------
+        int
+            0 if all the stages succeeded, 1 otherwise.
+        """
+        from utils import has_pending_writes, wait_for_writes
+
+        order = self.topological_order()
+        dependencies = {name: self.dependencies(self.stages[name]) for name in order}
+        done = set()
+        running = {}
+        saving = {}
+        failed = False
+        used_cpus = 0
+        used_memory = 0.0
+
+        with ThreadPoolExecutor(max_workers=max(len(order), 1)) as pool:
+            while True:
+                for name in order:
+                    if failed:
+                        break
+                    if name in done or name in running.values():
+                        continue
+                    if name in saving.values():
+                        continue
+                    if not all(
+                        dep in done or dep in saving.values()
+                        for dep in dependencies[name]
+                    ):
+                        continue
+
+                    stage = self.stages[name]
+                    if not force and stage.outputs and all(
+                        path.exists() for path in stage.outputs
+                    ):
+                        logger.info(
+                            f"{name}: Skipped, outputs already exist "
+                            f"({', '.join(str(path) for path in stage.outputs)})"
+                        )
+                        done.add(name)
+                        continue
+
+                    fits_cpus = used_cpus + stage.cpus <= n_cpus
+                    fits_memory = (
+                        max_memory is None or used_memory + stage.memory <= max_memory
+                    )
+                    if (running or saving) and not (fits_cpus and fits_memory):
+                        continue
+
+                    logger.info(f"{name}: Started")
+                    if executor is None:
+                        future = pool.submit(stage.func, **stage.kwargs)
+                    else:
+                        future = pool.submit(_run_stage, executor, stage)
+                    running[future] = name
+                    used_cpus += stage.cpus
+                    used_memory += stage.memory
+
+                if not running and not saving:
+                    break
+
+                finished, _ = wait(
+                    list(running) + list(saving), return_when=FIRST_COMPLETED
+                )
+                for future in finished:
+                    if future in saving:
+                        name = saving.pop(future)
+                        used_memory -= self.stages[name].memory
+                        try:
+                            future.result()
+                        except Exception:
+                            logger.exception(f"{name}: Failed to save outputs")
+                            failed = True
+                            continue
+                        logger.info(f"{name}: Done")
+                        done.add(name)
+                        continue
+
+                    name = running.pop(future)
+                    stage = self.stages[name]
+                    used_cpus -= stage.cpus
+                    try:
+                        exit_code = future.result()
+                    except Exception:
+                        logger.exception(f"{name}: Failed")
+                        used_memory -= stage.memory
+                        failed = True
+                        continue
+                    if exit_code:
+                        logger.error(f"{name}: Failed with exit code {exit_code}")
+                        used_memory -= stage.memory
+                        failed = True
+                        continue
+                    if has_pending_writes(stage.outputs):
+                        # The outputs stay in memory until they are saved
+                        logger.info(f"{name}: Saving")
+                        saving[pool.submit(wait_for_writes, stage.outputs)] = name
+                        continue
+                    logger.info(f"{name}: Done")
+                    used_memory -= stage.memory
+                    done.add(name)
+
+                # Stages that can never run anymore are skipped
+                if failed and not running and not saving:
+                    break
+
+        # Volumes saved in the background that are not outputs of a stage
+        try:
+            wait_for_writes()
+        except Exception:
+            logger.exception("Failed to save a volume")
+            failed = True
+
+        return 1 if failed else 0
+
+    def to_makefile(self) -> str:
+        """Write the pipeline as a Makefile.
+
+        Stages with several outputs use grouped targets, which need
+        GNU Make 4.3 or newer.
+        """
+        lines = [
+            ".PHONY: all",
+            "all: " + " ".join(_quote_make(path) for path in self.final_outputs()),
+            "",
+        ]
+        for name in self.topological_order():
+            stage = self.stages[name]
+            separator = " &:" if len(stage.outputs) > 1 else ":"
+            lines += [
+                f"# {name}",
+                " ".join(_quote_make(path) for path in stage.outputs)
+                + separator
+                + "".join(" " + _quote_make(path) for path in stage.inputs),
+                "\t" + _shell_command(stage.command),
+                "",
+            ]
+        return "\n".join(lines)
+
+    def to_snakemake(self) -> str:
+        """Write the pipeline as a Snakefile."""
+        lines = ["rule all:", "    input:"]
+        lines += [f"        {str(path)!r}," for path in self.final_outputs()]
+        lines.append("")
+        for name in self.topological_order():
+            stage = self.stages[name]
+            lines.append(f"rule {name.replace('-', '_')}:")
+            if stage.inputs:
+                lines.append("    input:")
+                lines += [f"        {str(path)!r}," for path in stage.inputs]
+            lines.append("    output:")
+            lines += [f"        {str(path)!r}," for path in stage.outputs]
+            lines += [
+                f"    threads: {stage.cpus}",
+                f"    resources: mem_mb={int(stage.memory * 1024)}",
+                f"    shell: {_shell_command(stage.command)!r}",
+                "",
+            ]
+        return "\n".join(lines)
+
+
+def _run_stage(executor: Executor, stage: Stage) -> int:
+    """Run a stage with an executor and wait for its exit code."""
+    return executor.submit(_run_and_save, stage.func, stage.kwargs).result()
+
+
+def _run_and_save(func: Callable[..., int], kwargs: dict[str, Any]) -> int:
+    """Run a stage and wait for its outputs to be saved.
+
+    Stages run by an executor may live in another process, whose volumes
+    saved in the background cannot be read by the next stages from memory.
+    """
+    from utils import wait_for_writes
+
+    exit_code = func(**kwargs)
+    wait_for_writes()
+    return exit_code
+
+
+def _shell_command(command: list[str]) -> str:
+    """Join a command line into a string that can be run by a shell."""
+    return " ".join(shlex.quote(str(arg)) for arg in command)
+
+
+def _quote_make(path: Path) -> str:
+    """Escape the spaces of a path used as a Makefile target or prerequisite."""
+    return str(path).replace(" ", "\\ ")
@@ -18,13 +18,14 @@ import argparse
 import logging
 import sys
 from pathlib import Path
-from typing import Any, Generator, Optional, Tuple
+from typing import TYPE_CHECKING, Any, Generator, Optional, Tuple
 
 import numpy as np
-import PIL
-from atldld.base import DisplacementField
 from tqdm import tqdm
 
+if TYPE_CHECKING:
+    from atldld.base import DisplacementField
+
 logger = logging.getLogger("download-gene")
 
 
@@ -67,6 +68,15 @@ def parse_args():
         If True, download and apply deformation to threshold images too.
         """,
     )
+    parser.add_argument(
+        "--sparse-expression",
+        action="store_true",
+        help="""\
+        If True, the threshold images are saved with run-length encoding
+        (<experiment_id>-expression.rle.npz), which is much smaller than
+        the dense numpy file for these mostly empty images.
+        """,
+    )
     args = parser.parse_args()
 
     return args
@@ -142,6 +152,8 @@ def main(
     output_dir: Path | str,
     downsample_img: int,
     expression: bool = True,
+    sparse_expression: bool = False,
+    async_save: bool = False,
 ) -> int:
     """Download gene expression dataset.
 
@@ -156,12 +168,20 @@ def main(
         This factor is going to reduce the size.
     expression
         If True, threshold images are downloaded too.
+    sparse_expression
+        If True, threshold images are saved with run-length encoding,
+        see `utils.save_rle`.
+    async_save
+        If True, the volumes are saved in the background while the next
+        stages of the pipeline use them, see `utils.save_volume_async`.
     """
     # Imports
     import json
 
+    import PIL.Image
     from atldld.sync import DatasetDownloader
     from atldld.utils import CommonQueries
+    from utils import RLE_SUFFIX, save_volume, save_volume_async
 
     # To avoid Decompression Warning
     PIL.Image.MAX_IMAGE_PIXELS = 200000000
@@ -185,12 +205,14 @@ def main(
     metadata_dict["axis"] = axis
 
     logger.info(f"Saving results of experiment ID {experiment_id}")
-    np.save(output_dir / f"{experiment_id}.npy", dataset_np)
+    save = save_volume_async if async_save else save_volume
+    save(output_dir / f"{experiment_id}.npy", dataset_np)
     with open(output_dir / f"{experiment_id}.json", "w") as f:
         json.dump(metadata_dict, f, indent=True, sort_keys=True)
 
     if expression_np is not None:
-        np.save(output_dir / f"{experiment_id}-expression.npy", expression_np)
+        suffix = RLE_SUFFIX if sparse_expression else ".npy"
+        save(output_dir / f"{experiment_id}-expression{suffix}", expression_np)
 
     neg_values = [False if sec > 0 else True for sec in metadata_dict["section_numbers"]]
     if np.sum(neg_values) > 0:
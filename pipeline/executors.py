@@ -0,0 +1,214 @@
+# Copyright 2021, Blue Brain Project, EPFL
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Executors running the tasks of the pipeline locally or on a cluster.
+
+All the executors share the same small interface: `submit` returns a future
+whose `result()` gives the return value of the task, `as_completed` yields
+futures as soon as they are done, and `scatter` sends data once to the
+workers so that many tasks can use it. Tasks must be
+module-level functions, so that they can be sent to other processes.
+"""
+from __future__ import annotations
+
+import logging
+from concurrent.futures import Future, ProcessPoolExecutor, as_completed
+from typing import Any, Callable, Iterable, Iterator
+
+logger = logging.getLogger("executors")
+
+EXECUTORS = ("serial", "process", "dask")
+
+
+def _run_with_retries(func: Callable, retries: int, *args, **kwargs) -> Any:
+    """Call a function, calling it again up to `retries` times if it raises."""
+    for attempt in range(retries + 1):
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            if attempt == retries:
+                raise
+            logger.warning(
+                f"{getattr(func, '__name__', func)} failed, retrying "
+                f"({attempt + 1} / {retries})",
+                exc_info=True,
+            )
+
+
+class Executor:
+    """Run tasks, possibly in parallel.
+
+    Parameters
+    ----------
+    retries
+        Number of times a failing task is run again before giving up.
+    """
+
+    def __init__(self, retries: int = 0) -> None:
+        self.retries = retries
+
+    def submit(self, func: Callable, *args, **kwargs) -> Future:
+        """Run `func(*args, **kwargs)` and return a future of its result."""
+        raise NotImplementedError
+
+    def scatter(self, data: Any) -> Any:
+        """Send data to the workers ahead of the tasks using it.
+
+        The returned object is given to `submit` in place of the data.
+        """
+        return data
+
+    def as_completed(self, futures: Iterable[Future]) -> Iterator[Future]:
+        """Yield the futures returned by `submit` as soon as they are done."""
+        return as_completed(futures)
+
+    def shutdown(self) -> None:
+        """Release the workers."""
+
+    def __enter__(self) -> Executor:
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.shutdown()
+
+
+class SerialExecutor(Executor):
+    """Run the tasks one after the other in the current process."""
+
+    def submit(self, func: Callable, *args, **kwargs) -> Future:
+        future = Future()
+        try:
+            future.set_result(_run_with_retries(func, self.retries, *args, **kwargs))
+        except Exception as exc:
+            future.set_exception(exc)
+        return future
+
+
+class ProcessExecutor(Executor):
+    """Run the tasks in a pool of local processes.
+
+    Parameters
+    ----------
+    n_workers
+        Number of processes. If None, the number of CPUs.
+    retries
+        Number of times a failing task is run again before giving up.
+    """
+
+    def __init__(self, n_workers: int | None = None, retries: int = 0) -> None:
+        super().__init__(retries)
+        self.pool = ProcessPoolExecutor(max_workers=n_workers)
+
+    def submit(self, func: Callable, *args, **kwargs) -> Future:
+        return self.pool.submit(_run_with_retries, func, self.retries, *args, **kwargs)
+
+    def shutdown(self) -> None:
+        self.pool.shutdown()
+
+
+class DaskExecutor(Executor):
+    """Run the tasks on a dask distributed cluster.
+
+    The pipeline directory must be importable by the workers (e.g. in
+    their `PYTHONPATH`), so that the tasks can be unpickled.
+
+    Parameters
+    ----------
+    address
+        Address of the scheduler of an existing cluster. If None, a local
+        cluster is started, which is mostly useful for testing.
+    n_workers
+        Number of workers of the local cluster.
+    retries
+        Number of times a failing task is run again before giving up,
+        possibly on another worker.
+    """
+
+    def __init__(
+        self,
+        address: str | None = None,
+        n_workers: int | None = None,
+        retries: int = 0,
+    ) -> None:
+        try:
+            from dask.distributed import Client, LocalCluster
+        except ImportError as exc:
+            raise ImportError(
+                "The dask executor needs dask.distributed, "
+                "install it with `pip install dask[distributed]`"
+            ) from exc
+
+        super().__init__(retries)
+        self.cluster = None
+        if address is None:
+            self.cluster = LocalCluster(n_workers=n_workers, threads_per_worker=1)
+            address = self.cluster.scheduler_address
+        self.client = Client(address)
+        logger.info(f"Connected to the dask scheduler at {address}")
+
+    def submit(self, func: Callable, *args, **kwargs) -> Future:
+        # Tasks have side effects (e.g. writing files), they are never cached
+        return self.client.submit(
+            func, *args, retries=self.retries, pure=False, **kwargs
+        )
+
+    def scatter(self, data: Any) -> Any:
+        # Tasks using the scattered data are preferably run where it lives
+        return self.client.scatter(data)
+
+    def as_completed(self, futures: Iterable[Future]) -> Iterator[Future]:
+        from dask.distributed import as_completed
+
+        return iter(as_completed(futures))
+
+    def shutdown(self) -> None:
+        self.client.close()
+        if self.cluster is not None:
+            self.cluster.close()
+
+
+def get_executor(
+    name: str,
+    n_workers: int | None = None,
+    address: str | None = None,
+    retries: int = 0,
+) -> Executor:
+    """Create an executor from its name.
+
+    Parameters
+    ----------
+    name
+        One of `EXECUTORS`.
+    n_workers
+        Number of local workers, ignored by the serial executor and when
+        connecting to an existing dask cluster.
+    address
+        Address of the dask scheduler, see `DaskExecutor`.
+    retries
+        Number of times a failing task is run again before giving up.
+
+    Returns
+    -------
+    executor : Executor
+        The executor, to be shut down once the tasks are done.
+    """
+    if name == "serial":
+        return SerialExecutor(retries=retries)
+    elif name == "process":
+        return ProcessExecutor(n_workers=n_workers, retries=retries)
+    elif name == "dask":
+        return DaskExecutor(address=address, n_workers=n_workers, retries=retries)
+    else:
+        raise ValueError(
+            f"The executor {name} is not supported. Choices are: {EXECUTORS}"
+        )
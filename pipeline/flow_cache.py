@@ -0,0 +1,186 @@
+# Copyright 2021, Blue Brain Project, EPFL
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Persistent cache of the optical flows between reference sections.
+
+With the optical flow models, the flows between the sections of the
+reference volume only depend on the reference volume, on the model and on
+the pair of sections, not on the gene. They are computed once and reused
+by every experiment and every image type.
+"""
+from __future__ import annotations
+
+import dataclasses
+import hashlib
+import json
+import logging
+import os
+import tempfile
+from pathlib import Path
+
+import numpy as np
+from atlinter.optical_flow import GeneOpticalFlow
+
+logger = logging.getLogger("flow-cache")
+
+
+def hash_volume(volume: np.ndarray, chunk_size: int = 16) -> str:
+    """Compute the SHA1 of the content of a volume, slice chunk by slice chunk.
+
+    Memory-mapped volumes are hashed without being entirely loaded.
+    """
+    sha = hashlib.sha1(f"{volume.dtype.str}:{volume.shape}".encode())
+    for start in range(0, len(volume), chunk_size):
+        sha.update(np.ascontiguousarray(volume[start : start + chunk_size]).data)
+    return sha.hexdigest()
+
+
+@dataclasses.dataclass(frozen=True)
+class FlowCache:
+    """Directory of the flows computed with one reference volume and model.
+
+    Attributes
+    ----------
+    directory
+        Directory containing one numpy file per pair of sections.
+    offset
+        Section number of the first section of the reference given to
+        the optical flow model, when it is a sub-volume of the reference
+        volume (e.g. the sections of a gap only).
+    """
+
+    directory: Path
+    offset: int = 0
+
+    @classmethod
+    def open(
+        cls,
+        cache_dir: Path | str,
+        reference_volume: np.ndarray,
+        interpolator_name: str,
+        checkpoint: Path | str | None,
+    ) -> FlowCache:
+        """Open the cache of a reference volume and an interpolator model.
+
+        Parameters
+        ----------
+        cache_dir
+            Root directory of the flow caches.
+        reference_volume
+            Entire reference volume.
+        interpolator_name
+            Name of the optical flow model.
+        checkpoint
+            Checkpoint of the model. Its size and modification time are part
+            of the key, so that the flows of a retrained model are not reused.
+
+        Returns
+        -------
+        flow_cache : FlowCache
+            Cache of the flows computed with this reference volume and model.
+        """
+        key = {
+            "reference": hash_volume(reference_volume),
+            "interpolator_name": interpolator_name,
+            "checkpoint": None,
+        }
+        if checkpoint is not None:
+            checkpoint = Path(checkpoint).resolve()
+            stat = checkpoint.stat()
+            key["checkpoint"] = f"{checkpoint}:{stat.st_size}:{stat.st_mtime_ns}"
+
+        digest = hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()
+        directory = Path(cache_dir) / f"{interpolator_name}-{digest[:16]}"
+        directory.mkdir(parents=True, exist_ok=True)
+        key_path = directory / "key.json"
+        if not key_path.exists():
+            content = json.dumps(key, indent=True, sort_keys=True).encode()
+            _write_atomic(key_path, lambda f: f.write(content))
+        return cls(directory)
+
+    def with_offset(self, offset: int) -> FlowCache:
+        """Get the same cache for a sub-volume starting at section `offset`."""
+        return dataclasses.replace(self, offset=self.offset + offset)
+
+    def path(self, axis: str, idx_from: int, idx_to: int) -> Path:
+        """Path of the flow between two sections of the sub-volume."""
+        idx_from = int(idx_from) + self.offset
+        idx_to = int(idx_to) + self.offset
+        return self.directory / f"{axis}-{idx_from}-{idx_to}.npy"
+
+    def load(self, axis: str, idx_from: int, idx_to: int) -> np.ndarray | None:
+        """Load a flow, None if it is not in the cache yet."""
+        path = self.path(axis, idx_from, idx_to)
+        if not path.exists():
+            return None
+        return np.load(path)
+
+    def save(self, axis: str, idx_from: int, idx_to: int, flow: np.ndarray) -> None:
+        """Save a flow, atomically so that concurrent runs can share the cache."""
+        path = self.path(axis, idx_from, idx_to)
+        _write_atomic(path, lambda f: np.save(f, flow))
+
+
+def _write_atomic(path: Path, write) -> None:
+    """Write a file through a unique temporary file and an atomic rename.
+
+    Concurrent writers, threads or processes, never share a temporary file
+    and readers never see a partial file.
+    """
+    fd, tmp_name = tempfile.mkstemp(
+        dir=path.parent, prefix=f".{path.name}.", suffix=".tmp"
+    )
+    try:
+        with os.fdopen(fd, "wb") as f:
+            write(f)
+        os.replace(tmp_name, path)
+    except BaseException:
+        if os.path.exists(tmp_name):
+            os.unlink(tmp_name)
+        raise
+
+
+class CachedGeneOpticalFlow(GeneOpticalFlow):
+    """Gene optical flow interpolation reusing the cached reference flows.
+
+    Parameters
+    ----------
+    gene_data
+        Known gene sections.
+    reference_volume
+        Reference volume (or sub-volume) of the same shape as the volume
+        to predict.
+    model
+        Optical flow model.
+    flow_cache
+        Cache of the flows computed with this reference volume and model.
+    """
+
+    def __init__(self, gene_data, reference_volume, model, flow_cache: FlowCache):
+        super().__init__(gene_data, reference_volume, model)
+        self.flow_cache = flow_cache
+        self.axis_name = gene_data.axis
+        self.n_hits = 0
+        self.n_misses = 0
+
+    def predict_ref_flow(self, idx_from: int, idx_to: int) -> np.ndarray:
+        """Compute the optical flow between two reference sections, or reuse it."""
+        flow = self.flow_cache.load(self.axis_name, idx_from, idx_to)
+        if flow is not None:
+            self.n_hits += 1
+            return flow
+
+        self.n_misses += 1
+        flow = super().predict_ref_flow(idx_from, idx_to)
+        self.flow_cache.save(self.axis_name, idx_from, idx_to, flow)
+        return flow
@@ -21,6 +21,26 @@ from pathlib import Path
 
 logger = logging.getLogger("full-pipeline")
 
+SCRIPTS_DIR = Path(__file__).resolve().parent
+
+# Rough resources needed by every stage, used by the scheduler
+STAGE_CPUS = {
+    "nissl-to-ccfv3": 4,
+    "download-gene": 1,
+    "gene-to-nissl": 2,
+    "interpolate-gene": 2,
+    "qc": 1,
+    "region-expression": 1,
+}
+STAGE_MEMORY = {
+    "nissl-to-ccfv3": 16.0,
+    "download-gene": 4.0,
+    "gene-to-nissl": 4.0,
+    "interpolate-gene": 8.0,
+    "qc": 2.0,
+    "region-expression": 2.0,
+}
+
 
 def parse_args():
     """Parse command line arguments.
@@ -124,6 +144,15 @@ def parse_args():
         If True, download and apply deformation to threshold images too.
         """,
     )
+    parser.add_argument(
+        "--sparse-expression",
+        action="store_true",
+        help="""\
+        If True, the threshold images downloaded and registered are saved
+        with run-length encoding, which is much smaller for these mostly
+        empty images.
+        """,
+    )
     parser.add_argument(
         "-f",
         "--force",
@@ -132,10 +161,124 @@ def parse_args():
         If True, force to recompute every steps.
         """,
     )
+    parser.add_argument(
+        "--skip-qc",
+        action="store_true",
+        help="""\
+        If True, the quality control scores of the registrations are not
+        computed.
+        """,
+    )
+    parser.add_argument(
+        "--skip-region-expression",
+        action="store_true",
+        help="""\
+        If True, the expression statistics of every region of the annotation
+        are not computed from the interpolated volumes.
+        """,
+    )
+    parser.add_argument(
+        "-j",
+        "--n-cpus",
+        type=int,
+        default=1,
+        help="""\
+        Number of CPUs that the stages running concurrently can use.
+        Independent stages (e.g. the download of the gene and the alignment
+        of the Nissl volume) are run at the same time if they fit.
+        """,
+    )
+    parser.add_argument(
+        "--max-memory",
+        type=float,
+        help="""\
+        Memory (in GB) that the stages running concurrently can use.
+        If not specified, the memory is not limited.
+        """,
+    )
+    parser.add_argument(
+        "--emit-plan",
+        type=str,
+        choices=("make", "snakemake"),
+        help="""\
+        If specified, nothing is run and the pipeline is printed as a
+        Makefile or a Snakefile instead.
+        """,
+    )
+    parser.add_argument(
+        "--shared-memory",
+        action="store_true",
+        help="""\
+        If True, the reference volumes are loaded once into shared memory
+        (/dev/shm) and all the stages, as well as other runs of the pipeline
+        on the same node, attach to the same copy.
+        """,
+    )
+    parser.add_argument(
+        "--keep-shared",
+        action="store_true",
+        help="""\
+        If True, the volumes loaded into shared memory by --shared-memory
+        are kept after the run, for the next runs on the same node.
+        Otherwise, they are removed at the end of the run unless other
+        running processes of the node still use them.
+        """,
+    )
+    parser.add_argument(
+        "--flow-cache-dir",
+        type=Path,
+        help="""\
+        If specified, the flows between the sections of the Nissl volume
+        computed by the optical flow interpolators are cached in this
+        directory and reused by the other experiments.
+        """,
+    )
+    parser.add_argument(
+        "--adaptive",
+        action="store_true",
+        help="""\
+        If True, the small gaps and the gaps between similar sections are
+        interpolated with the linear model, the interpolator model being
+        only used for the other gaps.
+        """,
+    )
+    parser.add_argument(
+        "--executor",
+        type=str,
+        choices=("serial", "process", "dask"),
+        help="""\
+        If specified, the stages are run by this executor (local processes
+        or a dask cluster) instead of threads of the current process.
+        """,
+    )
+    parser.add_argument(
+        "--n-workers",
+        type=int,
+        help="""\
+        Number of local workers of the executor. By default, the number
+        of CPUs.
+        """,
+    )
+    parser.add_argument(
+        "--scheduler-address",
+        type=str,
+        help="""\
+        Address of the dask scheduler. If not specified, a local dask
+        cluster is started.
+        """,
+    )
+    parser.add_argument(
+        "--retries",
+        type=int,
+        default=0,
+        help="""\
+        Number of times a stage is run again by the executor when it fails.
+        """,
+    )
     return parser.parse_args()
 
 
-def main(
+def build_pipeline(
     nissl_path: Path | str,
     ccfv2_path: Path | str,
     experiment_id: int,
@@ -147,102 +290,388 @@ def main(
     output_dir: Path | str,
     saving_format: str,
     expression: bool = False,
-    force: bool = False,
-) -> int:
-    """Implement the main function."""
+    skip_qc: bool = False,
+    shared_memory: bool = False,
+    flow_cache_dir: Path | str | None = None,
+    sparse_expression: bool = False,
+    skip_region_expression: bool = False,
+    adaptive: bool = False,
+):
+    """Describe the full pipeline as a graph of stages.
+
+    Parameters are the same as the ones of `main`.
+
+    Returns
+    -------
+    pipeline : dag.Pipeline
+        Pipeline whose stages are the different scripts of the pipeline.
+    """
+    from dag import Pipeline, Stage
     from download_gene import main as download_gene_main
     from gene_to_nissl import main as gene_to_nissl_main
     from interpolate_gene import main as interpolate_gene_main
     from nissl_to_ccfv3 import main as nissl_to_ccfv3_main
+    from qc import main as qc_main
+    from region_expression import main as region_expression_main
+    from utils import RLE_SUFFIX
 
+    nissl_path = Path(nissl_path)
     output_dir = Path(output_dir)
+    qc_dir = output_dir / "qc"
+    shared_option = ["--shared-memory"] if shared_memory else []
+    expression_suffix = RLE_SUFFIX if sparse_expression else ".npy"
+    sparse_option = ["--sparse-expression"] if sparse_expression else []
+    pipeline = Pipeline()
+
+    def add_qc_stage(name, volume_path, reference_path, output_path, **kwargs):
+        command = [
+            "python",
+            SCRIPTS_DIR / "qc.py",
+            volume_path,
+            reference_path,
+            output_path,
+        ]
+        inputs = [Path(volume_path), Path(reference_path)]
+        for key, value in kwargs.items():
+            option = "--" + key.replace("_", "-")
+            command += [option] if value is True else [option, value]
+            if key == "metadata_path":
+                inputs.append(Path(value))
+        pipeline.add(
+            Stage(
+                name=name,
+                func=qc_main,
+                kwargs={
+                    "volume_path": volume_path,
+                    "reference_path": reference_path,
+                    "output_path": output_path,
+                    **kwargs,
+                },
+                inputs=inputs,
+                outputs=[output_path],
+                command=command,
+                cpus=STAGE_CPUS["qc"],
+                memory=STAGE_MEMORY["qc"],
+            )
+        )
 
     if coordinate_sys == "ccfv3":
-        if ccfv3_path is None:
-            logger.error(
-                "One needs to specify CCFv3 annotation volume to run the pipeline"
+        nissl_to_ccfv3_dir = output_dir / "nissl-to-ccfv3"
+        warped_nissl_path = nissl_to_ccfv3_dir / "warped-nissl.npy"
+        pipeline.add(
+            Stage(
+                name="nissl-to-ccfv3",
+                func=nissl_to_ccfv3_main,
+                kwargs={
+                    "nissl_path": nissl_path,
+                    "ccfv2_path": ccfv2_path,
+                    "ccfv3_path": ccfv3_path,
+                    "output_dir": nissl_to_ccfv3_dir,
+                    "shared_memory": shared_memory,
+                    "async_save": True,
+                },
+                inputs=[nissl_path, Path(ccfv2_path), Path(ccfv3_path)],
+                outputs=[nissl_to_ccfv3_dir / "warped-ccfv2.npy", warped_nissl_path],
+                command=[
+                    "python",
+                    SCRIPTS_DIR / "nissl_to_ccfv3.py",
+                    nissl_path,
+                    ccfv2_path,
+                    ccfv3_path,
+                    nissl_to_ccfv3_dir,
+                    *shared_option,
+                ],
+                cpus=STAGE_CPUS["nissl-to-ccfv3"],
+                memory=STAGE_MEMORY["nissl-to-ccfv3"],
             )
-            return 1
-        warped_nissl_path = output_dir / "nissl-to-ccfv3" / "warped-nissl.npy"
-        if not warped_nissl_path.exists() or force:
-            logger.info("Aligning Nissl volume to CCFv3 annotation volume...")
-            nissl_to_ccfv3_main(
-                nissl_path,
-                ccfv2_path,
+        )
+        nissl_path = warped_nissl_path
+
+        if not skip_qc:
+            add_qc_stage(
+                "qc-nissl-to-ccfv3",
+                warped_nissl_path,
                 ccfv3_path,
-                output_dir=output_dir / "nissl-to-ccfv3",
+                qc_dir / "nissl-to-ccfv3.json",
+                reference_is_annotation=True,
             )
-        else:
-            logger.info(
-                "Aligning Nissl volume to CCFv3 annotation volume: Skipped \n"
-                f"Nissl is already aligned and saved under {warped_nissl_path}"
+            add_qc_stage(
+                "qc-ccfv2-to-ccfv3",
+                nissl_to_ccfv3_dir / "warped-ccfv2.npy",
+                ccfv3_path,
+                qc_dir / "ccfv2-to-ccfv3.json",
+                volume_is_annotation=True,
+                reference_is_annotation=True,
             )
 
-        nissl_path = warped_nissl_path
-
     gene_experiment_dir = output_dir / "download-gene"
     gene_experiment_path = gene_experiment_dir / f"{experiment_id}.npy"
-    if not gene_experiment_path.exists() or force:
-        logger.info("Downloading Gene Expression...")
-        download_gene_main(
-            experiment_id,
-            output_dir=gene_experiment_dir,
-            downsample_img=downsample_img,
-            expression=expression,
-        )
-    else:
-        logger.info(
-            "Downloading Gene Expression: Skipped \n"
-            f"{experiment_id} is already downloaded and saved under {gene_experiment_path}"
+    gene_metadata_path = gene_experiment_dir / f"{experiment_id}.json"
+    gene_expression_path = (
+        gene_experiment_dir / f"{experiment_id}-expression{expression_suffix}"
+    )
+    download_command = [
+        "python",
+        SCRIPTS_DIR / "download_gene.py",
+        experiment_id,
+        gene_experiment_dir,
+        "--downsample-img",
+        downsample_img,
+    ]
+    if expression:
+        download_command += ["--expression", *sparse_option]
+    pipeline.add(
+        Stage(
+            name="download-gene",
+            func=download_gene_main,
+            kwargs={
+                "experiment_id": experiment_id,
+                "output_dir": gene_experiment_dir,
+                "downsample_img": downsample_img,
+                "expression": expression,
+                "sparse_expression": sparse_expression,
+                "async_save": True,
+            },
+            outputs=[gene_experiment_path, gene_metadata_path]
+            + ([gene_expression_path] if expression else []),
+            command=download_command,
+            cpus=STAGE_CPUS["download-gene"],
+            memory=STAGE_MEMORY["download-gene"],
         )
+    )
 
     aligned_results_dir = output_dir / "gene-to-nissl" / coordinate_sys
     aligned_gene_path = aligned_results_dir / f"{experiment_id}-warped-gene.npy"
-
-    if not aligned_gene_path.exists() or force:
-        logger.info(
-            f"Aligning downloaded Gene Expression to Nissl volume in {coordinate_sys} ({nissl_path})..."
+    aligned_metadata_path = aligned_results_dir / f"{experiment_id}-metadata.json"
+    aligned_expression_path = (
+        aligned_results_dir / f"{experiment_id}-warped-expression{expression_suffix}"
+    )
+    gene_to_nissl_command = [
+        "python",
+        SCRIPTS_DIR / "gene_to_nissl.py",
+        gene_experiment_path,
+        gene_metadata_path,
+        nissl_path,
+        aligned_results_dir,
+        *shared_option,
+    ]
+    if expression:
+        gene_to_nissl_command += [
+            "--expression-path",
+            gene_expression_path,
+            *sparse_option,
+        ]
+    pipeline.add(
+        Stage(
+            name="gene-to-nissl",
+            func=gene_to_nissl_main,
+            kwargs={
+                "gene_path": gene_experiment_path,
+                "metadata_path": gene_metadata_path,
+                "nissl_path": nissl_path,
+                "output_dir": aligned_results_dir,
+                "expression_path": gene_expression_path if expression else None,
+                "shared_memory": shared_memory,
+                "sparse_expression": sparse_expression,
+                "async_save": True,
+            },
+            inputs=[gene_experiment_path, gene_metadata_path, nissl_path]
+            + ([gene_expression_path] if expression else []),
+            outputs=[aligned_gene_path, aligned_metadata_path]
+            + ([aligned_expression_path] if expression else []),
+            command=gene_to_nissl_command,
+            cpus=STAGE_CPUS["gene-to-nissl"],
+            memory=STAGE_MEMORY["gene-to-nissl"],
         )
-        gene_to_nissl_main(
-            gene_path=gene_experiment_dir / f"{experiment_id}.npy",
-            metadata_path=gene_experiment_dir / f"{experiment_id}.json",
-            nissl_path=nissl_path,
-            output_dir=aligned_results_dir,
-            expression_path=gene_experiment_dir / f"{experiment_id}-expression.npy"
-            if expression
-            else None,
+    )
+
+    if not skip_qc:
+        add_qc_stage(
+            "qc-gene-to-nissl",
+            aligned_gene_path,
+            nissl_path,
+            qc_dir / coordinate_sys / f"{experiment_id}-gene-to-nissl.json",
+            metadata_path=aligned_metadata_path,
         )
-    else:
-        logger.info("Aligning downloaded Gene Expression to Nissl volume: Skipped")
 
     interpolation_results_dir = output_dir / "interpolate-gene" / coordinate_sys
-    interpolated_gene_path = (
-        interpolation_results_dir
-        / f"{experiment_id}-{interpolator_name}-interpolated-gene.npy"
-    )
+    paths = {"gene": aligned_gene_path}
+    if expression:
+        paths["expression"] = aligned_expression_path
 
-    if not interpolated_gene_path.exists() or force:
-        logger.info("Interpolating the missing slices of the gene expression...")
-        paths = [
-            aligned_results_dir / f"{experiment_id}-warped-gene.npy",
+    for image_type, path in paths.items():
+        interpolated_path = (
+            interpolation_results_dir
+            / f"{experiment_id}-{interpolator_name}-interpolated-{image_type}"
+            f".{saving_format}"
+        )
+        interpolate_command = [
+            "python",
+            SCRIPTS_DIR / "interpolate_gene.py",
+            path,
+            aligned_metadata_path,
+            interpolation_results_dir,
+            "--interpolator-name",
+            interpolator_name,
+            "--saving-format",
+            saving_format,
+            "--reference-path",
+            nissl_path,
+            *shared_option,
         ]
-        if expression:
-            paths += [
-                aligned_results_dir / f"{experiment_id}-warped-expression.npy",
+        if flow_cache_dir is not None:
+            interpolate_command += ["--flow-cache-dir", flow_cache_dir]
+        if adaptive:
+            interpolate_command.append("--adaptive")
+        if interpolator_checkpoint is not None:
+            interpolate_command += [
+                "--interpolator-checkpoint",
+                interpolator_checkpoint,
             ]
+        interpolate_inputs = [path, aligned_metadata_path]
+        if interpolator_name in {"maskflownet", "raftnet"}:
+            interpolate_inputs.append(nissl_path)
+        pipeline.add(
+            Stage(
+                name=f"interpolate-{image_type}",
+                func=interpolate_gene_main,
+                kwargs={
+                    "gene_path": path,
+                    "metadata_path": aligned_metadata_path,
+                    "interpolator_name": interpolator_name,
+                    "interpolator_checkpoint": interpolator_checkpoint,
+                    "saving_format": saving_format,
+                    "reference_path": nissl_path,
+                    "output_dir": interpolation_results_dir,
+                    "shared_memory": shared_memory,
+                    "flow_cache_dir": flow_cache_dir,
+                    "adaptive": adaptive,
+                    "async_save": True,
+                },
+                inputs=interpolate_inputs,
+                outputs=[interpolated_path],
+                command=interpolate_command,
+                cpus=STAGE_CPUS["interpolate-gene"],
+                memory=STAGE_MEMORY["interpolate-gene"],
+            )
+        )
+
+        if skip_region_expression:
+            continue
+        annotation_path = Path(ccfv3_path if coordinate_sys == "ccfv3" else ccfv2_path)
+        region_expression_path = (
+            output_dir
+            / "region-expression"
+            / coordinate_sys
+            / f"{interpolated_path.name.split('.')[0]}.csv"
+        )
+        pipeline.add(
+            Stage(
+                name=f"region-expression-{image_type}",
+                func=region_expression_main,
+                kwargs={
+                    "annotation_path": annotation_path,
+                    "output_path": region_expression_path,
+                    "volume_paths": [interpolated_path],
+                },
+                inputs=[annotation_path, interpolated_path],
+                outputs=[region_expression_path],
+                command=[
+                    "python",
+                    SCRIPTS_DIR / "region_expression.py",
+                    annotation_path,
+                    region_expression_path,
+                    interpolated_path,
+                ],
+                cpus=STAGE_CPUS["region-expression"],
+                memory=STAGE_MEMORY["region-expression"],
+            )
+        )
+
+    return pipeline
+
+
+def main(
+    nissl_path: Path | str,
+    ccfv2_path: Path | str,
+    experiment_id: int,
+    ccfv3_path: Path | str | None,
+    coordinate_sys: str,
+    downsample_img: int,
+    interpolator_name: str,
+    interpolator_checkpoint: Path | str | None,
+    output_dir: Path | str,
+    saving_format: str,
+    expression: bool = False,
+    sparse_expression: bool = False,
+    force: bool = False,
+    skip_qc: bool = False,
+    skip_region_expression: bool = False,
+    n_cpus: int = 1,
+    max_memory: float | None = None,
+    emit_plan: str | None = None,
+    shared_memory: bool = False,
+    keep_shared: bool = False,
+    flow_cache_dir: Path | str | None = None,
+    adaptive: bool = False,
+    executor: str | None = None,
+    n_workers: int | None = None,
+    scheduler_address: str | None = None,
+    retries: int = 0,
+) -> int:
+    """Implement the main function."""
+    if coordinate_sys == "ccfv3" and ccfv3_path is None:
+        logger.error("One needs to specify CCFv3 annotation volume to run the pipeline")
+        return 1
+
+    pipeline = build_pipeline(
+        nissl_path=nissl_path,
+        ccfv2_path=ccfv2_path,
+        experiment_id=experiment_id,
+        ccfv3_path=ccfv3_path,
+        coordinate_sys=coordinate_sys,
+        downsample_img=downsample_img,
+        interpolator_name=interpolator_name,
+        interpolator_checkpoint=interpolator_checkpoint,
+        output_dir=output_dir,
+        saving_format=saving_format,
+        expression=expression,
+        sparse_expression=sparse_expression,
+        skip_qc=skip_qc,
+        skip_region_expression=skip_region_expression,
+        shared_memory=shared_memory,
+        flow_cache_dir=flow_cache_dir,
+        adaptive=adaptive,
+    )
+
+    if emit_plan == "make":
+        print(pipeline.to_makefile())
+        return 0
+    elif emit_plan == "snakemake":
+        print(pipeline.to_snakemake())
+        return 0
+
+    try:
+        if executor is None:
+            return pipeline.run(n_cpus=n_cpus, max_memory=max_memory, force=force)
+
+        from executors import get_executor
 
-        for path in paths:
-            interpolate_gene_main(
-                gene_path=path,
-                metadata_path=aligned_results_dir / f"{experiment_id}-metadata.json",
-                interpolator_name=interpolator_name,
-                interpolator_checkpoint=interpolator_checkpoint,
-                saving_format=saving_format,
-                reference_path=nissl_path,
-                output_dir=interpolation_results_dir,
+        with get_executor(
+            executor, n_workers=n_workers, address=scheduler_address, retries=retries
+        ) as stage_executor:
+            return pipeline.run(
+                n_cpus=n_cpus,
+                max_memory=max_memory,
+                force=force,
+                executor=stage_executor,
             )
+    finally:
+        if shared_memory and not keep_shared:
+            from utils import release_shared
 
-    return 0
+            n_released = release_shared()
+            logger.info(f"Removed {n_released} volumes from shared memory")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,447 @@
+# Copyright 2021, Blue Brain Project, EPFL
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Chunked store of many interpolated genes, and the script to pack and query it.
+
+The store is a directory containing `index.json` and one numpy file per
+chunk. A chunk holds a block of `gene_block` genes over a box of
+`chunk_shape` voxels, with shape `(gene_block, cz, cy, cx)` and dtype
+float16. Chunks are memory-mapped when read, so:
+
+* the values of one gene in a chunk are contiguous, a gene slice reads
+  only its part of every chunk;
+* the profile of one voxel reads one value per gene in a single chunk
+  per gene block.
+
+Genes are appended in place, filling the last gene block before new
+chunk files are created.
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import logging
+import os
+import sys
+from itertools import product
+from pathlib import Path
+from typing import Iterator
+
+import numpy as np
+
+logger = logging.getLogger("gene-atlas")
+
+
+def parse_args():
+    """Parse arguments."""
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    pack = subparsers.add_parser(
+        "pack", help="Add interpolated volumes to a store, creating it if needed."
+    )
+    pack.add_argument(
+        "store_dir",
+        type=Path,
+        help="""\
+        Path to the store directory.
+        """,
+    )
+    pack.add_argument(
+        "volume_paths",
+        type=Path,
+        nargs="+",
+        help="""\
+        Paths to the interpolated volumes. The genes are named after the
+        files, e.g. "1234-rife-interpolated-gene".
+        """,
+    )
+    pack.add_argument(
+        "--chunk-shape",
+        type=int,
+        nargs=3,
+        default=(32, 32, 32),
+        help="""\
+        Shape of the box of voxels of every chunk, only used when the store
+        is created.
+        """,
+    )
+    pack.add_argument(
+        "--gene-block",
+        type=int,
+        default=16,
+        help="""\
+        Number of genes of every chunk, only used when the store is created.
+        """,
+    )
+
+    query = subparsers.add_parser("query", help="Read values from a store.")
+    query.add_argument(
+        "store_dir",
+        type=Path,
+        help="""\
+        Path to the store directory.
+        """,
+    )
+    group = query.add_mutually_exclusive_group(required=True)
+    group.add_argument(
+        "--voxel",
+        type=int,
+        nargs=3,
+        help="""\
+        Print the value of every gene at this voxel.
+        """,
+    )
+    group.add_argument(
+        "--gene",
+        type=str,
+        help="""\
+        Save the volume of this gene to --output-path.
+        """,
+    )
+    group.add_argument(
+        "--region",
+        type=int,
+        help="""\
+        Print the mean value of every gene in the region with this label
+        of --annotation-path.
+        """,
+    )
+    query.add_argument(
+        "--annotation-path",
+        type=Path,
+        help="""\
+        Path to the annotation volume, needed by --region.
+        """,
+    )
+    query.add_argument(
+        "--output-path",
+        type=Path,
+        help="""\
+        Path to the numpy file where to save the volume, needed by --gene.
+        """,
+    )
+    return parser.parse_args()
+
+
+class GeneAtlasStore:
+    """Chunked store of interpolated gene volumes.
+
+    Parameters
+    ----------
+    store_dir
+        Path to an existing store directory, see `create`.
+    """
+
+    def __init__(self, store_dir: Path | str) -> None:
+        self.store_dir = Path(store_dir)
+        with open(self.store_dir / "index.json") as f:
+            index = json.load(f)
+        self.volume_shape = tuple(index["volume_shape"])
+        self.chunk_shape = tuple(index["chunk_shape"])
+        self.gene_block = index["gene_block"]
+        self.genes = index["genes"]
+
+    @classmethod
+    def create(
+        cls,
+        store_dir: Path | str,
+        volume_shape: tuple[int, int, int],
+        chunk_shape: tuple[int, int, int] = (32, 32, 32),
+        gene_block: int = 16,
+    ) -> GeneAtlasStore:
+        """Create an empty store.
+
+        Parameters
+        ----------
+        store_dir
+            Path to the store directory, created if needed.
+        volume_shape
+            Shape of the volumes of the store, without the channels.
+        chunk_shape
+            Shape of the box of voxels of every chunk.
+        gene_block
+            Number of genes of every chunk.
+
+        Returns
+        -------
+        store : GeneAtlasStore
+            The empty store.
+        """
+        store_dir = Path(store_dir)
+        if (store_dir / "index.json").exists():
+            raise ValueError(f"There is already a store in {store_dir}.")
+        (store_dir / "chunks").mkdir(parents=True, exist_ok=True)
+        _write_index(
+            store_dir,
+            {
+                "volume_shape": list(volume_shape),
+                "chunk_shape": list(chunk_shape),
+                "gene_block": gene_block,
+                "dtype": "float16",
+                "genes": [],
+            },
+        )
+        return cls(store_dir)
+
+    @property
+    def grid_shape(self) -> tuple[int, ...]:
+        """Number of chunks along every axis of the volume."""
+        sizes = zip(self.volume_shape, self.chunk_shape)
+        return tuple(-(-size // chunk) for size, chunk in sizes)
+
+    def chunk_path(self, block: int, chunk_index: tuple[int, ...]) -> Path:
+        """Path of the chunk of a gene block at a position of the grid."""
+        name = "-".join(str(i) for i in (block,) + tuple(chunk_index))
+        return self.store_dir / "chunks" / f"{name}.npy"
+
+    def chunk_box(self, chunk_index: tuple[int, ...]) -> tuple[slice, ...]:
+        """Voxels of the volume covered by a chunk."""
+        return tuple(
+            slice(i * chunk, min((i + 1) * chunk, size))
+            for i, chunk, size in zip(chunk_index, self.chunk_shape, self.volume_shape)
+        )
+
+    def iter_chunks(self) -> Iterator[tuple[int, ...]]:
+        """Iterate over the positions of the chunks of the grid."""
+        return product(*(range(n) for n in self.grid_shape))
+
+    def read_chunk(self, block: int, chunk_index: tuple[int, ...]) -> np.ndarray:
+        """Memory-map a chunk in read-only mode."""
+        return np.load(self.chunk_path(block, chunk_index), mmap_mode="r")
+
+    def append(self, name: str, volume: np.ndarray) -> None:
+        """Add a gene to the store, in place.
+
+        Parameters
+        ----------
+        name
+            Name of the gene, e.g. the name of the interpolated volume.
+        volume
+            Volume of the gene. RGB volumes are converted to grayscale.
+        """
+        from qc import to_intensity
+
+        if name in self.genes:
+            raise ValueError(f"The gene {name} is already in the store.")
+        if volume.shape[:3] != self.volume_shape:
+            raise ValueError(
+                f"The volume ({volume.shape}) does not have the shape of the "
+                f"store ({self.volume_shape}) !"
+            )
+
+        block, slot = divmod(len(self.genes), self.gene_block)
+        chunk_z, _, _ = self.chunk_shape
+        for iz in range(self.grid_shape[0]):
+            # Read one slab of the volume at once, it is contiguous on disk
+            slab = np.asarray(volume[iz * chunk_z : (iz + 1) * chunk_z])
+            slab = to_intensity(slab, 3).astype(np.float16)
+            for iy, ix in product(*(range(n) for n in self.grid_shape[1:])):
+                chunk_index = (iz, iy, ix)
+                _, box_y, box_x = self.chunk_box(chunk_index)
+                values = slab[:, box_y, box_x]
+
+                path = self.chunk_path(block, chunk_index)
+                if slot == 0:
+                    chunk = np.lib.format.open_memmap(
+                        path,
+                        mode="w+",
+                        dtype=np.float16,
+                        shape=(self.gene_block,) + self.chunk_shape,
+                    )
+                else:
+                    chunk = np.load(path, mmap_mode="r+")
+                sz, sy, sx = values.shape
+                chunk[slot, :sz, :sy, :sx] = values
+                chunk.flush()
+                del chunk
+
+        # The gene only becomes visible once all its chunks are written
+        self.genes.append(name)
+        with open(self.store_dir / "index.json") as f:
+            index = json.load(f)
+        index["genes"] = self.genes
+        _write_index(self.store_dir, index)
+
+    def gene_indices(self, genes: list[str] | None = None) -> list[int]:
+        """Positions of some genes in the store, all of them if None."""
+        if genes is None:
+            return list(range(len(self.genes)))
+        missing = [gene for gene in genes if gene not in self.genes]
+        if missing:
+            raise ValueError(f"The genes {missing} are not in the store.")
+        return [self.genes.index(gene) for gene in genes]
+
+    def voxel(
+        self, z: int, y: int, x: int, genes: list[str] | None = None
+    ) -> np.ndarray:
+        """Read the values of some genes at one voxel.
+
+        Only one chunk per gene block is read.
+
+        Parameters
+        ----------
+        z, y, x
+            Coordinates of the voxel.
+        genes
+            Names of the genes, all of them if None.
+
+        Returns
+        -------
+        values : np.ndarray
+            Value of every gene.
+        """
+        position = (z, y, x)
+        chunk_index = tuple(c // s for c, s in zip(position, self.chunk_shape))
+        offset = tuple(c % s for c, s in zip(position, self.chunk_shape))
+        values = []
+        for index in self.gene_indices(genes):
+            block, slot = divmod(index, self.gene_block)
+            values.append(self.read_chunk(block, chunk_index)[(slot,) + offset])
+        return np.array(values, dtype=np.float16)
+
+    def gene(self, name: str) -> np.ndarray:
+        """Read the volume of one gene.
+
+        Only the part of every chunk holding this gene is read.
+        """
+        (index,) = self.gene_indices([name])
+        block, slot = divmod(index, self.gene_block)
+        volume = np.zeros(self.volume_shape, dtype=np.float16)
+        for chunk_index in self.iter_chunks():
+            box = self.chunk_box(chunk_index)
+            sizes = tuple(s.stop - s.start for s in box)
+            chunk = self.read_chunk(block, chunk_index)
+            volume[box] = chunk[(slot,) + tuple(slice(0, size) for size in sizes)]
+        return volume
+
+    def region(
+        self,
+        annotation: np.ndarray,
+        label: int,
+        genes: list[str] | None = None,
+    ) -> np.ndarray:
+        """Compute the mean value of some genes in one region.
+
+        Only the chunks overlapping the region are read.
+
+        Parameters
+        ----------
+        annotation
+            Annotation volume of the shape of the store.
+        label
+            Label of the region.
+        genes
+            Names of the genes, all of them if None.
+
+        Returns
+        -------
+        means : np.ndarray
+            Mean value of every gene in the region, NaN if the region is
+            empty.
+        """
+        if annotation.shape != self.volume_shape:
+            raise ValueError(
+                f"The annotation ({annotation.shape}) does not have the shape "
+                f"of the store ({self.volume_shape}) !"
+            )
+
+        indices = self.gene_indices(genes)
+        blocks = sorted({index // self.gene_block for index in indices})
+        sums = np.zeros(len(indices))
+        count = 0
+        for chunk_index in self.iter_chunks():
+            box = self.chunk_box(chunk_index)
+            mask = np.asarray(annotation[box]) == label
+            n_voxels = int(mask.sum())
+            if not n_voxels:
+                continue
+            count += n_voxels
+            sizes = tuple(s.stop - s.start for s in box)
+            crop = tuple(slice(0, size) for size in sizes)
+            for block in blocks:
+                chunk = self.read_chunk(block, chunk_index)
+                for i, index in enumerate(indices):
+                    if index // self.gene_block == block:
+                        slot = index % self.gene_block
+                        values = chunk[(slot,) + crop][mask]
+                        sums[i] += values.sum(dtype=np.float64)
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return sums / count
+
+
+def _write_index(store_dir: Path, index: dict) -> None:
+    """Write the index of a store atomically."""
+    tmp_path = store_dir / "index.json.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(index, f, indent=True)
+    os.replace(tmp_path, store_dir / "index.json")
+
+
+def main(command: str, store_dir: Path | str, **kwargs) -> int:
+    """Implement main function."""
+    from utils import check_and_load, volume_stem
+
+    store_dir = Path(store_dir)
+    if command == "pack":
+        volume_paths = kwargs["volume_paths"]
+        if (store_dir / "index.json").exists():
+            store = GeneAtlasStore(store_dir)
+        else:
+            volume = check_and_load(volume_paths[0], mmap=True)
+            store = GeneAtlasStore.create(
+                store_dir,
+                volume.shape[:3],
+                chunk_shape=tuple(kwargs["chunk_shape"]),
+                gene_block=kwargs["gene_block"],
+            )
+        for path in volume_paths:
+            name = volume_stem(path)
+            if name in store.genes:
+                logger.warning(f"{name} is already in the store, skipped")
+                continue
+            logger.info(f"Packing {name}...")
+            store.append(name, check_and_load(path, mmap=True))
+        logger.info(f"The store contains {len(store.genes)} genes")
+        return 0
+
+    store = GeneAtlasStore(store_dir)
+    if kwargs["voxel"] is not None:
+        values = store.voxel(*kwargs["voxel"])
+    elif kwargs["gene"] is not None:
+        if kwargs["output_path"] is None:
+            logger.error("--output-path is needed by --gene")
+            return 1
+        np.save(kwargs["output_path"], store.gene(kwargs["gene"]))
+        return 0
+    else:
+        if kwargs["annotation_path"] is None:
+            logger.error("--annotation-path is needed by --region")
+            return 1
+        annotation = check_and_load(kwargs["annotation_path"], mmap=True)
+        values = store.region(annotation, kwargs["region"])
+
+    for gene, value in zip(store.genes, values):
+        print(f"{gene}\t{value:.6g}")
+    return 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
+    )
+    args = parse_args()
+    kwargs = vars(args)
+    sys.exit(main(**kwargs))
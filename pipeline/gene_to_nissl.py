@@ -17,12 +17,18 @@ from __future__ import annotations
 import argparse
 import json
 import logging
+import os
+import shutil
 import sys
+import time
 from pathlib import Path
+from typing import TYPE_CHECKING, Any
 
 import numpy as np
-from atlannot.ants import register, transform
-from skimage.color import rgb2gray
+
+if TYPE_CHECKING:
+    from executors import Executor
+    from sections import SectionStore
 
 # Initialize the logger
 logger = logging.getLogger("gene-to-nissl")
@@ -66,92 +72,670 @@ def parse_args():
         If specified, transformation also applied to the given numpy.
         """,
     )
+    parser.add_argument(
+        "--pyramid-factors",
+        type=int,
+        nargs="+",
+        help="""\
+        If specified, every section is registered coarse to fine, once per
+        downsampling factor (e.g. 4 1). Every level starts from the transform
+        found by the previous one. The last factor should be 1 to end at full
+        resolution. If not specified, sections are registered at full
+        resolution only.
+        """,
+    )
+    parser.add_argument(
+        "--pyramid-iterations",
+        type=str,
+        nargs="+",
+        help="""\
+        ANTs iterations of every level of the pyramid, e.g. 100x70x50 20x10.
+        If not specified, the default iterations of ANTs are used.
+        """,
+    )
+    parser.add_argument(
+        "--pyramid-skip-nmi",
+        type=float,
+        help="""\
+        If specified, the remaining levels of the pyramid are skipped as soon
+        as the normalized mutual information between the Nissl section and
+        the warped gene section reaches this value.
+        """,
+    )
+    parser.add_argument(
+        "--warm-start",
+        action="store_true",
+        help="""\
+        If True, the registration of every section starts from the transform
+        found for the previous section (by section number), unless the
+        latter matches worse than the identity.
+        """,
+    )
+    parser.add_argument(
+        "--warm-start-iterations",
+        type=str,
+        help="""\
+        ANTs iterations of the warm-started registrations, e.g. 40x20x0.
+        Ignored with --pyramid-factors.
+        """,
+    )
+    parser.add_argument(
+        "--shared-memory",
+        action="store_true",
+        help="""\
+        If True, the reference volumes are loaded once into shared memory
+        (/dev/shm) and every process running the pipeline attaches to the
+        same copy.
+        """,
+    )
+    parser.add_argument(
+        "--executor",
+        type=str,
+        choices=("serial", "process", "dask"),
+        help="""\
+        If specified, the sections are registered in parallel by this
+        executor: local processes or a dask cluster. Cannot be combined
+        with --warm-start.
+        """,
+    )
+    parser.add_argument(
+        "--n-workers",
+        type=int,
+        help="""\
+        Number of local workers of the executor. By default, the number
+        of CPUs.
+        """,
+    )
+    parser.add_argument(
+        "--scheduler-address",
+        type=str,
+        help="""\
+        Address of the dask scheduler. If not specified, a local dask
+        cluster is started.
+        """,
+    )
+    parser.add_argument(
+        "--retries",
+        type=int,
+        default=0,
+        help="""\
+        Number of times the registration of a section is run again by the
+        executor when it fails.
+        """,
+    )
+    parser.add_argument(
+        "--sparse-expression",
+        action="store_true",
+        help="""\
+        If True, the warped threshold images are saved with run-length
+        encoding (<experiment_id>-warped-expression.rle.npz).
+        """,
+    )
+    parser.add_argument(
+        "--no-checkpoint",
+        dest="checkpoint",
+        action="store_false",
+        help="""\
+        If specified, the registered sections are not saved one by one
+        while the registration is running. By default, they are saved in
+        <output_dir>/<experiment_id>-checkpoint/ so that an interrupted
+        run resumes where it stopped.
+        """,
+    )
     return parser.parse_args()
 
 
-def registration(
-    nissl_volume: np.ndarray,
-    gene_volume: np.ndarray,
-    section_numbers: np.ndarray,
-    expression_volume: np.ndarray | None,
-) -> tuple[np.ndarray, np.ndarray | None, list[bool]]:
-    """Compute registration transform between a couple of volumes.
+def parse_iterations(iterations: str) -> tuple[int, ...]:
+    """Parse ANTs-like iterations such as "100x70x50"."""
+    return tuple(int(n) for n in iterations.split("x"))
+
+
+def upsample_field(nii_data: np.ndarray, shape: tuple[int, int]) -> np.ndarray:
+    """Resize a 2D displacement field to a new image shape.
+
+    Parameters
+    ----------
+    nii_data
+        Displacement field as returned by `atlannot.ants.register`. Its two
+        first axes are the spatial ones and its last axis contains the
+        displacement along each of them (in pixels).
+    shape
+        Shape of the images at the new resolution.
+
+    Returns
+    -------
+    nii_data : np.ndarray
+        Displacement field at the new resolution, with displacements
+        scaled accordingly.
+    """
+    from skimage.transform import resize
+
+    new_shape = tuple(shape) + nii_data.shape[2:]
+    upsampled = resize(nii_data, new_shape, order=1, preserve_range=True)
+    for axis in range(2):
+        upsampled[..., axis] *= shape[axis] / nii_data.shape[axis]
+    return upsampled
+
+
+def compose_fields(first: np.ndarray, second: np.ndarray) -> np.ndarray:
+    """Compose two displacement fields.
+
+    Warping with the result is the same as warping with `first`
+    and then with `second`.
+
+    Parameters
+    ----------
+    first
+        Displacement field applied first.
+    second
+        Displacement field applied to the image already warped by `first`.
+
+    Returns
+    -------
+    nii_data : np.ndarray
+        Composed displacement field.
+    """
+    from atlannot.ants import transform
+
+    composed = second.copy()
+    image_shape = first.shape[:2]
+    for axis in range(first.shape[-1]):
+        component = first[..., axis]
+        warped = transform(component.reshape(image_shape), second)
+        composed[..., axis] += warped.reshape(component.shape)
+    return composed
+
+
+def register_pyramid(
+    nissl_slice: np.ndarray,
+    gene_slice: np.ndarray,
+    factors: list[int],
+    iterations: list[str] | None = None,
+    skip_nmi: float | None = None,
+    initial: np.ndarray | None = None,
+) -> np.ndarray:
+    """Register a gene section to a Nissl section coarse to fine.
+
+    Parameters
+    ----------
+    nissl_slice
+        Nissl section (fixed image).
+    gene_slice
+        Grayscale gene section (moving image).
+    factors
+        Downsampling factor of every level, from the coarsest to the finest.
+    iterations
+        If specified, ANTs iterations of every level (e.g. "100x70x50").
+    skip_nmi
+        If specified, the remaining levels are skipped as soon as the
+        normalized mutual information between the Nissl section and the
+        warped gene section reaches this value.
+    initial
+        If specified, displacement field at full resolution the registration
+        starts from. Otherwise, the registration starts from the identity.
+
+    Returns
+    -------
+    nii_data : np.ndarray
+        Displacement field at full resolution.
+    """
+    from atlannot.ants import register, transform
+    from metrics import image_nmi
+    from skimage.transform import rescale
+
+    if iterations is not None and len(iterations) != len(factors):
+        raise ValueError(
+            f"The number of iterations ({len(iterations)}) has to be consistent "
+            f"to the number of pyramid levels ({len(factors)})"
+        )
+
+    nii_data = initial
+    warped = gene_slice if initial is None else transform(gene_slice, initial)
+    for level, factor in enumerate(factors):
+        kwargs = {}
+        if iterations is not None:
+            kwargs["reg_iterations"] = parse_iterations(iterations[level])
+
+        fixed, moving = nissl_slice, warped
+        if factor > 1:
+            scale = 1 / factor
+            fixed = rescale(fixed, scale, anti_aliasing=True, preserve_range=True)
+            moving = rescale(moving, scale, anti_aliasing=True, preserve_range=True)
+
+        start = time.perf_counter()
+        level_data = register(fixed, moving, is_atlas=False, **kwargs)
+        if factor > 1:
+            level_data = upsample_field(level_data, nissl_slice.shape)
+        if nii_data is not None:
+            level_data = compose_fields(nii_data, level_data)
+        nii_data = level_data
+        warped = transform(gene_slice, nii_data)
+
+        nmi = image_nmi(nissl_slice, warped)
+        logger.debug(
+            f"Pyramid level {level} (factor {factor}): NMI {nmi:.4f} "
+            f"in {time.perf_counter() - start:.2f}s"
+        )
+        if skip_nmi is not None and nmi >= skip_nmi and level < len(factors) - 1:
+            logger.debug(f"Remaining pyramid levels skipped (NMI {nmi:.4f})")
+            break
+
+    return nii_data
+
+
+def warm_start_transform(
+    nissl_slice: np.ndarray, gene_slice: np.ndarray, candidate: np.ndarray
+) -> np.ndarray | None:
+    """Check whether a transform is a good starting point for a registration.
+
+    Parameters
+    ----------
+    nissl_slice
+        Nissl section (fixed image).
+    gene_slice
+        Grayscale gene section (moving image).
+    candidate
+        Displacement field of a neighbouring section.
+
+    Returns
+    -------
+    initial : np.ndarray | None
+        The candidate if the gene section warped by it matches the Nissl
+        section better than the gene section itself, None otherwise.
+    """
+    from atlannot.ants import transform
+    from metrics import image_nmi
+
+    identity_nmi = image_nmi(nissl_slice, gene_slice)
+    candidate_nmi = image_nmi(nissl_slice, transform(gene_slice, candidate))
+    if candidate_nmi < identity_nmi:
+        logger.debug(
+            f"Warm start rejected (NMI {candidate_nmi:.4f} < {identity_nmi:.4f})"
+        )
+        return None
+    return candidate
+
+
+def find_valid_sections(
+    section_numbers: list[int | float], n_sections: int, warn: bool = True
+) -> list[int]:
+    """Find the gene sections lying inside the nissl volume.
 
     Parameters
     ----------
-    nissl_volume
-        Nissl volume (fixed volume during registration).
-    gene_volume
-        Gene to register (moving volume during registration).
     section_numbers
-        Section numbers of every gene slice in gene volume.
-    expression_volume
-        If specified, volume to which we apply same transform
-        as the gene_volume.
+        Section number of every gene section.
+    n_sections
+        Number of sections of the nissl volume along the section axis.
+    warn
+        If True, a warning is logged for every section out of the volume.
 
     Returns
     -------
-    warped_genes : np.ndarray
-        Warped slice.
-    warped_expression : np.ndarray | None
-        Warped expression.
-    section_numbers_kept : list[bool]
-        Boolean value saying if section was kept or removed.
+    valid_indices : list[int]
+        Indices (in `section_numbers`) of the sections to keep.
     """
-    rgb = False
-    if gene_volume.ndim == 4:
-        rgb = True
-
-    warped_genes = []
-    warped_expression = []
-    section_numbers_kept = []
-    for i, (section_number, gene_slice) in enumerate(zip(section_numbers, gene_volume)):
-        try:
-            if section_number < 0:
-                raise IndexError("The index is negative.")
-            nissl_slice = nissl_volume[int(section_number)]
-        except IndexError:
-            logger.warn(
+    valid_indices = []
+    for i, section_number in enumerate(section_numbers):
+        if 0 <= section_number < n_sections:
+            valid_indices.append(i)
+        elif warn:
+            logger.warning(
                 f"One of the gene slice has a section number ({section_number}) "
-                f"out of nissl volume shape {nissl_volume.shape}. This slice is "
+                f"out of nissl volume ({n_sections} sections). This slice is "
                 "removed from the pipeline."
             )
-            section_numbers_kept.append(False)
+    return valid_indices
+
+
+def prepare_checkpoint(checkpoint_dir: Path, parameters: dict[str, Any]) -> None:
+    """Create the checkpoint directory of a registration.
+
+    Sections registered with other parameters (e.g. by a previous run with
+    other pyramid factors or on a regenerated input volume) cannot be
+    reused, the checkpoint is then emptied.
+
+    Parameters
+    ----------
+    checkpoint_dir
+        Directory where the registered sections are saved one by one.
+    parameters
+        Parameters of the registration, JSON serializable.
+    """
+    parameters_path = checkpoint_dir / "parameters.json"
+    if parameters_path.exists():
+        with open(parameters_path) as f:
+            previous_parameters = json.load(f)
+        if previous_parameters != json.loads(json.dumps(parameters)):
+            logger.warning(
+                f"The checkpoint {checkpoint_dir} was made with other "
+                "parameters, it is discarded"
+            )
+            shutil.rmtree(checkpoint_dir)
+
+    checkpoint_dir.mkdir(parents=True, exist_ok=True)
+    with open(parameters_path, "w") as f:
+        json.dump(parameters, f, indent=True, sort_keys=True)
+
+
+def save_checkpoint(
+    checkpoint_dir: Path,
+    section_number: int,
+    warped: np.ndarray,
+    warped_expression: np.ndarray | None,
+    nii_data: np.ndarray,
+) -> None:
+    """Save one registered section.
+
+    The file is written under a temporary name and then renamed, so that
+    a run interrupted while saving never leaves a truncated section.
+    """
+    arrays = {"warped": warped, "transform": nii_data}
+    if warped_expression is not None:
+        arrays["expression"] = warped_expression
+
+    path = checkpoint_dir / f"section-{section_number}.npz"
+    tmp_path = checkpoint_dir / f"section-{section_number}.tmp"
+    with open(tmp_path, "wb") as f:
+        np.savez(f, **arrays)
+    os.replace(tmp_path, path)
+
+
+def load_checkpoint(
+    checkpoint_dir: Path, section_numbers: list[int]
+) -> dict[int, tuple[np.ndarray, np.ndarray | None, np.ndarray]]:
+    """Load the sections already registered.
+
+    Parameters
+    ----------
+    checkpoint_dir
+        Directory where the registered sections are saved one by one.
+    section_numbers
+        Section numbers of the sections to register.
+
+    Returns
+    -------
+    done : dict
+        Warped image, warped expression (or None) and registration
+        transform of every section found in the checkpoint.
+    """
+    done = {}
+    for section_number in section_numbers:
+        path = checkpoint_dir / f"section-{section_number}.npz"
+        if not path.exists():
             continue
+        with np.load(path) as data:
+            expression = data["expression"] if "expression" in data else None
+            done[section_number] = (data["warped"], expression, data["transform"])
+    return done
+
+
+def register_section(
+    nissl_slice: np.ndarray,
+    image: np.ndarray,
+    expression: np.ndarray | None = None,
+    pyramid_factors: list[int] | None = None,
+    pyramid_iterations: list[str] | None = None,
+    pyramid_skip_nmi: float | None = None,
+    previous_transform: np.ndarray | None = None,
+    warm_start_iterations: str | None = None,
+) -> tuple[np.ndarray, np.ndarray | None, np.ndarray, bool]:
+    """Register one gene section to its nissl section.
+
+    This is a module-level function so that it can be sent to the workers
+    of an executor, see `executors`.
 
-        if rgb:
-            gene_slice_rgb = gene_slice.copy()
-            gene_slice = rgb2gray(gene_slice)
+    Parameters
+    ----------
+    nissl_slice
+        Nissl section (fixed image).
+    image
+        Gene section (moving image), grayscale or RGB.
+    expression
+        If specified, RGB expression image warped with the same transform.
+    pyramid_factors, pyramid_iterations, pyramid_skip_nmi
+        Parameters of the coarse to fine registration, see `registration`.
+    previous_transform
+        If specified, transform of the previous section used as a warm start
+        when it matches better than the identity.
+    warm_start_iterations
+        ANTs iterations of the warm-started registration, when there is no
+        pyramid.
 
+    Returns
+    -------
+    warped : np.ndarray
+        Warped gene section.
+    warped_expression : np.ndarray or None
+        Warped expression image, if `expression` is specified.
+    nii_data : np.ndarray
+        Registration transform.
+    warm_started : bool
+        Whether the registration started from `previous_transform`.
+    """
+    from atlannot.ants import register, transform
+    from skimage.color import rgb2gray
+
+    gene_slice = image
+    rgb = gene_slice.ndim == 3
+    if rgb:
+        gene_slice = rgb2gray(gene_slice)
+
+    initial = None
+    if previous_transform is not None:
+        initial = warm_start_transform(nissl_slice, gene_slice, previous_transform)
+
+    if pyramid_factors is not None:
+        nii_data = register_pyramid(
+            nissl_slice,
+            gene_slice,
+            pyramid_factors,
+            iterations=pyramid_iterations,
+            skip_nmi=pyramid_skip_nmi,
+            initial=initial,
+        )
+    elif initial is not None:
+        iterations = None
+        if warm_start_iterations is not None:
+            iterations = [warm_start_iterations]
+        nii_data = register_pyramid(
+            nissl_slice, gene_slice, [1], iterations=iterations, initial=initial
+        )
+    else:
         nii_data = register(nissl_slice, gene_slice, is_atlas=False)
 
-        if rgb:
-            warped = np.zeros_like(gene_slice_rgb)
-            warped[:, :, 0] = transform(gene_slice_rgb[:, :, 0], nii_data)
-            warped[:, :, 1] = transform(gene_slice_rgb[:, :, 1], nii_data)
-            warped[:, :, 2] = transform(gene_slice_rgb[:, :, 2], nii_data)
-        else:
-            warped = transform(gene_slice, nii_data)
+    if rgb:
+        warped = np.zeros_like(image)
+        warped[:, :, 0] = transform(image[:, :, 0], nii_data)
+        warped[:, :, 1] = transform(image[:, :, 1], nii_data)
+        warped[:, :, 2] = transform(image[:, :, 2], nii_data)
+    else:
+        warped = transform(gene_slice, nii_data)
 
-        warped_genes.append(warped)
+    warped_expression = None
+    if expression is not None:
+        warped_expression = np.zeros_like(expression)
+        warped_expression[:, :, 0] = transform(expression[:, :, 0], nii_data)
+        warped_expression[:, :, 1] = transform(expression[:, :, 1], nii_data)
+        warped_expression[:, :, 2] = transform(expression[:, :, 2], nii_data)
 
-        if expression_volume is not None:
-            expression = expression_volume[i]
-            warped = np.zeros_like(expression)
-            warped[:, :, 0] = transform(expression[:, :, 0], nii_data)
-            warped[:, :, 1] = transform(expression[:, :, 1], nii_data)
-            warped[:, :, 2] = transform(expression[:, :, 2], nii_data)
+    return warped, warped_expression, nii_data, initial is not None
 
-            warped_expression.append(warped)
 
-        section_numbers_kept.append(True)
+def registration(
+    nissl_sections: dict[int, np.ndarray],
+    sections: SectionStore,
+    pyramid_factors: list[int] | None = None,
+    pyramid_iterations: list[str] | None = None,
+    pyramid_skip_nmi: float | None = None,
+    warm_start: bool = False,
+    warm_start_iterations: str | None = None,
+    executor: Executor | None = None,
+    checkpoint_dir: Path | None = None,
+) -> SectionStore:
+    """Compute registration transform between a couple of volumes.
 
-        if (i + 1) % 5 == 0:
-            logger.info(f" {i + 1} / {gene_volume.shape[0]} registrations done")
+    Parameters
+    ----------
+    nissl_sections
+        Nissl section (fixed image during registration) of every section
+        number, see `utils.extract_sections`.
+    sections
+        Gene sections to register (moving images during registration).
+        If a section has an expression image, the same transform
+        is applied to it.
+    pyramid_factors
+        If specified, every section is registered coarse to fine with
+        these downsampling factors, see `register_pyramid`. Otherwise,
+        sections are registered at full resolution only.
+    pyramid_iterations
+        ANTs iterations of every level of the pyramid.
+    pyramid_skip_nmi
+        NMI above which the remaining levels of the pyramid are skipped.
+    warm_start
+        If True, sections are registered by increasing section number and
+        every registration starts from the transform of the previous
+        section, unless it matches worse than the identity.
+    warm_start_iterations
+        ANTs iterations of the warm-started registrations (e.g. "40x20x0"),
+        when there is no pyramid. Fewer iterations are usually needed than
+        when starting from the identity.
+    executor
+        If specified, the sections are registered in parallel by this
+        executor (see `executors`). Cannot be combined with `warm_start`,
+        where every registration needs the previous one.
+    checkpoint_dir
+        If specified, every registered section is saved in this directory
+        as soon as it is done, and the sections already saved there are
+        not registered again. See `prepare_checkpoint`.
+
+    Returns
+    -------
+    warped_sections : SectionStore
+        Warped sections together with their registration transform.
+        With `warm_start`, the sections are sorted by section number.
+
+    Raises
+    ------
+    ValueError
+        When the nissl section of some gene sections is missing, e.g.
+        because they are out of the nissl volume. See `find_valid_sections`
+        to filter them out beforehand. Or when both `warm_start` and
+        `executor` are specified.
+    """
+    from sections import SectionStore
+
+    missing = [s for s in sections.section_numbers if s not in nissl_sections]
+    if missing:
+        raise ValueError(f"The nissl sections {missing} are missing.")
+    if warm_start and executor is not None:
+        raise ValueError(
+            "Warm-started registrations are sequential, "
+            "they cannot be run by an executor."
+        )
+
+    if warm_start:
+        order = sections.sorted_section_numbers()
+    else:
+        order = sections.section_numbers
+
+    pyramid_kwargs = {
+        "pyramid_factors": pyramid_factors,
+        "pyramid_iterations": pyramid_iterations,
+        "pyramid_skip_nmi": pyramid_skip_nmi,
+    }
+
+    done = {}
+    if checkpoint_dir is not None:
+        done = load_checkpoint(checkpoint_dir, order)
+        if done:
+            logger.info(
+                f"{len(done)} / {len(order)} sections found in the checkpoint "
+                f"{checkpoint_dir}"
+            )
 
-    warped_expression = np.array(warped_expression) if warped_expression else None
+    start = time.perf_counter()
+    n_warm_starts = 0
+    if executor is not None:
+        futures = {}
+        for section_number in order:
+            if section_number in done:
+                continue
+            section = sections[section_number]
+            future = executor.submit(
+                register_section,
+                executor.scatter(nissl_sections[section_number]),
+                section.image,
+                section.expression,
+                **pyramid_kwargs,
+            )
+            futures[future] = section_number
+
+        # Sections are checkpointed as soon as they are registered, so that
+        # a slow section does not hold back the ones that finished after it
+        n_submitted = len(futures)
+        for i, future in enumerate(executor.as_completed(list(futures))):
+            section_number = futures.pop(future)
+            warped, warped_expression, nii_data, warm_started = future.result()
+            n_warm_starts += warm_started
+            if checkpoint_dir is not None:
+                save_checkpoint(
+                    checkpoint_dir,
+                    section_number,
+                    warped,
+                    warped_expression,
+                    nii_data,
+                )
+            done[section_number] = (warped, warped_expression, nii_data)
+            if (i + 1) % 5 == 0:
+                logger.info(f" {i + 1} / {n_submitted} registrations done")
+
+    previous_transform = None
+    warped_sections = SectionStore()
+    for i, section_number in enumerate(order):
+        section = sections[section_number]
+        if section_number in done:
+            warped, warped_expression, nii_data = done.pop(section_number)
+        else:
+            result = register_section(
+                nissl_sections[section_number],
+                section.image,
+                section.expression,
+                **pyramid_kwargs,
+                previous_transform=previous_transform,
+                warm_start_iterations=warm_start_iterations,
+            )
+            warped, warped_expression, nii_data, warm_started = result
+            n_warm_starts += warm_started
+            if checkpoint_dir is not None:
+                save_checkpoint(
+                    checkpoint_dir,
+                    section_number,
+                    warped,
+                    warped_expression,
+                    nii_data,
+                )
+        if warm_start:
+            previous_transform = nii_data
+
+        warped_sections.add(
+            section_number,
+            warped,
+            image_id=section.image_id,
+            expression=warped_expression,
+            transform=nii_data,
+        )
+
+        if executor is None and (i + 1) % 5 == 0:
+            logger.info(f" {i + 1} / {len(sections)} registrations done")
 
-    return np.array(warped_genes), warped_expression, section_numbers_kept
+    logger.info(
+        f"{len(warped_sections)} registrations done in "
+        f"{time.perf_counter() - start:.1f}s"
+        + (f" ({n_warm_starts} warm-started)" if warm_start else "")
+    )
+
+    return warped_sections
 
 
 def main(
@@ -160,9 +744,32 @@ def main(
     nissl_path: Path | str,
     output_dir: Path | str,
     expression_path: str | Path | None = None,
+    pyramid_factors: list[int] | None = None,
+    pyramid_iterations: list[str] | None = None,
+    pyramid_skip_nmi: float | None = None,
+    warm_start: bool = False,
+    warm_start_iterations: str | None = None,
+    shared_memory: bool = False,
+    executor: str | None = None,
+    n_workers: int | None = None,
+    scheduler_address: str | None = None,
+    retries: int = 0,
+    checkpoint: bool = True,
+    sparse_expression: bool = False,
+    async_save: bool = False,
 ) -> int:
     """Implement main function."""
-    from utils import check_and_load
+    from executors import get_executor
+    from sections import SectionStore
+    from utils import (
+        RLE_SUFFIX,
+        SECTION_AXES,
+        check_and_load,
+        extract_sections,
+        file_version,
+        save_volume,
+        save_volume_async,
+    )
 
     gene_path = Path(gene_path)
     metadata_path = Path(metadata_path)
@@ -171,25 +778,29 @@ def main(
     if expression_path is not None:
         expression_path = Path(expression_path)
 
-    logger.info("Loading volumes")
-    nissl = check_and_load(nissl_path)
-    genes = check_and_load(gene_path)
-    experiment_id = gene_path.stem
-
-    expression = None
-    if expression_path is not None:
-        expression = check_and_load(expression_path)
-
     with open(metadata_path) as f:
         json_dict = json.load(f)
 
     section_numbers = json_dict["section_numbers"]
+    image_ids = json_dict["image_ids"]
     axis = json_dict["axis"]
 
-    if axis == "sagittal":
-        nissl = np.transpose(nissl, (2, 0, 1))
+    logger.info("Loading volumes")
+    # Memory-map the volumes so that only the slices used are read
+    nissl = check_and_load(nissl_path, mmap=True, shared=shared_memory)
+    genes = check_and_load(gene_path, mmap=True)
+    experiment_id = gene_path.stem
 
-    if nissl.shape[1:] != genes.shape[1:3]:
+    expression = None
+    if expression_path is not None:
+        expression = check_and_load(expression_path, mmap=True)
+
+    section_axis = SECTION_AXES[axis]
+    nissl_section_shape = tuple(
+        size for i, size in enumerate(nissl.shape) if i != section_axis
+    )
+
+    if nissl_section_shape != genes.shape[1:3]:
         raise ValueError(
             f"It seems the nissl ({nissl.shape}) and genes ({genes.shape}) "
             "do not have the same shape !"
@@ -201,32 +812,95 @@ def main(
             f" has to be consistent to the genes shape ({genes.shape[0]})"
         )
 
-    logger.info("Start registration...")
-
-    warped_genes, warped_expression, section_numbers_kept = registration(
-        nissl, genes, section_numbers, expression_volume=expression
+    valid_indices = find_valid_sections(section_numbers, nissl.shape[section_axis])
+    if expression is not None:
+        expression = expression[valid_indices]
+    sections = SectionStore.from_arrays(
+        genes[valid_indices],
+        [section_numbers[i] for i in valid_indices],
+        image_ids=[image_ids[i] for i in valid_indices],
+        expressions=expression,
     )
+    nissl_sections = extract_sections(nissl, sections.section_numbers, axis)
+
+    if executor is not None:
+        if warm_start:
+            logger.error("--warm-start cannot be combined with --executor")
+            return 1
+        executor = get_executor(
+            executor, n_workers=n_workers, address=scheduler_address, retries=retries
+        )
+
+    checkpoint_dir = None
+    if checkpoint:
+        checkpoint_dir = output_dir / f"{experiment_id}-checkpoint"
+        prepare_checkpoint(
+            checkpoint_dir,
+            {
+                "gene_path": str(gene_path.resolve()),
+                "nissl_path": str(nissl_path.resolve()),
+                "expression_path": expression_path and str(expression_path.resolve()),
+                # Regenerated inputs at the same paths invalidate the checkpoints
+                "gene_version": file_version(gene_path),
+                "nissl_version": file_version(nissl_path),
+                "expression_version": expression_path and file_version(expression_path),
+                "image_ids": sections.image_ids,
+                "pyramid_factors": pyramid_factors,
+                "pyramid_iterations": pyramid_iterations,
+                "pyramid_skip_nmi": pyramid_skip_nmi,
+                "warm_start": warm_start,
+                "warm_start_iterations": warm_start_iterations,
+            },
+        )
+
+    logger.info("Start registration...")
+    try:
+        warped_sections = registration(
+            nissl_sections,
+            sections,
+            pyramid_factors=pyramid_factors,
+            pyramid_iterations=pyramid_iterations,
+            pyramid_skip_nmi=pyramid_skip_nmi,
+            warm_start=warm_start,
+            warm_start_iterations=warm_start_iterations,
+            executor=executor,
+            checkpoint_dir=checkpoint_dir,
+        )
+    finally:
+        if executor is not None:
+            executor.shutdown()
 
     logger.info("Saving results...")
     output_dir.mkdir(parents=True, exist_ok=True)
-    np.save(output_dir / f"{experiment_id}-warped-gene", warped_genes)
-
-    json_dict["section_numbers"] = [
-        image_id
-        for image_id, kept in zip(json_dict["section_numbers"], section_numbers_kept)
-        if kept
-    ]
-    json_dict["image_ids"] = [
-        image_id
-        for image_id, kept in zip(json_dict["image_ids"], section_numbers_kept)
-        if kept
-    ]
-
+    warped_sections.update_metadata(json_dict)
     with open(output_dir / f"{experiment_id}-metadata.json", "w") as f:
         json.dump(json_dict, f, indent=True, sort_keys=True)
 
+    warped_gene_path = output_dir / f"{experiment_id}-warped-gene.npy"
+    volumes = {warped_gene_path: warped_sections.images()}
+    warped_expression = warped_sections.expressions()
     if warped_expression is not None:
-        np.save(output_dir / f"{experiment_id}-warped-expression", warped_expression)
+        suffix = RLE_SUFFIX if sparse_expression else ".npy"
+        volumes[output_dir / f"{experiment_id}-warped-expression{suffix}"] = (
+            warped_expression
+        )
+
+    if async_save:
+        futures = [save_volume_async(path, volume) for path, volume in volumes.items()]
+
+        # The checkpoints are kept until the results are on disk
+        def remove_checkpoint(_):
+            if all(future.done() and future.exception() is None for future in futures):
+                shutil.rmtree(checkpoint_dir, ignore_errors=True)
+
+        if checkpoint_dir is not None:
+            for future in futures:
+                future.add_done_callback(remove_checkpoint)
+    else:
+        for path, volume in volumes.items():
+            save_volume(path, volume)
+        if checkpoint_dir is not None:
+            shutil.rmtree(checkpoint_dir)
 
     return 0
 
@@ -18,10 +18,16 @@ import argparse
 import json
 import logging
 import sys
+import time
+from functools import lru_cache
 from pathlib import Path
 
 logger = logging.getLogger("interpolate-gene")
 
+VOLUME_SHAPE = (528, 320, 456, 3)
+# Voxel size in micrometers of the volumes of shape VOLUME_SHAPE (CCFv2/CCFv3)
+VOXEL_SIZE = 25.0
+
 
 def parse_args():
     """Parse arguments."""
@@ -81,6 +87,86 @@ def parse_args():
         specify a reference path.
         """,
     )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="""\
+        If True and the output of a previous run exists, only the sections
+        next to the known sections that were added, removed or modified
+        since that run are predicted again and patched into the existing
+        output volume.
+        """,
+    )
+    parser.add_argument(
+        "--half-brain",
+        action="store_true",
+        help="""\
+        If True and the experiment is sagittal, only the left hemisphere is
+        interpolated. The right hemisphere is its mirror, as for entire
+        volumes, and is only produced when saving.
+        """,
+    )
+    parser.add_argument(
+        "--adaptive",
+        action="store_true",
+        help="""\
+        If True, every gap between known sections is predicted on its own,
+        with the linear model for the small gaps and the gaps between
+        similar sections, and with the chosen interpolator otherwise.
+        Also applies to --incremental and --half-brain runs. Only for the
+        pair interpolation models (rife and cain).
+        """,
+    )
+    parser.add_argument(
+        "--adaptive-max-gap",
+        type=int,
+        default=1,
+        help="""\
+        With --adaptive, gaps with at most this number of missing sections
+        are predicted with the linear model.
+        """,
+    )
+    parser.add_argument(
+        "--adaptive-min-nmi",
+        type=float,
+        default=0.9,
+        help="""\
+        With --adaptive, gaps whose two known sections have a normalized
+        mutual information above this value are predicted with the linear
+        model.
+        """,
+    )
+    parser.add_argument(
+        "--flow-cache-dir",
+        type=Path,
+        help="""\
+        If specified and the interpolator is an optical flow model, the
+        flows between the sections of the reference volume are cached in
+        this directory and reused by later runs with the same reference
+        volume and model, e.g. for other experiments.
+        """,
+    )
+    parser.add_argument(
+        "--shared-memory",
+        action="store_true",
+        help="""\
+        If True, the reference volumes are loaded once into shared memory
+        (/dev/shm) and every process running the pipeline attaches to the
+        same copy.
+        """,
+    )
+    parser.add_argument(
+        "--preview-levels",
+        type=int,
+        nargs="+",
+        metavar="FACTOR",
+        help="""\
+        If specified, downsampled previews of the interpolated volume are
+        saved too, one per factor (e.g. 2 4 8), averaging blocks of FACTOR
+        voxels per axis. They are saved next to the volume as
+        <name>-preview<FACTOR>x.<saving-format>.
+        """,
+    )
     return parser.parse_args()
 
 
@@ -141,6 +227,745 @@ def load_interpolator_model(interpolator_name: str, checkpoint: str | Path | Non
     return model
 
 
+@lru_cache(maxsize=4)
+def get_interpolator_model(interpolator_name: str, checkpoint: str | None):
+    """Load an interpolator model once per process.
+
+    Long running processes (e.g. `worker.py`) running several interpolations
+    reuse the same model instead of loading the checkpoint again.
+
+    Parameters
+    ----------
+    interpolator_name
+        Name of the interpolator model.
+    checkpoint
+        Path of the interpolator checkpoint, as a string so that equivalent
+        paths share the same model.
+
+    Returns
+    -------
+    model
+        Interpolator model, as returned by `load_interpolator_model`.
+    """
+    return load_interpolator_model(interpolator_name, checkpoint)
+
+
+def predict_sections(
+    images,
+    section_numbers: list[int],
+    volume_shape: tuple[int, ...],
+    axis: str,
+    interpolator_name: str,
+    interpolator_model,
+    reference_volume=None,
+    flow_cache=None,
+):
+    """Predict a volume from some known sections.
+
+    Parameters
+    ----------
+    images : np.ndarray
+        Known (normalized) gene sections.
+    section_numbers
+        Section number of every known section.
+    volume_shape
+        Shape of the volume to predict.
+    axis
+        Axis of the experiment, either "coronal" or "sagittal".
+    interpolator_name
+        Name of the interpolator model.
+    interpolator_model
+        Interpolator model, as returned by `load_interpolator_model`.
+    reference_volume : np.ndarray | None
+        Reference volume of shape `volume_shape` (without the channels),
+        only needed by the optical flow models.
+    flow_cache : flow_cache.FlowCache | None
+        If specified, the flows between reference sections are read from
+        this cache when possible, and saved to it otherwise.
+
+    Returns
+    -------
+    predicted_volume : np.ndarray
+        Volume of shape `volume_shape` containing the known and the
+        predicted sections.
+    """
+    from atlinter.data import GeneDataset
+
+    # Wrap the data into a GeneDataset class
+    gene_dataset = GeneDataset(
+        images,
+        section_numbers,
+        volume_shape=volume_shape,
+        axis=axis,
+    )
+
+    # Create a gene interpolator
+    if interpolator_name in {"cain", "linear", "rife"}:
+        from atlinter.pair_interpolation import GeneInterpolate
+
+        gene_interpolate = GeneInterpolate(
+            gene_dataset, interpolator_model, border_predictions=False
+        )
+        return gene_interpolate.predict_volume()
+    elif flow_cache is None:
+        from atlinter.optical_flow import GeneOpticalFlow
+
+        gene_optical_flow = GeneOpticalFlow(
+            gene_dataset, reference_volume, interpolator_model
+        )
+        return gene_optical_flow.predict_volume()
+    else:
+        from flow_cache import CachedGeneOpticalFlow
+
+        gene_optical_flow = CachedGeneOpticalFlow(
+            gene_dataset, reference_volume, interpolator_model, flow_cache
+        )
+        predicted_volume = gene_optical_flow.predict_volume()
+        logger.info(
+            f"{gene_optical_flow.n_hits} reference flows reused from the cache, "
+            f"{gene_optical_flow.n_misses} computed"
+        )
+        return predicted_volume
+
+
+def predict_gap(
+    sections,
+    left: int,
+    right: int,
+    axis: str,
+    interpolator_name: str,
+    interpolator_model,
+    reference_volume=None,
+    flow_cache=None,
+):
+    """Predict the sections lying between two known sections.
+
+    Only the two known sections bounding the gap are read, and the
+    interpolation is run on a sub-volume spanning the gap only.
+
+    Parameters
+    ----------
+    sections : SectionStore
+        Known (normalized) gene sections.
+    left
+        Section number of the known section on the left of the gap.
+    right
+        Section number of the known section on the right of the gap.
+    axis
+        Axis of the experiment, either "coronal" or "sagittal".
+    interpolator_name
+        Name of the interpolator model.
+    interpolator_model
+        Interpolator model, as returned by `load_interpolator_model`.
+    reference_volume : np.ndarray | None
+        Reference volume, only needed by the optical flow models.
+    flow_cache : flow_cache.FlowCache | None
+        If specified, the flows between reference sections are read from
+        this cache when possible, and saved to it otherwise.
+
+    Returns
+    -------
+    gap_volume : np.ndarray
+        Sub-volume containing the sections from `left` to `right` (both
+        included) along the section axis of the experiment.
+    """
+    import numpy as np
+    from utils import SECTION_AXES
+
+    section_axis = SECTION_AXES[axis]
+    volume_shape = list(VOLUME_SHAPE)
+    volume_shape[section_axis] = right - left + 1
+
+    gap_reference = None
+    if reference_volume is not None:
+        gap_reference = np.take(
+            reference_volume, range(left, right + 1), axis=section_axis
+        )
+    if flow_cache is not None:
+        # The sections of the sub-volume are numbered from the left one
+        flow_cache = flow_cache.with_offset(left)
+
+    return predict_sections(
+        np.stack([sections[left].image, sections[right].image]),
+        [0, right - left],
+        tuple(volume_shape),
+        axis,
+        interpolator_name,
+        interpolator_model,
+        gap_reference,
+        flow_cache,
+    )
+
+
+def predict_half_sagittal(
+    sections,
+    interpolator_name: str,
+    interpolator_model,
+    reference_volume=None,
+    flow_cache=None,
+    adaptive: bool = False,
+    max_gap: int = 1,
+    min_nmi: float = 0.9,
+):
+    """Predict the left hemisphere of a sagittal volume only.
+
+    The right hemisphere of sagittal volumes is overwritten by the mirror
+    of the left one, so it does not need to be predicted. Only the known
+    sections of the left hemisphere are used, plus the first one beyond
+    the middle so that the sections close to the middle are predicted as
+    in the entire volume.
+
+    Parameters
+    ----------
+    sections : SectionStore
+        Known (normalized) sagittal gene sections.
+    interpolator_name
+        Name of the interpolator model.
+    interpolator_model
+        Interpolator model, as returned by `load_interpolator_model`.
+    reference_volume : np.ndarray | None
+        Reference volume, only needed by the optical flow models.
+    flow_cache : flow_cache.FlowCache | None
+        If specified, the flows between reference sections are read from
+        this cache when possible, and saved to it otherwise.
+    adaptive
+        If True, the gaps are predicted one by one and the linear model is
+        used where it suffices, see `predict_gaps_adaptive`.
+    max_gap
+        With `adaptive`, see `predict_gaps_adaptive`.
+    min_nmi
+        With `adaptive`, see `predict_gaps_adaptive`.
+
+    Returns
+    -------
+    left_volume : np.ndarray
+        Left hemisphere of the volume, of shape `(528, 320, 228, 3)`.
+    gaps : list[dict]
+        With `adaptive`, the gaps as returned by `predict_gaps_adaptive`.
+        Otherwise, an empty list.
+    """
+    import numpy as np
+
+    half = VOLUME_SHAPE[2] // 2
+    kept = [s for s in sections.sorted_section_numbers() if s < half]
+    _, next_section = sections.neighbours(half - 1)
+    width = half
+    if next_section is not None:
+        kept.append(next_section)
+        width = next_section + 1
+
+    volume_shape = VOLUME_SHAPE[:2] + (width,) + VOLUME_SHAPE[3:]
+    if reference_volume is not None:
+        reference_volume = reference_volume[:, :, :width]
+
+    gaps = []
+    if adaptive:
+        dtype = np.asarray(sections[kept[0]].image).dtype
+        predicted_volume = np.zeros(volume_shape, dtype=dtype)
+        for section_number in kept:
+            predicted_volume[:, :, section_number] = sections[section_number].image
+        gaps = predict_gaps_adaptive(
+            predicted_volume,
+            [(kept[i], kept[i + 1]) for i in range(len(kept) - 1)],
+            sections,
+            "sagittal",
+            interpolator_name,
+            interpolator_model,
+            max_gap=max_gap,
+            min_nmi=min_nmi,
+        )
+    else:
+        predicted_volume = predict_sections(
+            np.stack([sections[s].image for s in kept]),
+            kept,
+            volume_shape,
+            "sagittal",
+            interpolator_name,
+            interpolator_model,
+            reference_volume,
+            flow_cache,
+        )
+    return predicted_volume[:, :, :half], gaps
+
+
+def predict_gaps_adaptive(
+    volume,
+    gaps: list[tuple[int, int]],
+    sections,
+    axis: str,
+    interpolator_name: str,
+    interpolator_model,
+    max_gap: int = 1,
+    min_nmi: float = 0.9,
+) -> list[dict]:
+    """Predict some gaps in place, using the linear model where it suffices.
+
+    A gap is predicted with the linear model when it is small or when its
+    two known sections are similar, the linear blending being then almost
+    identical to the one of the deep model and far cheaper. Other gaps are
+    predicted with the given pair interpolation model.
+
+    Parameters
+    ----------
+    volume : np.ndarray
+        Volume whose sections along the section axis of the experiment are
+        numbered from 0, modified in place. Only the missing sections of
+        the gaps are written.
+    gaps
+        Gaps `(left, right)` to predict, as returned by `SectionStore.gaps`.
+    sections : SectionStore
+        Known (normalized) gene sections.
+    axis
+        Axis of the experiment, either "coronal" or "sagittal".
+    interpolator_name
+        Name of the pair interpolation model.
+    interpolator_model
+        Interpolator model, as returned by `load_interpolator_model`.
+    max_gap
+        Gaps with at most this number of missing sections are predicted
+        with the linear model.
+    min_nmi
+        Gaps whose known sections have a normalized mutual information
+        above this value are predicted with the linear model.
+
+    Returns
+    -------
+    gaps : list[dict]
+        Model, reason, NMI and duration of every gap, see `adaptive_report`.
+    """
+    import numpy as np
+    from metrics import image_nmi
+    from utils import SECTION_AXES
+
+    linear_model = get_interpolator_model("linear", None)
+    section_axis = SECTION_AXES[axis]
+    moved = np.moveaxis(volume, section_axis, 0)
+
+    records = []
+    for left, right in gaps:
+        n_missing = right - left - 1
+        nmi = image_nmi(
+            np.asarray(sections[left].image).mean(axis=-1),
+            np.asarray(sections[right].image).mean(axis=-1),
+        )
+        if n_missing <= max_gap:
+            name, model, reason = "linear", linear_model, "small gap"
+        elif nmi >= min_nmi:
+            name, model, reason = "linear", linear_model, "similar sections"
+        else:
+            name, model, reason = interpolator_name, interpolator_model, "default"
+
+        start = time.perf_counter()
+        gap_volume = predict_gap(sections, left, right, axis, name, model)
+        duration = time.perf_counter() - start
+        moved[left + 1 : right] = np.moveaxis(gap_volume, section_axis, 0)[1:-1]
+
+        records.append(
+            {
+                "left": left,
+                "right": right,
+                "n_missing": n_missing,
+                "nmi": nmi,
+                "interpolator_name": name,
+                "reason": reason,
+                "duration": duration,
+            }
+        )
+
+    return records
+
+
+def adaptive_report(
+    gaps: list[dict],
+    interpolator_name: str,
+    max_gap: int,
+    min_nmi: float,
+) -> dict:
+    """Summarize the gaps predicted by `predict_gaps_adaptive`.
+
+    Parameters
+    ----------
+    gaps
+        Gaps as returned by `predict_gaps_adaptive`.
+    interpolator_name
+        Name of the pair interpolation model.
+    max_gap
+        Gap size below which the linear model was used.
+    min_nmi
+        Normalized mutual information above which the linear model was used.
+
+    Returns
+    -------
+    report : dict
+        Model, reason, NMI and duration of every gap, and an estimate of the
+        time saved compared to using `interpolator_name` everywhere.
+    """
+    # The time saved is estimated from the time per missing section of the
+    # gaps predicted with the deep model
+    deep = [gap for gap in gaps if gap["interpolator_name"] != "linear"]
+    linear = [gap for gap in gaps if gap["interpolator_name"] == "linear"]
+    time_saved = None
+    if deep:
+        deep_rate = sum(gap["duration"] for gap in deep) / sum(
+            gap["n_missing"] for gap in deep
+        )
+        time_saved = sum(
+            deep_rate * gap["n_missing"] - gap["duration"] for gap in linear
+        )
+
+    return {
+        "interpolator_name": interpolator_name,
+        "max_gap": max_gap,
+        "min_nmi": min_nmi,
+        "n_linear_gaps": len(linear),
+        "n_deep_gaps": len(deep),
+        "estimated_time_saved": time_saved,
+        "gaps": gaps,
+    }
+
+
+def predict_adaptive(
+    sections,
+    axis: str,
+    interpolator_name: str,
+    interpolator_model,
+    max_gap: int = 1,
+    min_nmi: float = 0.9,
+):
+    """Predict a volume gap by gap, using the linear model where it suffices.
+
+    See `predict_gaps_adaptive` for the choice of the model of every gap.
+
+    Parameters
+    ----------
+    sections : SectionStore
+        Known (normalized) gene sections.
+    axis
+        Axis of the experiment, either "coronal" or "sagittal".
+    interpolator_name
+        Name of the pair interpolation model.
+    interpolator_model
+        Interpolator model, as returned by `load_interpolator_model`.
+    max_gap
+        Gaps with at most this number of missing sections are predicted
+        with the linear model.
+    min_nmi
+        Gaps whose known sections have a normalized mutual information
+        above this value are predicted with the linear model.
+
+    Returns
+    -------
+    predicted_volume : np.ndarray
+        Volume containing the known and the predicted sections.
+    report : dict
+        Model, reason, NMI and duration of every gap, see `adaptive_report`.
+    """
+    import numpy as np
+    from utils import SECTION_AXES
+
+    known = sections.sorted_section_numbers()
+    dtype = np.asarray(sections[known[0]].image).dtype
+    predicted_volume = np.zeros(VOLUME_SHAPE, dtype=dtype)
+    moved = np.moveaxis(predicted_volume, SECTION_AXES[axis], 0)
+    for section_number in known:
+        moved[section_number] = sections[section_number].image
+
+    gaps = predict_gaps_adaptive(
+        predicted_volume,
+        sections.gaps(),
+        sections,
+        axis,
+        interpolator_name,
+        interpolator_model,
+        max_gap=max_gap,
+        min_nmi=min_nmi,
+    )
+    report = adaptive_report(gaps, interpolator_name, max_gap, min_nmi)
+    return predicted_volume, report
+
+
+def write_volume(
+    path: Path | str,
+    volume,
+    saving_format: str,
+    factor: int = 1,
+    async_save: bool = False,
+    on_saved=None,
+) -> None:
+    """Save an interpolated volume, or one of its previews.
+
+    Parameters
+    ----------
+    path
+        Path of the output.
+    volume : np.ndarray
+        Volume to save.
+    saving_format
+        Either "npy" or "nrrd".
+    factor
+        Downsampling factor of the volume, which scales the voxel size
+        (`VOXEL_SIZE`) written in the NRRD header.
+    async_save
+        If True, the volume is saved in the background, see
+        `utils.save_volume_async`.
+    on_saved : Callable[[], None] | None
+        If specified, called once the volume is on disk, and only if it
+        could be saved.
+    """
+    import numpy as np
+    from utils import save_volume_async
+
+    if saving_format == "npy":
+        save_func = np.save
+    else:
+        import nrrd
+        from convert_npy_nrrd import make_header
+
+        header = make_header(volume, spacing=VOXEL_SIZE * factor)
+
+        def save_func(path, volume):
+            nrrd.write(str(path), volume, header=header)
+
+    if async_save:
+        save_volume_async(path, volume, save_func, on_saved)
+    else:
+        save_func(path, volume)
+        if on_saved is not None:
+            on_saved()
+
+
+def save_mirrored_sagittal(left_volume, output_path: str, saving_format: str) -> None:
+    """Save a sagittal volume made of a left hemisphere and its mirror.
+
+    For numpy files, the output is written through a memory map and the
+    mirrored hemisphere is a flipped view of the left one, so the entire
+    volume never needs to be held in memory.
+
+    Parameters
+    ----------
+    left_volume : np.ndarray
+        Left hemisphere of the volume.
+    output_path
+        Path of the output, without suffix.
+    saving_format
+        Either "npy" or "nrrd".
+    """
+    import numpy as np
+
+    half = left_volume.shape[2]
+    shape = left_volume.shape[:2] + (2 * half,) + left_volume.shape[3:]
+    if saving_format == "npy":
+        volume = np.lib.format.open_memmap(
+            output_path + ".npy", mode="w+", dtype=left_volume.dtype, shape=shape
+        )
+        volume[:, :, :half] = left_volume
+        volume[:, :, half:] = np.flip(left_volume, axis=2)
+        volume.flush()
+        del volume
+    else:
+        import nrrd
+        from convert_npy_nrrd import make_header
+
+        volume = np.concatenate([left_volume, np.flip(left_volume, axis=2)], axis=2)
+        header = make_header(volume, spacing=VOXEL_SIZE)
+        nrrd.write(output_path + ".nrrd", volume, header=header)
+
+
+def mirror_sagittal(volume, columns=None) -> None:
+    """Mirror the left half of a sagittal volume onto its right half in place.
+
+    Parameters
+    ----------
+    volume : np.ndarray
+        Volume of shape `(528, 320, 456, ...)` to mirror.
+    columns : Iterable[int] | None
+        If specified, only these sagittal sections (and their mirror) are
+        updated. Otherwise, the entire right half is overwritten.
+    """
+    import numpy as np
+
+    sagittal_shape = volume.shape[2]
+    if columns is None:
+        volume[:, :, (sagittal_shape // 2):] = np.flip(
+            volume[:, :, : (sagittal_shape // 2)], axis=2
+        )
+        return
+
+    for column in sorted(set(columns)):
+        mirror = sagittal_shape - 1 - column
+        if column < sagittal_shape // 2:
+            volume[:, :, mirror] = volume[:, :, column]
+        else:
+            volume[:, :, column] = volume[:, :, mirror]
+
+
+def hash_sections(sections) -> dict[str, str]:
+    """Compute a content hash of every known section.
+
+    Parameters
+    ----------
+    sections : SectionStore
+        Known gene sections.
+
+    Returns
+    -------
+    hashes : dict[str, str]
+        Mapping from section number (as string, to be JSON friendly)
+        to the SHA1 of the section image.
+    """
+    import hashlib
+
+    import numpy as np
+
+    return {
+        str(section_number): hashlib.sha1(
+            np.ascontiguousarray(section.image).tobytes()
+        ).hexdigest()
+        for section_number, section in sections.items()
+    }
+
+
+def find_affected_ranges(
+    previous_hashes: dict[str, str], sections
+) -> list[tuple[int, int]]:
+    """Find the ranges of sections affected by a change of known sections.
+
+    Parameters
+    ----------
+    previous_hashes
+        Section hashes of the previous run, as returned by `hash_sections`.
+    sections : SectionStore
+        Known gene sections of the current run.
+
+    Returns
+    -------
+    ranges : list[tuple[int, int]]
+        Sorted and disjoint ranges `(start, stop)`, both included, of
+        sections whose prediction might differ from the previous run.
+        Every range starts and ends either on a known section or on
+        a border of the known sections.
+    """
+    current_hashes = hash_sections(sections)
+    changed = {
+        int(section_number)
+        for section_number in set(previous_hashes) | set(current_hashes)
+        if previous_hashes.get(section_number) != current_hashes.get(section_number)
+    }
+
+    ranges = []
+    for section_number in sorted(changed):
+        previous_section, next_section = sections.neighbours(section_number)
+        start = section_number if previous_section is None else previous_section
+        stop = section_number if next_section is None else next_section
+        if ranges and start <= ranges[-1][1]:
+            ranges[-1] = (ranges[-1][0], max(stop, ranges[-1][1]))
+        else:
+            ranges.append((start, stop))
+
+    return ranges
+
+
+def patch_volume(
+    volume,
+    ranges: list[tuple[int, int]],
+    sections,
+    axis: str,
+    interpolator_name: str,
+    interpolator_model,
+    reference_volume=None,
+    flow_cache=None,
+    adaptive: bool = False,
+    max_gap: int = 1,
+    min_nmi: float = 0.9,
+) -> list[dict]:
+    """Re-predict the given ranges of an interpolated volume in place.
+
+    Parameters
+    ----------
+    volume : np.ndarray
+        Interpolated volume of a previous run, modified in place.
+    ranges
+        Ranges of sections to re-predict, as returned by
+        `find_affected_ranges`.
+    sections : SectionStore
+        Known (normalized) gene sections of the current run.
+    axis
+        Axis of the experiment, either "coronal" or "sagittal".
+    interpolator_name
+        Name of the interpolator model.
+    interpolator_model
+        Interpolator model, as returned by `load_interpolator_model`.
+    reference_volume : np.ndarray | None
+        Reference volume, only needed by the optical flow models.
+    flow_cache : flow_cache.FlowCache | None
+        If specified, the flows between reference sections are read from
+        this cache when possible, and saved to it otherwise.
+    adaptive
+        If True, the linear model is used for the gaps where it suffices,
+        see `predict_gaps_adaptive`.
+    max_gap
+        With `adaptive`, see `predict_gaps_adaptive`.
+    min_nmi
+        With `adaptive`, see `predict_gaps_adaptive`.
+
+    Returns
+    -------
+    gaps : list[dict]
+        With `adaptive`, the re-predicted gaps as returned by
+        `predict_gaps_adaptive`. Otherwise, an empty list.
+    """
+    import numpy as np
+    from utils import SECTION_AXES
+
+    section_axis = SECTION_AXES[axis]
+    moved = np.moveaxis(volume, section_axis, 0)
+    gaps = sections.gaps()
+    records = []
+
+    for start, stop in ranges:
+        logger.info(f"Re-predicting sections {start} to {stop}...")
+        moved[start : stop + 1] = 0
+        for section_number in sections.sorted_section_numbers():
+            if start <= section_number <= stop:
+                moved[section_number] = sections[section_number].image
+
+        range_gaps = [
+            (left, right) for left, right in gaps if start <= left and right <= stop
+        ]
+        if adaptive:
+            records += predict_gaps_adaptive(
+                volume,
+                range_gaps,
+                sections,
+                axis,
+                interpolator_name,
+                interpolator_model,
+                max_gap=max_gap,
+                min_nmi=min_nmi,
+            )
+            continue
+
+        for left, right in range_gaps:
+            gap_volume = predict_gap(
+                sections,
+                left,
+                right,
+                axis,
+                interpolator_name,
+                interpolator_model,
+                reference_volume,
+                flow_cache,
+            )
+            gap_volume = np.moveaxis(gap_volume, section_axis, 0)
+            moved[left + 1 : right] = gap_volume[1:-1]
+
+    if axis == "sagittal":
+        columns = [c for start, stop in ranges for c in range(start, stop + 1)]
+        mirror_sagittal(volume, columns)
+
+    return records
+
+
 def main(
     gene_path: Path | str,
     metadata_path: Path | str,
@@ -149,76 +974,219 @@ def main(
     saving_format: str,
     reference_path: str | Path,
     output_dir: Path | str | None = None,
+    incremental: bool = False,
+    half_brain: bool = False,
+    shared_memory: bool = False,
+    flow_cache_dir: Path | str | None = None,
+    adaptive: bool = False,
+    adaptive_max_gap: int = 1,
+    adaptive_min_nmi: float = 0.9,
+    async_save: bool = False,
+    preview_levels: list[int] | None = None,
 ) -> int:
     """Implement main function."""
     import nrrd
     import numpy as np
-    from atlinter.data import GeneDataset
-    from utils import check_and_load
+    from sections import SectionStore
+    from utils import check_and_load, compute_previews, preview_path, volume_stem
 
     logger.info("Loading Data...")
     section_images = check_and_load(gene_path, normalize=True)
     with open(metadata_path) as fh:
         metadata = json.load(fh)
 
-    section_numbers = [int(s) for s in metadata["section_numbers"]]
+    sections = SectionStore.from_arrays(section_images, metadata["section_numbers"])
     axis = metadata["axis"]
 
-    # Wrap the data into a GeneDataset class
-    gene_dataset = GeneDataset(
-        section_images,
-        section_numbers,
-        volume_shape=(528, 320, 456, 3),
-        axis=axis,
-    )
+    experiment_id = volume_stem(gene_path).split("-")[0]
+    image_type = volume_stem(gene_path).split("-")[-1]
+
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    output_path = str(output_dir / f"{experiment_id}-{interpolator_name}-interpolated-{image_type}")
+    run_metadata_path = Path(output_path + ".json")
+    volume_path = Path(f"{output_path}.{saving_format}")
+
+    ranges = None
+    if incremental:
+        if volume_path.exists() and run_metadata_path.exists():
+            with open(run_metadata_path) as fh:
+                previous_run = json.load(fh)
+            ranges = find_affected_ranges(previous_run["section_hashes"], sections)
+            known = sections.sorted_section_numbers()
+            if interpolator_name in {"maskflownet", "raftnet"} and any(
+                start < known[0] or stop > known[-1] for start, stop in ranges
+            ):
+                # Optical flow models also predict the sections outside the
+                # known ones, a change of border section affects all of them
+                logger.info("Border sections changed, the entire volume is predicted")
+                ranges = None
+        else:
+            logger.info(
+                f"No previous run found under {volume_path}, "
+                "the entire volume is predicted"
+            )
+
+    if adaptive and interpolator_name not in {"rife", "cain"}:
+        logger.warning(
+            f"The adaptive mode only applies to pair interpolation models, "
+            f"{interpolator_name} is used everywhere"
+        )
+        adaptive = False
 
     logger.info("Loading interpolator model...")
-    interpolator_model = load_interpolator_model(
+    if interpolator_checkpoint is not None:
+        interpolator_checkpoint = str(Path(interpolator_checkpoint).resolve())
+    interpolator_model = get_interpolator_model(
         interpolator_name, interpolator_checkpoint
     )
 
-    # Create a gene interpolator
-    logger.info("Start interpolating the entire volume...")
-    if interpolator_name in {"cain", "linear", "rife"}:
-        from atlinter.pair_interpolation import GeneInterpolate
+    reference_volume = None
+    flow_cache = None
+    if interpolator_name in {"maskflownet", "raftnet"}:
+        reference_volume = check_and_load(reference_path, shared=shared_memory)
+        if flow_cache_dir is not None:
+            from flow_cache import FlowCache
 
-        gene_interpolate = GeneInterpolate(
-            gene_dataset, interpolator_model, border_predictions=False
+            flow_cache = FlowCache.open(
+                flow_cache_dir,
+                reference_volume,
+                interpolator_name,
+                interpolator_checkpoint,
+            )
+            logger.info(f"Using the reference flows of {flow_cache.directory}")
+
+    gaps = []
+    report = None
+    if ranges is not None:
+        logger.info(f"Start re-interpolating {len(ranges)} ranges of sections...")
+        if saving_format == "npy":
+            predicted_volume = np.load(volume_path, mmap_mode="r+")
+        else:
+            predicted_volume, header = nrrd.read(str(volume_path))
+
+        gaps = patch_volume(
+            predicted_volume,
+            ranges,
+            sections,
+            axis,
+            interpolator_name,
+            interpolator_model,
+            reference_volume,
+            flow_cache,
+            adaptive=adaptive,
+            max_gap=adaptive_max_gap,
+            min_nmi=adaptive_min_nmi,
         )
-        predicted_volume = gene_interpolate.predict_volume()
-    else:
-        from atlinter.optical_flow import GeneOpticalFlow
 
-        reference_volume = check_and_load(reference_path)
-        gene_optical_flow = GeneOpticalFlow(
-            gene_dataset, reference_volume, interpolator_model
+        if saving_format == "npy":
+            predicted_volume.flush()
+        else:
+            nrrd.write(str(volume_path), predicted_volume, header=header)
+
+    elif half_brain and axis == "sagittal":
+        logger.info("Start interpolating the left hemisphere...")
+        left_volume, gaps = predict_half_sagittal(
+            sections,
+            interpolator_name,
+            interpolator_model,
+            reference_volume,
+            flow_cache,
+            adaptive=adaptive,
+            max_gap=adaptive_max_gap,
+            min_nmi=adaptive_min_nmi,
         )
-        predicted_volume = gene_optical_flow.predict_volume()
+        save_mirrored_sagittal(left_volume, output_path, saving_format)
 
-    # Mirror the volume if the dataset is sagittal
-    if axis == "sagittal":
-        sagittal_shape = predicted_volume.shape[2]
-        predicted_volume[:, :, (sagittal_shape // 2):] = np.flip(
-            predicted_volume[:, :, : (sagittal_shape // 2)], axis=2
+    elif adaptive:
+        logger.info("Start interpolating the entire volume gap by gap...")
+        predicted_volume, report = predict_adaptive(
+            sections,
+            axis,
+            interpolator_name,
+            interpolator_model,
+            max_gap=adaptive_max_gap,
+            min_nmi=adaptive_min_nmi,
         )
 
-    experiment_id = Path(gene_path).stem.split("-")[0]
-    image_type = Path(gene_path).stem.split("-")[-1]
+    else:
+        logger.info("Start interpolating the entire volume...")
+        # The loaded images are given as they are, without another copy
+        predicted_volume = predict_sections(
+            section_images,
+            metadata["section_numbers"],
+            VOLUME_SHAPE,
+            axis,
+            interpolator_name,
+            interpolator_model,
+            reference_volume,
+            flow_cache,
+        )
 
-    output_dir = Path(output_dir)
-    output_dir.mkdir(parents=True, exist_ok=True)
-    output_path = str(output_dir / f"{experiment_id}-{interpolator_name}-interpolated-{image_type}")
+    if adaptive:
+        if report is None:
+            report = adaptive_report(
+                gaps, interpolator_name, adaptive_max_gap, adaptive_min_nmi
+            )
+        time_saved = report["estimated_time_saved"]
+        logger.info(
+            f"{report['n_linear_gaps']} gaps predicted with the linear "
+            f"model, {report['n_deep_gaps']} with {interpolator_name}"
+            + ("" if time_saved is None else f", about {time_saved:.1f}s saved")
+        )
 
-    if saving_format == "npy":
-        np.save(
-            output_path + ".npy",
+    # Keep track of the known sections for later incremental runs
+    run_metadata = {
+        "interpolator_name": interpolator_name,
+        "section_numbers": sections.sorted_section_numbers(),
+        "section_hashes": hash_sections(sections),
+    }
+    if report is not None:
+        run_metadata["adaptive"] = report
+
+    def write_run_metadata():
+        with open(run_metadata_path, "w") as fh:
+            json.dump(
+                run_metadata,
+                fh,
+                indent=True,
+                sort_keys=True,
+            )
+
+    if ranges is None and not (half_brain and axis == "sagittal"):
+
+        # Mirror the volume if the dataset is sagittal
+        if axis == "sagittal":
+            mirror_sagittal(predicted_volume)
+
+        # The hashes are only written once the volume they describe is on
+        # disk, a crash in between must not leave those of the previous run
+        run_metadata_path.unlink(missing_ok=True)
+        write_volume(
+            volume_path,
             predicted_volume,
+            saving_format,
+            async_save=async_save,
+            on_saved=write_run_metadata,
         )
-    else:
-        from convert_npy_nrrd import HEADER
-        HEADER["dimension"] = len(predicted_volume.shape)
-        HEADER["sizes"] = np.array(predicted_volume.shape)
-        nrrd.write(output_path + ".nrrd", predicted_volume, header=HEADER)
+
+    if preview_levels:
+        logger.info(f"Saving the previews downsampled by {preview_levels}...")
+        if ranges is None and half_brain and axis == "sagittal":
+            # The mirrored volume was written straight to disk
+            predicted_volume = check_and_load(volume_path, mmap=True)
+        previews = compute_previews(predicted_volume, preview_levels)
+        for factor, preview in previews.items():
+            write_volume(
+                preview_path(volume_path, factor),
+                preview,
+                saving_format,
+                factor=factor,
+                async_save=async_save,
+            )
+
+    if ranges is not None or (half_brain and axis == "sagittal"):
+        write_run_metadata()
 
     return 0
 
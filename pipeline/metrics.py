@@ -0,0 +1,233 @@
+# Copyright 2021, Blue Brain Project, EPFL
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Information theoretic metrics computed from joint histograms.
+
+All the metrics work on integer histograms and support leading batch
+dimensions, so that the metrics of many slices are computed at once.
+Entropies are expressed in nats, as in `sklearn.metrics`.
+"""
+from __future__ import annotations
+
+import numpy as np
+
+
+def quantize(
+    volume: np.ndarray, n_bins: int, value_range: tuple[float, float]
+) -> np.ndarray:
+    """Map intensities to integer bins.
+
+    Parameters
+    ----------
+    volume
+        Intensity array.
+    n_bins
+        Number of bins.
+    value_range
+        Minimum and maximum intensities, mapped to the first and last bin.
+        Values out of the range are clipped.
+
+    Returns
+    -------
+    codes : np.ndarray
+        Array of the same shape as `volume` containing bin indices
+        between 0 and `n_bins - 1`.
+    """
+    v_min, v_max = value_range
+    scale = n_bins / (v_max - v_min) if v_max > v_min else 0.0
+    codes = ((volume.astype(np.float64) - v_min) * scale).astype(np.int64)
+    return np.clip(codes, 0, n_bins - 1)
+
+
+def encode_labels(labels: np.ndarray, label_values: np.ndarray) -> np.ndarray:
+    """Map label values to consecutive integer codes.
+
+    Parameters
+    ----------
+    labels
+        Label array.
+    label_values
+        Sorted array of all the possible label values, e.g. `np.unique`
+        of the entire annotation volume.
+
+    Returns
+    -------
+    codes : np.ndarray
+        Array of the same shape as `labels` containing the index of every
+        label in `label_values`.
+    """
+    return np.searchsorted(label_values, labels)
+
+
+def joint_histogram(
+    codes_a: np.ndarray,
+    codes_b: np.ndarray,
+    n_a: int,
+    n_b: int,
+    batched: bool = False,
+) -> np.ndarray:
+    """Count the co-occurrences of two integer code arrays in one pass.
+
+    Parameters
+    ----------
+    codes_a
+        Integer codes between 0 and `n_a - 1`.
+    codes_b
+        Integer codes between 0 and `n_b - 1`, same shape as `codes_a`.
+    n_a
+        Number of possible codes in `codes_a`.
+    n_b
+        Number of possible codes in `codes_b`.
+    batched
+        If True, the first axis is a batch axis (e.g. slices) and one
+        histogram is computed for every element of the batch.
+
+    Returns
+    -------
+    counts : np.ndarray
+        Joint histogram of shape `(n_a, n_b)`, or `(batch, n_a, n_b)`
+        if `batched`.
+    """
+    if codes_a.shape != codes_b.shape:
+        raise ValueError(
+            f"The codes have different shapes ({codes_a.shape} and {codes_b.shape})"
+        )
+
+    index = codes_a.astype(np.int64) * n_b + codes_b
+    n_batch = 1
+    if batched:
+        n_batch = codes_a.shape[0]
+        batch = np.arange(n_batch, dtype=np.int64).reshape(
+            (-1,) + (1,) * (codes_a.ndim - 1)
+        )
+        index = index + batch * (n_a * n_b)
+
+    counts = np.bincount(index.ravel(), minlength=n_batch * n_a * n_b)
+    if batched:
+        return counts.reshape(n_batch, n_a, n_b)
+    return counts.reshape(n_a, n_b)
+
+
+def entropy(counts: np.ndarray) -> np.ndarray:
+    """Compute the entropy of histograms along their last axis.
+
+    Parameters
+    ----------
+    counts
+        Histograms of shape `(..., n)`.
+
+    Returns
+    -------
+    entropy : np.ndarray
+        Entropies of shape `(...)`. Empty histograms have zero entropy.
+    """
+    counts = np.asarray(counts, dtype=np.float64)
+    totals = counts.sum(axis=-1, keepdims=True)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        p = counts / totals
+        terms = np.where(counts > 0, p * np.log(p), 0.0)
+    return -terms.sum(axis=-1)
+
+
+def mutual_information(joint: np.ndarray) -> np.ndarray:
+    """Compute the mutual information from joint histograms.
+
+    Parameters
+    ----------
+    joint
+        Joint histograms of shape `(..., n_a, n_b)`.
+
+    Returns
+    -------
+    mutual_information : np.ndarray
+        Mutual information of shape `(...)`.
+    """
+    h_a = entropy(joint.sum(axis=-1))
+    h_b = entropy(joint.sum(axis=-2))
+    h_ab = entropy(joint.reshape(joint.shape[:-2] + (-1,)))
+    return np.maximum(h_a + h_b - h_ab, 0.0)
+
+
+def normalized_mutual_information(joint: np.ndarray) -> np.ndarray:
+    """Compute the normalized mutual information from joint histograms.
+
+    The normalization is the arithmetic mean of the marginal entropies,
+    which is the default of `sklearn.metrics.normalized_mutual_info_score`.
+
+    Parameters
+    ----------
+    joint
+        Joint histograms of shape `(..., n_a, n_b)`.
+
+    Returns
+    -------
+    nmi : np.ndarray
+        Normalized mutual information of shape `(...)`, between 0 and 1.
+        When both marginals have zero entropy, the NMI is 1.
+    """
+    h_a = entropy(joint.sum(axis=-1))
+    h_b = entropy(joint.sum(axis=-2))
+    normalizer = (h_a + h_b) / 2
+    mi = mutual_information(joint)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        nmi = np.where(normalizer > 0, mi / normalizer, 1.0)
+    return np.clip(nmi, 0.0, 1.0)
+
+
+def conditional_entropy(joint: np.ndarray) -> np.ndarray:
+    """Compute the entropy of the second variable knowing the first one.
+
+    This is the average entropy of the histogram of every row (e.g. of the
+    intensities inside every region), weighted by the number of elements
+    in the row.
+
+    Parameters
+    ----------
+    joint
+        Joint histograms of shape `(..., n_a, n_b)`, the first variable
+        being along the axis `-2`.
+
+    Returns
+    -------
+    conditional_entropy : np.ndarray
+        Conditional entropies of shape `(...)`. Empty histograms have zero
+        conditional entropy.
+    """
+    row_counts = joint.sum(axis=-1)
+    totals = row_counts.sum(axis=-1)
+    weighted = (entropy(joint) * row_counts).sum(axis=-1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(totals > 0, weighted / totals, 0.0)
+
+
+def image_nmi(image_a: np.ndarray, image_b: np.ndarray, n_bins: int = 64) -> float:
+    """Compute the normalized mutual information between two images.
+
+    Parameters
+    ----------
+    image_a
+        First intensity image.
+    image_b
+        Second intensity image, same shape as `image_a`.
+    n_bins
+        Number of bins used to quantize the intensities of every image.
+
+    Returns
+    -------
+    nmi : float
+        Normalized mutual information between the quantized images.
+    """
+    codes_a = quantize(image_a, n_bins, (image_a.min(), image_a.max()))
+    codes_b = quantize(image_b, n_bins, (image_b.min(), image_b.max()))
+    joint = joint_histogram(codes_a, codes_b, n_bins, n_bins)
+    return float(normalized_mutual_information(joint))
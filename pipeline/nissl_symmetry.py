@@ -0,0 +1,311 @@
+# Copyright 2021, Blue Brain Project, EPFL
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Script that compares the left and right hemispheres of a Nissl volume."""
+from __future__ import annotations
+
+import argparse
+import csv
+import logging
+import sys
+from pathlib import Path
+
+import numpy as np
+
+logger = logging.getLogger("nissl-symmetry")
+
+REPORT_COLUMNS = (
+    "slice",
+    "identical",
+    "max_abs_diff",
+    "nmi_left",
+    "nmi_right",
+    "conditional_entropy_left",
+    "conditional_entropy_right",
+    "better_nmi",
+    "better_entropy",
+)
+
+
+def parse_args():
+    """Parse arguments."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "nissl_path",
+        type=Path,
+        help="""\
+        Path to Nissl Volume.
+        """,
+    )
+    parser.add_argument(
+        "annotation_path",
+        type=Path,
+        help="""\
+        Path to the annotation volume in the same coordinate system as the
+        Nissl volume (e.g. CCFv2).
+        """,
+    )
+    parser.add_argument(
+        "report_path",
+        type=Path,
+        help="""\
+        Path to the CSV file where to save the per-slice report.
+        """,
+    )
+    parser.add_argument(
+        "--n-bins",
+        type=int,
+        default=256,
+        help="""\
+        Number of bins used to quantize the Nissl intensities.
+        """,
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=16,
+        help="""\
+        Number of coronal slices processed at once.
+        """,
+    )
+    parser.add_argument(
+        "--symmetric-path",
+        type=Path,
+        help="""\
+        If specified, a symmetric Nissl volume is saved there, made of the
+        hemisphere chosen by --side for every slice.
+        """,
+    )
+    parser.add_argument(
+        "--side",
+        type=str,
+        choices=("left", "right", "best-entropy", "best-nmi"),
+        default="right",
+        help="""\
+        Hemisphere kept in the symmetric Nissl volume. With "best-entropy"
+        and "best-nmi", the best hemisphere is chosen slice by slice.
+        """,
+    )
+    return parser.parse_args()
+
+
+def hemisphere_metrics(
+    nissl: np.ndarray,
+    annotation: np.ndarray,
+    n_bins: int = 256,
+    chunk_size: int = 16,
+) -> dict[str, np.ndarray]:
+    """Compare the two hemispheres of every coronal slice.
+
+    The right hemisphere is flipped onto the left one. For every slice and
+    every hemisphere, one joint histogram of annotation labels and quantized
+    Nissl intensities is computed, all the slices of a chunk at once with a
+    single `np.bincount`. The metrics are then derived from the histograms.
+
+    Parameters
+    ----------
+    nissl
+        Nissl volume of shape `(n_slices, height, width)`.
+    annotation
+        Annotation volume of the same shape as `nissl`.
+    n_bins
+        Number of bins used to quantize the Nissl intensities.
+    chunk_size
+        Number of slices processed at once.
+
+    Returns
+    -------
+    metrics : dict[str, np.ndarray]
+        Per-slice arrays for every column of `REPORT_COLUMNS`.
+        "better_nmi" and "better_entropy" are either "left" or "right".
+    """
+    from metrics import (
+        conditional_entropy,
+        encode_labels,
+        joint_histogram,
+        normalized_mutual_information,
+        quantize,
+    )
+
+    if nissl.shape != annotation.shape:
+        raise ValueError(
+            f"The nissl ({nissl.shape}) and annotation ({annotation.shape}) "
+            "volumes do not have the same shape !"
+        )
+
+    n_slices, _, width = nissl.shape
+    half = width // 2
+    value_range = (nissl.min(), nissl.max())
+    label_values = np.unique(annotation)
+    n_labels = len(label_values)
+    # The background is not taken into account in the conditional entropy
+    foreground = label_values != 0
+
+    results = {
+        name: np.zeros(n_slices)
+        for name in (
+            "max_abs_diff",
+            "nmi_left",
+            "nmi_right",
+            "conditional_entropy_left",
+            "conditional_entropy_right",
+        )
+    }
+    results["slice"] = np.arange(n_slices)
+
+    for start in range(0, n_slices, chunk_size):
+        stop = min(start + chunk_size, n_slices)
+        nissl_chunk = nissl[start:stop]
+        annotation_chunk = annotation[start:stop]
+
+        left = nissl_chunk[:, :, :half]
+        right_flip = np.flip(nissl_chunk[:, :, width - half :], axis=2)
+        diff = np.abs(left.astype(np.float64) - right_flip)
+        results["max_abs_diff"][start:stop] = diff.max(axis=(1, 2))
+
+        annotation_left = annotation_chunk[:, :, :half]
+        annotation_right_flip = np.flip(annotation_chunk[:, :, width - half :], axis=2)
+        for side, nissl_half, annotation_half in (
+            ("left", left, annotation_left),
+            ("right", right_flip, annotation_right_flip),
+        ):
+            joint = joint_histogram(
+                encode_labels(annotation_half, label_values),
+                quantize(nissl_half, n_bins, value_range),
+                n_labels,
+                n_bins,
+                batched=True,
+            )
+            results[f"nmi_{side}"][start:stop] = normalized_mutual_information(joint)
+            results[f"conditional_entropy_{side}"][start:stop] = conditional_entropy(
+                joint[:, foreground]
+            )
+
+    # Same tolerance as `np.allclose(left, right_flip, rtol=0)`
+    results["identical"] = results["max_abs_diff"] <= 1e-8
+    results["better_nmi"] = np.where(
+        results["nmi_left"] > results["nmi_right"], "left", "right"
+    )
+    results["better_entropy"] = np.where(
+        results["conditional_entropy_left"] < results["conditional_entropy_right"],
+        "left",
+        "right",
+    )
+
+    return results
+
+
+def make_symmetric(nissl: np.ndarray, sides: np.ndarray) -> np.ndarray:
+    """Build a symmetric volume from one hemisphere of every slice.
+
+    Parameters
+    ----------
+    nissl
+        Nissl volume of shape `(n_slices, height, width)`.
+    sides
+        Array of length `n_slices` containing "left" or "right", the
+        hemisphere to keep for every slice.
+
+    Returns
+    -------
+    symmetric_nissl : np.ndarray
+        Volume whose slices are made of the chosen hemisphere and its mirror.
+    """
+    width = nissl.shape[2]
+    half = width // 2
+    keep_left = (np.asarray(sides) == "left")[:, None, None]
+
+    left = nissl[:, :, :half]
+    right_flip = np.flip(nissl[:, :, width - half :], axis=2)
+    kept = np.where(keep_left, left, right_flip)
+
+    symmetric_nissl = nissl.copy()
+    symmetric_nissl[:, :, :half] = kept
+    symmetric_nissl[:, :, width - half :] = np.flip(kept, axis=2)
+    return symmetric_nissl
+
+
+def write_report(report_path: Path | str, results: dict[str, np.ndarray]) -> None:
+    """Write the per-slice metrics as a CSV file."""
+    with open(report_path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(REPORT_COLUMNS)
+        for row in zip(*(results[name] for name in REPORT_COLUMNS)):
+            writer.writerow(
+                [
+                    f"{value:.6g}" if isinstance(value, np.floating) else value
+                    for value in row
+                ]
+            )
+
+
+def main(
+    nissl_path: Path | str,
+    annotation_path: Path | str,
+    report_path: Path | str,
+    n_bins: int = 256,
+    chunk_size: int = 16,
+    symmetric_path: Path | str | None = None,
+    side: str = "right",
+) -> int:
+    """Implement main function."""
+    from utils import check_and_load
+
+    logger.info("Loading volumes")
+    nissl = check_and_load(nissl_path)
+    annotation = check_and_load(annotation_path)
+
+    logger.info("Computing the metrics of both hemispheres...")
+    results = hemisphere_metrics(nissl, annotation, n_bins, chunk_size)
+
+    logger.info(
+        f"{int(results['identical'].sum())} / {len(nissl)} slices are symmetric, "
+        f"the left hemisphere has a better NMI for "
+        f"{int((results['better_nmi'] == 'left').sum())} slices and a better "
+        f"conditional entropy for "
+        f"{int((results['better_entropy'] == 'left').sum())} slices"
+    )
+
+    report_path = Path(report_path)
+    report_path.parent.mkdir(parents=True, exist_ok=True)
+    write_report(report_path, results)
+
+    if symmetric_path is not None:
+        import nrrd
+
+        if side in {"left", "right"}:
+            sides = np.full(len(nissl), side)
+        elif side == "best-entropy":
+            sides = results["better_entropy"]
+        else:
+            sides = results["better_nmi"]
+
+        logger.info(f"Saving the symmetric Nissl volume ({side})...")
+        symmetric_nissl = make_symmetric(nissl, sides)
+        symmetric_path = Path(symmetric_path)
+        if symmetric_path.suffix == ".nrrd":
+            nrrd.write(str(symmetric_path), symmetric_nissl)
+        else:
+            np.save(symmetric_path, symmetric_nissl)
+
+    return 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
+    )
+    args = parse_args()
+    kwargs = vars(args)
+    sys.exit(main(**kwargs))
@@ -21,7 +21,6 @@ import sys
 from pathlib import Path
 
 import numpy as np
-from atlannot.ants import register, transform
 
 logger = logging.getLogger("nissl-to-ccfv3")
 
@@ -57,6 +56,15 @@ def parse_args():
         Path to output directory to save results.
         """,
     )
+    parser.add_argument(
+        "--shared-memory",
+        action="store_true",
+        help="""\
+        If True, the reference volumes are loaded once into shared memory
+        (/dev/shm) and every process running the pipeline attaches to the
+        same copy.
+        """,
+    )
     return parser.parse_args()
 
 
@@ -83,6 +91,8 @@ def registration(
     nissl_warped : np.ndarray
         Nissl volume once the registration transformation are applied.
     """
+    from atlannot.ants import register, transform
+
     logger.info("Compute the registration...")
     nii_data = register(reference_volume, moving_volume)
     logger.info(f"Max displacements: {np.abs(nii_data).max(axis=(0, 1, 2, 3))}")
@@ -101,15 +111,17 @@ def main(
     ccfv2_path: Path | str,
     ccfv3_path: Path | str,
     output_dir: Path | str,
+    shared_memory: bool = False,
+    async_save: bool = False,
 ) -> int:
     """Implement main function."""
     from atlannot.utils import Remapper
-    from utils import check_and_load
+    from utils import check_and_load, save_volume, save_volume_async
 
     logger.info("Loading volumes")
-    nissl = check_and_load(nissl_path)
-    ccfv2 = check_and_load(ccfv2_path)
-    ccfv3 = check_and_load(ccfv3_path)
+    nissl = check_and_load(nissl_path, shared=shared_memory)
+    ccfv2 = check_and_load(ccfv2_path, shared=shared_memory)
+    ccfv3 = check_and_load(ccfv3_path, shared=shared_memory)
 
     logger.info("Remapping CCFv2 and CCFv3 volumes to consecutive labels")
     remapper = Remapper(ccfv2, ccfv3)
@@ -125,8 +137,9 @@ def main(
     logger.info("Saving results...")
     output_dir = Path(output_dir)
     output_dir.mkdir(parents=True, exist_ok=True)
-    np.save(output_dir / "warped-ccfv2", warped_atlas)
-    np.save(output_dir / "warped-nissl", warped_nissl)
+    save = save_volume_async if async_save else save_volume
+    save(output_dir / "warped-ccfv2.npy", warped_atlas)
+    save(output_dir / "warped-nissl.npy", warped_nissl)
 
     return 0
 
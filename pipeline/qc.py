@@ -0,0 +1,345 @@
+# Copyright 2021, Blue Brain Project, EPFL
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Script that computes quality control scores between two volumes."""
+from __future__ import annotations
+
+import argparse
+import json
+import logging
+import sys
+from pathlib import Path
+from typing import Any, Iterator
+
+import numpy as np
+
+logger = logging.getLogger("qc")
+
+
+def parse_args():
+    """Parse arguments."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "volume_path",
+        type=Path,
+        help="""\
+        Path to the volume to evaluate (e.g. a registered volume).
+        """,
+    )
+    parser.add_argument(
+        "reference_path",
+        type=Path,
+        help="""\
+        Path to the reference volume (e.g. the fixed volume of the
+        registration).
+        """,
+    )
+    parser.add_argument(
+        "output_path",
+        type=Path,
+        help="""\
+        Path to the JSON file where to save the scores.
+        """,
+    )
+    parser.add_argument(
+        "--volume-is-annotation",
+        action="store_true",
+        help="""\
+        If True, the volume contains labels instead of intensities.
+        """,
+    )
+    parser.add_argument(
+        "--reference-is-annotation",
+        action="store_true",
+        help="""\
+        If True, the reference contains labels instead of intensities.
+        Statistics of the volume in every region are then computed too.
+        """,
+    )
+    parser.add_argument(
+        "--metadata-path",
+        type=Path,
+        help="""\
+        If specified, the volume is a stack of gene sections described by
+        this metadata (as saved by gene_to_nissl) and it is compared to the
+        corresponding sections of the reference.
+        """,
+    )
+    parser.add_argument(
+        "--n-bins",
+        type=int,
+        default=256,
+        help="""\
+        Number of bins used to quantize the intensities.
+        """,
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=32,
+        help="""\
+        Number of slices processed at once.
+        """,
+    )
+    return parser.parse_args()
+
+
+def iter_chunks(volume: np.ndarray, chunk_size: int) -> Iterator[np.ndarray]:
+    """Iterate over chunks of consecutive slices along the first axis."""
+    for start in range(0, len(volume), chunk_size):
+        yield np.asarray(volume[start : start + chunk_size])
+
+
+def to_intensity(chunk: np.ndarray, ndim: int) -> np.ndarray:
+    """Convert RGB chunks to grayscale by averaging the channels."""
+    if chunk.ndim == ndim + 1:
+        return chunk.mean(axis=-1)
+    return chunk
+
+
+class Encoder:
+    """Map the values of a volume to integer codes for joint histograms.
+
+    Parameters
+    ----------
+    is_annotation
+        If True, every label value gets its own code. Otherwise, the
+        intensities are quantized into `n_bins` bins.
+    n_bins
+        Number of bins of the intensities.
+    """
+
+    def __init__(self, is_annotation: bool, n_bins: int = 256) -> None:
+        self.is_annotation = is_annotation
+        self.n_bins = n_bins
+        self.label_values = None
+        self.value_range = None
+
+    def fit_chunk(self, chunk: np.ndarray) -> None:
+        """Update the labels or the range of intensities with a chunk."""
+        if self.is_annotation:
+            labels = np.unique(chunk)
+            if self.label_values is not None:
+                labels = np.union1d(self.label_values, labels)
+            self.label_values = labels
+        else:
+            v_min, v_max = float(chunk.min()), float(chunk.max())
+            if self.value_range is not None:
+                v_min = min(v_min, self.value_range[0])
+                v_max = max(v_max, self.value_range[1])
+            self.value_range = (v_min, v_max)
+
+    @property
+    def n_codes(self) -> int:
+        """Number of different codes."""
+        if self.is_annotation:
+            return len(self.label_values)
+        return self.n_bins
+
+    def encode(self, chunk: np.ndarray) -> np.ndarray:
+        """Map a chunk to integer codes."""
+        from metrics import encode_labels, quantize
+
+        if self.is_annotation:
+            return encode_labels(chunk, self.label_values)
+        return quantize(chunk, self.n_bins, self.value_range)
+
+
+def compute_qc(
+    volume: np.ndarray,
+    reference: np.ndarray,
+    volume_is_annotation: bool = False,
+    reference_is_annotation: bool = False,
+    n_bins: int = 256,
+    chunk_size: int = 32,
+) -> dict[str, Any]:
+    """Compute quality control scores between two volumes.
+
+    The volumes are read chunk by chunk along their first axis, so they
+    can be memory-mapped. A first cheap pass finds the range of intensities
+    (or the labels), then a single pass accumulates the integer joint
+    histogram and the per-region sums.
+
+    Parameters
+    ----------
+    volume
+        Volume to evaluate. RGB volumes are converted to grayscale.
+    reference
+        Reference volume, with the same shape as `volume` (without
+        the channels).
+    volume_is_annotation
+        If True, `volume` contains labels instead of intensities.
+    reference_is_annotation
+        If True, `reference` contains labels instead of intensities.
+    n_bins
+        Number of bins used to quantize the intensities.
+    chunk_size
+        Number of slices processed at once.
+
+    Returns
+    -------
+    scores : dict
+        Normalized mutual information, mutual information and entropy
+        of the volume given the reference (background label excluded if
+        the reference is an annotation). If the reference is an annotation
+        and the volume is not, "regions" contains the voxel count, mean
+        and standard deviation of the volume in every region.
+    """
+    from metrics import (
+        conditional_entropy,
+        joint_histogram,
+        mutual_information,
+        normalized_mutual_information,
+    )
+
+    ndim = reference.ndim
+    if volume.shape[:ndim] != reference.shape:
+        raise ValueError(
+            f"The volume ({volume.shape}) and the reference ({reference.shape}) "
+            "do not have the same shape !"
+        )
+
+    volume_encoder = Encoder(volume_is_annotation, n_bins)
+    reference_encoder = Encoder(reference_is_annotation, n_bins)
+    for volume_chunk, reference_chunk in zip(
+        iter_chunks(volume, chunk_size), iter_chunks(reference, chunk_size)
+    ):
+        volume_encoder.fit_chunk(to_intensity(volume_chunk, ndim))
+        reference_encoder.fit_chunk(reference_chunk)
+
+    region_stats = reference_is_annotation and not volume_is_annotation
+    n_regions = reference_encoder.n_codes
+    joint = np.zeros((n_regions, volume_encoder.n_codes), dtype=np.int64)
+    sums = np.zeros(n_regions)
+    squared_sums = np.zeros(n_regions)
+
+    for volume_chunk, reference_chunk in zip(
+        iter_chunks(volume, chunk_size), iter_chunks(reference, chunk_size)
+    ):
+        volume_chunk = to_intensity(volume_chunk, ndim)
+        reference_codes = reference_encoder.encode(reference_chunk)
+        joint += joint_histogram(
+            reference_codes,
+            volume_encoder.encode(volume_chunk),
+            reference_encoder.n_codes,
+            volume_encoder.n_codes,
+        )
+        if region_stats:
+            values = volume_chunk.ravel().astype(np.float64)
+            codes = reference_codes.ravel()
+            sums += np.bincount(codes, weights=values, minlength=n_regions)
+            squared_sums += np.bincount(codes, weights=values**2, minlength=n_regions)
+
+    if reference_is_annotation:
+        foreground = joint[reference_encoder.label_values != 0]
+    else:
+        foreground = joint
+
+    scores = {
+        "nmi": float(normalized_mutual_information(joint)),
+        "mutual_information": float(mutual_information(joint)),
+        "conditional_entropy": float(conditional_entropy(foreground)),
+    }
+
+    if region_stats:
+        counts = joint.sum(axis=1)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            means = sums / counts
+            stds = np.sqrt(np.maximum(squared_sums / counts - means**2, 0))
+        scores["regions"] = {
+            str(label): {"count": int(count), "mean": float(mean), "std": float(std)}
+            for label, count, mean, std in zip(
+                reference_encoder.label_values, counts, means, stds
+            )
+            if count > 0
+        }
+
+    return scores
+
+
+def sections_reference(reference: np.ndarray, metadata: dict[str, Any]) -> np.ndarray:
+    """Extract the reference sections matching a stack of gene sections.
+
+    Parameters
+    ----------
+    reference
+        Reference volume, e.g. the Nissl volume.
+    metadata
+        Metadata of the gene sections, as saved by `gene_to_nissl`.
+
+    Returns
+    -------
+    reference_sections : np.ndarray
+        Array of shape `(n_sections, ...)` containing the reference
+        section of every gene section.
+    """
+    from utils import extract_sections
+
+    planes = extract_sections(reference, metadata["section_numbers"], metadata["axis"])
+    return np.stack([planes[int(s)] for s in metadata["section_numbers"]])
+
+
+def main(
+    volume_path: Path | str,
+    reference_path: Path | str,
+    output_path: Path | str,
+    volume_is_annotation: bool = False,
+    reference_is_annotation: bool = False,
+    metadata_path: Path | str | None = None,
+    n_bins: int = 256,
+    chunk_size: int = 32,
+) -> int:
+    """Implement main function."""
+    from utils import check_and_load
+
+    logger.info("Loading volumes")
+    volume = check_and_load(volume_path, mmap=True)
+    reference = check_and_load(reference_path, mmap=True)
+
+    if metadata_path is not None:
+        with open(metadata_path) as f:
+            metadata = json.load(f)
+        reference = sections_reference(reference, metadata)
+
+    logger.info("Computing the quality control scores...")
+    scores = compute_qc(
+        volume,
+        reference,
+        volume_is_annotation=volume_is_annotation,
+        reference_is_annotation=reference_is_annotation,
+        n_bins=n_bins,
+        chunk_size=chunk_size,
+    )
+    logger.info(
+        f"NMI: {scores['nmi']:.4f}, "
+        f"conditional entropy: {scores['conditional_entropy']:.4f}"
+    )
+
+    output_path = Path(output_path)
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    scores["volume_path"] = str(volume_path)
+    scores["reference_path"] = str(reference_path)
+    with open(output_path, "w") as f:
+        json.dump(scores, f, indent=True, sort_keys=True)
+
+    return 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
+    )
+    args = parse_args()
+    kwargs = vars(args)
+    sys.exit(main(**kwargs))
@@ -0,0 +1,236 @@
+# Copyright 2021, Blue Brain Project, EPFL
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Script that computes the expression of interpolated genes in every region."""
+from __future__ import annotations
+
+import argparse
+import csv
+import logging
+import sys
+from pathlib import Path
+
+import numpy as np
+
+logger = logging.getLogger("region-expression")
+
+STATISTICS = ("voxel_count", "sum", "mean", "expressing_fraction")
+
+
+def parse_args():
+    """Parse arguments."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "annotation_path",
+        type=Path,
+        help="""\
+        Path to the annotation volume in the same coordinate system as the
+        interpolated volumes (e.g. CCFv2 or CCFv3).
+        """,
+    )
+    parser.add_argument(
+        "output_path",
+        type=Path,
+        help="""\
+        Path to the CSV file where to save the statistics of every
+        experiment and every region, one row per experiment and region.
+        """,
+    )
+    parser.add_argument(
+        "volume_paths",
+        type=Path,
+        nargs="+",
+        help="""\
+        Paths to the interpolated volumes.
+        """,
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.0,
+        help="""\
+        Voxels whose intensity is above this value are expressing.
+        """,
+    )
+    parser.add_argument(
+        "--matrix-path",
+        type=Path,
+        help="""\
+        If specified, a region by experiment matrix of --matrix-statistic
+        is saved there as a CSV file too.
+        """,
+    )
+    parser.add_argument(
+        "--matrix-statistic",
+        type=str,
+        choices=STATISTICS,
+        default="mean",
+        help="""\
+        Statistic saved in the region by experiment matrix.
+        """,
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=32,
+        help="""\
+        Number of slices processed at once.
+        """,
+    )
+    return parser.parse_args()
+
+
+def region_statistics(
+    volumes: list[np.ndarray],
+    annotation: np.ndarray,
+    threshold: float = 0.0,
+    chunk_size: int = 32,
+) -> tuple[np.ndarray, dict[str, np.ndarray]]:
+    """Compute the expression statistics of every region.
+
+    The volumes are read chunk by chunk along their first axis, so they can
+    be memory-mapped. Every chunk of the annotation is encoded once and then
+    used by one `np.bincount` per volume and statistic, instead of one mask
+    per region.
+
+    Parameters
+    ----------
+    volumes
+        Interpolated volumes, all of the same shape as `annotation` (without
+        the channels). RGB volumes are converted to grayscale.
+    annotation
+        Annotation volume.
+    threshold
+        Voxels whose intensity is above this value are expressing.
+    chunk_size
+        Number of slices processed at once.
+
+    Returns
+    -------
+    labels : np.ndarray
+        Labels of the regions found in the annotation, sorted.
+    statistics : dict[str, np.ndarray]
+        Arrays of shape `(n_volumes, n_labels)` for every name of
+        `STATISTICS`.
+    """
+    from qc import Encoder, iter_chunks, to_intensity
+
+    ndim = annotation.ndim
+    for volume in volumes:
+        if volume.shape[:ndim] != annotation.shape:
+            raise ValueError(
+                f"The volume ({volume.shape}) and the annotation "
+                f"({annotation.shape}) do not have the same shape !"
+            )
+
+    encoder = Encoder(is_annotation=True)
+    for annotation_chunk in iter_chunks(annotation, chunk_size):
+        encoder.fit_chunk(annotation_chunk)
+    n_labels = encoder.n_codes
+
+    counts = np.zeros(n_labels, dtype=np.int64)
+    sums = np.zeros((len(volumes), n_labels))
+    expressing = np.zeros((len(volumes), n_labels), dtype=np.int64)
+
+    for start in range(0, len(annotation), chunk_size):
+        codes = encoder.encode(np.asarray(annotation[start : start + chunk_size]))
+        codes = codes.ravel()
+        counts += np.bincount(codes, minlength=n_labels)
+        for i, volume in enumerate(volumes):
+            chunk = np.asarray(volume[start : start + chunk_size])
+            values = to_intensity(chunk, ndim).ravel().astype(np.float64)
+            sums[i] += np.bincount(codes, weights=values, minlength=n_labels)
+            expressing[i] += np.bincount(codes[values > threshold], minlength=n_labels)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        statistics = {
+            "voxel_count": np.broadcast_to(counts, sums.shape),
+            "sum": sums,
+            "mean": sums / counts,
+            "expressing_fraction": expressing / counts,
+        }
+    return encoder.label_values, statistics
+
+
+def write_table(
+    output_path: Path | str,
+    names: list[str],
+    labels: np.ndarray,
+    statistics: dict[str, np.ndarray],
+) -> None:
+    """Write the statistics as a CSV file, one row per volume and region."""
+    with open(output_path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(("experiment", "label") + STATISTICS)
+        for i, name in enumerate(names):
+            for j, label in enumerate(labels):
+                writer.writerow(
+                    [name, label, int(statistics["voxel_count"][i, j])]
+                    + [f"{statistics[s][i, j]:.6g}" for s in STATISTICS[1:]]
+                )
+
+
+def write_matrix(
+    matrix_path: Path | str,
+    names: list[str],
+    labels: np.ndarray,
+    values: np.ndarray,
+) -> None:
+    """Write one statistic as a CSV file, one row per region."""
+    with open(matrix_path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["label"] + list(names))
+        for j, label in enumerate(labels):
+            writer.writerow([label] + [f"{value:.6g}" for value in values[:, j]])
+
+
+def main(
+    annotation_path: Path | str,
+    output_path: Path | str,
+    volume_paths: list[Path | str],
+    threshold: float = 0.0,
+    matrix_path: Path | str | None = None,
+    matrix_statistic: str = "mean",
+    chunk_size: int = 32,
+) -> int:
+    """Implement main function."""
+    from utils import check_and_load, volume_stem
+
+    logger.info("Loading volumes")
+    annotation = check_and_load(annotation_path, mmap=True)
+    volumes = [check_and_load(path, mmap=True) for path in volume_paths]
+    names = [volume_stem(path) for path in volume_paths]
+
+    logger.info(f"Computing the statistics of {len(volumes)} volumes...")
+    labels, statistics = region_statistics(volumes, annotation, threshold, chunk_size)
+
+    output_path = Path(output_path)
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    write_table(output_path, names, labels, statistics)
+
+    if matrix_path is not None:
+        matrix_path = Path(matrix_path)
+        matrix_path.parent.mkdir(parents=True, exist_ok=True)
+        write_matrix(matrix_path, names, labels, statistics[matrix_statistic])
+
+    return 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
+    )
+    args = parse_args()
+    kwargs = vars(args)
+    sys.exit(main(**kwargs))
@@ -0,0 +1,302 @@
+# Copyright 2021, Blue Brain Project, EPFL
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Section-indexed storage of gene expression slices."""
+from __future__ import annotations
+
+import bisect
+import logging
+from dataclasses import dataclass
+from typing import Any, Iterator, Sequence
+
+import numpy as np
+
+logger = logging.getLogger("sections")
+
+
+@dataclass
+class Section:
+    """Data attached to one gene section.
+
+    Attributes
+    ----------
+    image
+        Gene expression image of the section.
+    image_id
+        Allen Brain image ID of the section.
+    expression
+        Threshold expression image of the section, if any.
+    transform
+        Registration transform (displacement field) of the section, if any.
+    """
+
+    image: np.ndarray
+    image_id: int | None = None
+    expression: np.ndarray | None = None
+    transform: np.ndarray | None = None
+
+
+class SectionStore:
+    """Gene sections indexed by their section number.
+
+    The sections are kept in a dictionary keyed by section number, so that
+    lookups, insertions and removals are O(1). The insertion order is kept
+    so that stacking the images gives back the order of the original data.
+    """
+
+    def __init__(self) -> None:
+        self._sections = {}
+        self._sorted = None
+
+    @classmethod
+    def from_arrays(
+        cls,
+        images: np.ndarray,
+        section_numbers: Sequence[int | float],
+        image_ids: Sequence[int] | None = None,
+        expressions: np.ndarray | None = None,
+    ) -> SectionStore:
+        """Create a store from dense arrays of sections.
+
+        Parameters
+        ----------
+        images
+            Array of shape `(n_sections, ...)` containing the gene images.
+        section_numbers
+            Section number of every image.
+        image_ids
+            If specified, Allen Brain image ID of every image.
+        expressions
+            If specified, array of shape `(n_sections, ...)` containing
+            the threshold expression images.
+
+        Returns
+        -------
+        store : SectionStore
+            Store containing one section per section number. The images are
+            views on the given arrays, nothing is copied. When a section
+            number is present several times, a warning is logged and only
+            its last image is kept, at the position of the first one.
+
+        Raises
+        ------
+        ValueError
+            When the lengths of the inputs are not consistent.
+        """
+        n_sections = len(images)
+        if len(section_numbers) != n_sections:
+            raise ValueError(
+                f"The length of the list of the section numbers "
+                f"({len(section_numbers)}) has to be consistent to the "
+                f"number of images ({n_sections})"
+            )
+        if image_ids is not None and len(image_ids) != n_sections:
+            raise ValueError(
+                f"The length of the list of the image ids ({len(image_ids)}) "
+                f"has to be consistent to the number of images ({n_sections})"
+            )
+        if expressions is not None and len(expressions) != n_sections:
+            raise ValueError(
+                f"The number of expression images ({len(expressions)}) "
+                f"has to be consistent to the number of images ({n_sections})"
+            )
+
+        numbers, counts = np.unique(
+            [int(section_number) for section_number in section_numbers],
+            return_counts=True,
+        )
+        duplicates = numbers[counts > 1].tolist()
+        if duplicates:
+            logger.warning(
+                f"The sections {duplicates} are present several times, only "
+                "the last image of each of them is kept."
+            )
+
+        store = cls()
+        for i, section_number in enumerate(section_numbers):
+            store._sections[int(section_number)] = Section(
+                images[i],
+                None if image_ids is None else image_ids[i],
+                None if expressions is None else expressions[i],
+            )
+        return store
+
+    def __len__(self) -> int:
+        return len(self._sections)
+
+    def __contains__(self, section_number: Any) -> bool:
+        return section_number in self._sections
+
+    def __getitem__(self, section_number: int) -> Section:
+        return self._sections[section_number]
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self._sections)
+
+    def items(self) -> Iterator[tuple[int, Section]]:
+        """Iterate over `(section_number, section)` in insertion order."""
+        return iter(self._sections.items())
+
+    def add(
+        self,
+        section_number: int | float,
+        image: np.ndarray,
+        image_id: int | None = None,
+        expression: np.ndarray | None = None,
+        transform: np.ndarray | None = None,
+    ) -> Section:
+        """Add a section to the store.
+
+        If a section with the same number is already stored, it is replaced.
+
+        Parameters
+        ----------
+        section_number
+            Section number of the image.
+        image
+            Gene expression image of the section.
+        image_id
+            Allen Brain image ID of the section.
+        expression
+            Threshold expression image of the section.
+        transform
+            Registration transform of the section.
+
+        Returns
+        -------
+        section : Section
+            The newly stored section.
+        """
+        section_number = int(section_number)
+        if section_number in self._sections:
+            logger.warning(
+                f"Section {section_number} is present several times, "
+                "only the last one is kept."
+            )
+            del self._sections[section_number]
+        else:
+            self._sorted = None
+
+        section = Section(image, image_id, expression, transform)
+        self._sections[section_number] = section
+        return section
+
+    def remove(self, section_number: int) -> Section:
+        """Remove a section from the store and return it."""
+        section = self._sections.pop(section_number)
+        self._sorted = None
+        return section
+
+    @property
+    def section_numbers(self) -> list[int]:
+        """Section numbers in insertion order."""
+        return list(self._sections)
+
+    @property
+    def image_ids(self) -> list[int | None]:
+        """Image IDs in insertion order."""
+        return [section.image_id for section in self._sections.values()]
+
+    def sorted_section_numbers(self) -> list[int]:
+        """Section numbers in increasing order."""
+        if self._sorted is None:
+            self._sorted = sorted(self._sections)
+        return self._sorted
+
+    def images(self) -> np.ndarray:
+        """Stack the images of all sections in insertion order."""
+        if not self._sections:
+            return np.array([])
+        return np.stack([section.image for section in self._sections.values()])
+
+    def expressions(self) -> np.ndarray | None:
+        """Stack the expression images of all sections in insertion order.
+
+        Returns
+        -------
+        expressions : np.ndarray | None
+            The stacked expression images, or None if no section has one.
+
+        Raises
+        ------
+        ValueError
+            When only some of the sections have an expression image.
+        """
+        expressions = [section.expression for section in self._sections.values()]
+        n_missing = sum(expression is None for expression in expressions)
+        if n_missing == len(expressions):
+            return None
+        if n_missing > 0:
+            raise ValueError(
+                f"{n_missing} sections out of {len(expressions)} do not have "
+                "an expression image."
+            )
+        return np.stack(expressions)
+
+    def neighbours(self, section_number: int) -> tuple[int | None, int | None]:
+        """Find the closest known sections around a section number.
+
+        Parameters
+        ----------
+        section_number
+            Any section number, known or not.
+
+        Returns
+        -------
+        previous_section : int | None
+            Largest known section number strictly lower than the given one,
+            or None if there is none.
+        next_section : int | None
+            Smallest known section number strictly greater than the given one,
+            or None if there is none.
+        """
+        known = self.sorted_section_numbers()
+        left = bisect.bisect_left(known, section_number)
+        right = bisect.bisect_right(known, section_number)
+        previous_section = known[left - 1] if left > 0 else None
+        next_section = known[right] if right < len(known) else None
+        return previous_section, next_section
+
+    def gaps(self) -> list[tuple[int, int]]:
+        """List the gaps between consecutive known sections.
+
+        Returns
+        -------
+        gaps : list[tuple[int, int]]
+            Pairs `(left, right)` of consecutive known section numbers
+            with at least one missing section between them.
+        """
+        known = self.sorted_section_numbers()
+        return [
+            (left, right)
+            for left, right in zip(known[:-1], known[1:])
+            if right - left > 1
+        ]
+
+    def update_metadata(self, metadata: dict[str, Any]) -> dict[str, Any]:
+        """Write the section numbers and image IDs of the store in metadata.
+
+        Parameters
+        ----------
+        metadata
+            Metadata dictionary of the experiment, as saved by `download_gene`.
+
+        Returns
+        -------
+        metadata : dict
+            The same dictionary, with the keys `section_numbers` and
+            `image_ids` matching the sections of the store.
+        """
+        metadata["section_numbers"] = self.section_numbers
+        metadata["image_ids"] = self.image_ids
+        return metadata
@@ -14,22 +14,60 @@
 """Utility functions for the full pipeline."""
 from __future__ import annotations
 
+import hashlib
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
+from typing import Callable, Iterable
 
 import numpy as np
-from atlannot.utils import load_volume
 
+# Axis of the volume along which the sections of an experiment are stacked
+SECTION_AXES = {"coronal": 0, "sagittal": 2}
 
-def check_and_load(path: Path | str, normalize: bool = False) -> np.ndarray:
+# Directory of the volumes shared between processes, see `check_and_load`
+SHARED_DIR = Path("/dev/shm")
+SHARED_PREFIX = "deep-atlas-"
+
+# Loaders of the same shared volume in one process wait for each other
+_shared_locks = {}
+_shared_locks_lock = threading.Lock()
+# Shared volumes this process is attached to, see `release_shared`
+_attached = set()
+
+# Suffix of the run-length encoded volumes, see `save_rle`
+RLE_SUFFIX = ".rle.npz"
+
+
+def check_and_load(
+    path: Path | str,
+    normalize: bool = False,
+    mmap: bool = False,
+    shared: bool = False,
+) -> np.ndarray:
     """Load volume if path exists.
 
     Parameters
     ----------
     path
-        File path.
+        File path. Run-length encoded volumes (see `save_rle`) are
+        decoded.
     normalize
         If True, output volume values are between 0 and 1.
         Otherwise, volume is kept raw.
+    mmap
+        If True and the file is a numpy file, the volume is memory-mapped
+        in read-only mode instead of being read entirely. Only the parts
+        of the volume that are accessed are then read from disk.
+        Cannot be combined with `normalize`.
+    shared
+        If True, the volume is loaded once into shared memory (a numpy
+        file in `SHARED_DIR`) and memory-mapped in read-only mode from
+        there. Any later call, from any process, attaches to the same
+        copy instead of loading the volume again.
 
     Returns
     -------
@@ -39,11 +77,558 @@ def check_and_load(path: Path | str, normalize: bool = False) -> np.ndarray:
     Raises
     ------
     ValueError
-        When the path specified does not exist.
+        When the path specified does not exist or when a memory-mapped
+        volume is asked to be normalized.
     """
     path = Path(path)
+    pending = _async_writer.get(path)
+    if pending is not None:
+        return normalize_volume(pending) if normalize else pending
+
     if not path.exists():
         raise ValueError(f"The specified path {path} does not exist.")
 
+    if shared:
+        return load_shared(path, normalize=normalize)
+
+    if mmap and path.suffix == ".npy":
+        if normalize:
+            raise ValueError("A memory-mapped volume cannot be normalized.")
+        return np.load(path, mmap_mode="r")
+
+    if path.name.endswith(RLE_SUFFIX):
+        volume = load_rle(path)
+        if normalize:
+            volume = normalize_volume(volume)
+        return volume
+
+    from atlannot.utils import load_volume
+
     volume = load_volume(path, normalize=normalize)
     return volume
+
+
+def normalize_volume(volume: np.ndarray) -> np.ndarray:
+    """Rescale volume values between 0 and 1, as `atlannot.utils.load_volume`."""
+    volume = volume.astype(np.float32)
+    return (volume - volume.min()) / (volume.max() - volume.min())
+
+
+def save_rle(path: Path | str, volume: np.ndarray) -> None:
+    """Save a volume with run-length encoding.
+
+    Thresholded expression images are mostly background, the runs of
+    identical values are stored once with their length. Stacks of RGB
+    images are encoded pixel by pixel, i.e. a run is a sequence of
+    identical RGB values.
+
+    Parameters
+    ----------
+    path
+        Path of the file, ending with `RLE_SUFFIX`.
+    volume
+        Volume to save.
+    """
+    path = Path(path)
+    if not path.name.endswith(RLE_SUFFIX):
+        raise ValueError(f"The path {path} has to end with {RLE_SUFFIX}.")
+
+    n_channels = 1
+    if volume.ndim > 2 and volume.shape[-1] in {3, 4}:
+        n_channels = volume.shape[-1]
+    pixels = np.ascontiguousarray(volume).reshape(-1, n_channels)
+
+    if len(pixels):
+        changes = np.any(pixels[1:] != pixels[:-1], axis=1)
+        starts = np.concatenate([[0], np.flatnonzero(changes) + 1])
+    else:
+        starts = np.array([], dtype=np.int64)
+    lengths = np.diff(np.append(starts, len(pixels)))
+
+    with open(path, "wb") as f:
+        np.savez(
+            f,
+            shape=np.array(volume.shape),
+            values=pixels[starts],
+            lengths=lengths.astype(np.min_scalar_type(max(len(pixels), 1))),
+        )
+
+
+def load_rle(path: Path | str) -> np.ndarray:
+    """Load a volume saved with `save_rle`."""
+    with np.load(path) as data:
+        shape = tuple(data["shape"])
+        pixels = np.repeat(data["values"], data["lengths"], axis=0)
+    return pixels.reshape(shape)
+
+
+def save_volume(path: Path | str, volume: np.ndarray) -> None:
+    """Save a volume as a numpy file or a run-length encoded one.
+
+    The format is chosen from the suffix of `path`, see `RLE_SUFFIX`.
+    """
+    if str(path).endswith(RLE_SUFFIX):
+        save_rle(path, volume)
+    else:
+        np.save(path, volume)
+
+
+def write_atomic(
+    path: Path | str,
+    volume: np.ndarray,
+    save_func: Callable[[Path, np.ndarray], None] = save_volume,
+    mtime_ns: int | None = None,
+) -> None:
+    """Save a volume to a temporary file, sync it and rename it to its path.
+
+    Readers never see a partially written file, and once this function
+    returns the file survives a crash of the node.
+
+    Parameters
+    ----------
+    path
+        Path of the file.
+    volume
+        Volume to save.
+    save_func
+        Function saving a volume to a path, the format being chosen from
+        the suffix (which the temporary file keeps).
+    mtime_ns
+        If specified, modification time given to the file, in nanoseconds.
+    """
+    path = Path(path)
+    tmp_path = path.with_name(f".tmp-{os.getpid()}-{path.name}")
+    try:
+        save_func(tmp_path, volume)
+        if mtime_ns is not None:
+            os.utime(tmp_path, ns=(mtime_ns, mtime_ns))
+        with open(tmp_path, "rb") as f:
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+
+    # The rename itself is only durable once the directory is synced
+    fd = os.open(path.parent, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class AsyncWriter:
+    """Save volumes in a background thread, keeping them readable meanwhile.
+
+    Until a volume is on disk, `check_and_load` gets it from memory, so that
+    the next stages of the pipeline do not wait for the disk. Saved volumes
+    must not be modified afterwards.
+
+    The modification time of a file is chosen when its volume is given, so
+    that `file_version` does not have to wait for the disk either.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._versions = {}
+        self._futures = {}
+        self._pool = None
+        self._pid = None
+
+    def save(
+        self,
+        path: Path | str,
+        volume: np.ndarray,
+        save_func: Callable[[Path, np.ndarray], None] = save_volume,
+        on_saved: Callable[[], None] | None = None,
+    ) -> Future:
+        """Save a volume in the background, see `write_atomic`.
+
+        `on_saved` is called once the volume is on disk, before the future
+        is done, for instance to write files describing the volume.
+
+        Returns
+        -------
+        future : Future
+            Future whose result is None once the volume is on disk.
+        """
+        key = Path(path).resolve()
+        with self._lock:
+            # A forked process (e.g. a worker of `executors.ProcessExecutor`)
+            # does not inherit the thread of its parent
+            if self._pid != os.getpid():
+                self._pending = {}
+                self._versions = {}
+                self._futures = {}
+                self._pool = ThreadPoolExecutor(
+                    max_workers=1, thread_name_prefix="async-writer"
+                )
+                self._pid = os.getpid()
+            # Whole microseconds, which most file systems can store exactly
+            mtime_ns = time.time_ns() // 1000 * 1000
+            self._pending[key] = volume
+            self._versions[key] = mtime_ns
+            future = self._pool.submit(
+                self._write, key, volume, save_func, mtime_ns, on_saved
+            )
+            self._futures[key] = future
+        return future
+
+    def _write(
+        self,
+        key: Path,
+        volume: np.ndarray,
+        save_func: Callable[[Path, np.ndarray], None],
+        mtime_ns: int,
+        on_saved: Callable[[], None] | None,
+    ) -> None:
+        try:
+            write_atomic(key, volume, save_func, mtime_ns)
+            if on_saved is not None:
+                on_saved()
+        finally:
+            with self._lock:
+                if self._pending.get(key) is volume:
+                    del self._pending[key]
+                    del self._versions[key]
+
+    def get(self, path: Path | str) -> np.ndarray | None:
+        """Get a read-only view of a volume not on disk yet, None otherwise."""
+        with self._lock:
+            volume = self._pending.get(Path(path).resolve())
+        if volume is None:
+            return None
+        view = volume.view()
+        view.flags.writeable = False
+        return view
+
+    def version(self, path: Path | str) -> int | None:
+        """Get the modification time of a volume not on disk yet, None otherwise."""
+        with self._lock:
+            return self._versions.get(Path(path).resolve())
+
+    def has_pending(self, paths: Iterable[Path | str] | None = None) -> bool:
+        """Check whether some volumes (all if None) were not waited for yet."""
+        with self._lock:
+            return bool(self._select(paths))
+
+    def wait(self, paths: Iterable[Path | str] | None = None) -> None:
+        """Wait until some volumes (all if None) are on disk.
+
+        Raises
+        ------
+        Exception
+            The first error raised while saving one of the volumes.
+        """
+        with self._lock:
+            futures = self._select(paths)
+        for key, future in futures.items():
+            try:
+                future.result()
+            finally:
+                with self._lock:
+                    if self._futures.get(key) is future:
+                        del self._futures[key]
+
+    def _select(self, paths: Iterable[Path | str] | None) -> dict[Path, Future]:
+        if paths is None:
+            return dict(self._futures)
+        keys = {Path(path).resolve() for path in paths}
+        return {key: f for key, f in self._futures.items() if key in keys}
+
+
+_async_writer = AsyncWriter()
+
+
+def save_volume_async(
+    path: Path | str,
+    volume: np.ndarray,
+    save_func: Callable[[Path, np.ndarray], None] = save_volume,
+    on_saved: Callable[[], None] | None = None,
+) -> Future:
+    """Save a volume in a background thread of the current process.
+
+    Meanwhile, `check_and_load` returns the volume from memory. Use
+    `wait_for_writes` before relying on the file itself. If specified,
+    `on_saved` is called once the volume is on disk.
+    """
+    return _async_writer.save(path, volume, save_func, on_saved)
+
+
+def has_pending_writes(paths: Iterable[Path | str] | None = None) -> bool:
+    """Check whether `wait_for_writes` is needed for some volumes (all if None)."""
+    return _async_writer.has_pending(paths)
+
+
+def wait_for_writes(paths: Iterable[Path | str] | None = None) -> None:
+    """Wait until the volumes saved with `save_volume_async` are on disk.
+
+    Parameters
+    ----------
+    paths
+        Paths of the volumes to wait for. If None, all of them.
+    """
+    _async_writer.wait(paths)
+
+
+def file_version(path: Path | str) -> str:
+    """Identify the version of a file by its modification time.
+
+    A volume still being saved by `save_volume_async` is not waited for, it
+    gets the modification time the file will have once written.
+    """
+    mtime_ns = _async_writer.version(path)
+    if mtime_ns is None:
+        mtime_ns = Path(path).stat().st_mtime_ns
+    return str(mtime_ns)
+
+
+def volume_stem(path: Path | str) -> str:
+    """Get the name of a volume file without its (possibly double) suffix.
+
+    For instance, both "1234-expression.npy" and "1234-expression.rle.npz"
+    give "1234-expression".
+    """
+    name = Path(path).name
+    if name.endswith(RLE_SUFFIX):
+        return name[: -len(RLE_SUFFIX)]
+    return Path(name).stem
+
+
+def preview_path(path: Path | str, factor: int) -> Path:
+    """Get the path of the preview of a volume downsampled by `factor`.
+
+    For instance, "1234-rife-interpolated-gene.npy" gives
+    "1234-rife-interpolated-gene-preview4x.npy" for a factor of 4.
+    """
+    path = Path(path)
+    stem = volume_stem(path)
+    return path.with_name(f"{stem}-preview{factor}x{path.name[len(stem):]}")
+
+
+def block_average(volume: np.ndarray, factor: int, n_axes: int = 3) -> np.ndarray:
+    """Downsample a volume by averaging blocks of `factor` voxels per axis.
+
+    Blocks on the border of the volume may be smaller, they are averaged
+    over the voxels they contain.
+
+    Parameters
+    ----------
+    volume
+        Volume to downsample, possibly with channels after the spatial axes.
+    factor
+        Size of the blocks along every spatial axis.
+    n_axes
+        Number of spatial axes, the other axes (e.g. RGB) are kept.
+
+    Returns
+    -------
+    downsampled : np.ndarray
+        Float32 volume whose spatial axes are `factor` times smaller
+        (rounded up).
+    """
+    downsampled = np.asarray(volume, dtype=np.float32)
+    for axis in range(min(n_axes, downsampled.ndim)):
+        size = downsampled.shape[axis]
+        starts = np.arange(0, size, factor)
+        counts = np.diff(np.append(starts, size))
+        downsampled = np.add.reduceat(downsampled, starts, axis=axis)
+        shape = [1] * downsampled.ndim
+        shape[axis] = len(counts)
+        downsampled /= counts.reshape(shape)
+    return downsampled
+
+
+def compute_previews(
+    volume: np.ndarray, factors: Iterable[int], n_axes: int = 3
+) -> dict[int, np.ndarray]:
+    """Compute downsampled previews of a volume in a single pass over it.
+
+    The volume is read slab by slab along its first axis, the thickness of
+    the slabs being a multiple of all the factors, so that a memory-mapped
+    volume is never entirely loaded and every slab feeds all the previews.
+
+    Parameters
+    ----------
+    volume
+        Volume to downsample, possibly memory-mapped.
+    factors
+        Downsampling factors of the previews, e.g. `[2, 4, 8]`.
+    n_axes
+        Number of spatial axes, see `block_average`.
+
+    Returns
+    -------
+    previews : dict[int, np.ndarray]
+        Block-averaged volume of every factor, of the same dtype as
+        `volume` (rounded for integer volumes).
+    """
+    factors = sorted(set(int(factor) for factor in factors))
+    if not factors:
+        return {}
+    if min(factors) < 1:
+        raise ValueError(f"The preview factors {factors} must be positive.")
+
+    n_axes = min(n_axes, volume.ndim)
+    previews = {}
+    for factor in factors:
+        shape = tuple(-(-size // factor) for size in volume.shape[:n_axes])
+        previews[factor] = np.empty(shape + volume.shape[n_axes:], volume.dtype)
+
+    thickness = int(np.lcm.reduce(factors))
+    for start in range(0, len(volume), thickness):
+        slab = np.asarray(volume[start : start + thickness])
+        for factor, preview in previews.items():
+            downsampled = block_average(slab, factor, n_axes)
+            if np.issubdtype(preview.dtype, np.integer):
+                downsampled = np.rint(downsampled)
+            first = start // factor
+            preview[first : first + len(downsampled)] = downsampled
+    return previews
+
+
+def load_shared(path: Path | str, normalize: bool = False) -> np.ndarray:
+    """Load a volume into shared memory, or attach to it if already there.
+
+    The shared copy is identified by the path of the volume, its size,
+    its modification time and the normalization, so that a modified
+    volume gets a new copy. The copies of its previous versions are then
+    removed.
+
+    Parameters
+    ----------
+    path
+        File path of an existing volume.
+    normalize
+        If True, shared volume values are between 0 and 1.
+
+    Returns
+    -------
+    volume : np.ndarray
+        Read-only memory map of the shared volume.
+    """
+    path = Path(path).resolve()
+    stat = path.stat()
+    path_key = hashlib.sha1(f"{path}:{normalize}".encode()).hexdigest()[:16]
+    version_key = hashlib.sha1(
+        f"{stat.st_size}:{stat.st_mtime_ns}".encode()
+    ).hexdigest()[:8]
+    key = f"{path_key}-{version_key}"
+    shared_path = SHARED_DIR / f"{SHARED_PREFIX}{key}.npy"
+
+    with _shared_locks_lock:
+        lock = _shared_locks.setdefault(key, threading.Lock())
+
+    with lock:
+        # Every attached process owns a reference file next to the copy, the
+        # copy is only removed once no live process references it
+        _shared_ref_path(shared_path, os.getpid()).touch()
+        _attached.add(shared_path)
+
+        while True:
+            if not shared_path.exists():
+                _write_shared(shared_path, check_and_load(path, normalize=normalize))
+                for old_path in SHARED_DIR.glob(f"{SHARED_PREFIX}{path_key}-*"):
+                    if not old_path.name.startswith(shared_path.name):
+                        old_path.unlink(missing_ok=True)
+            try:
+                return np.load(shared_path, mmap_mode="r")
+            except FileNotFoundError:
+                # Removed by another process in the meantime
+                continue
+
+
+def _write_shared(shared_path: Path, volume: np.ndarray) -> None:
+    """Write a shared volume through a unique temporary file."""
+    # Loaders of other processes write their own file, the rename is atomic
+    fd, tmp_name = tempfile.mkstemp(
+        dir=SHARED_DIR, prefix=f".{shared_path.name}.", suffix=".tmp"
+    )
+    try:
+        with os.fdopen(fd, "wb") as f:
+            np.save(f, volume)
+        os.replace(tmp_name, shared_path)
+    except BaseException:
+        Path(tmp_name).unlink(missing_ok=True)
+        raise
+
+
+def _shared_ref_path(shared_path: Path, pid: int) -> Path:
+    """Path of the file recording that a process uses a shared volume."""
+    return shared_path.with_name(f"{shared_path.name}.{pid}.ref")
+
+
+def _is_alive(pid: int) -> bool:
+    """Check whether a process of this node is running."""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def release_shared() -> int:
+    """Detach this process from the shared volumes it loaded or attached to.
+
+    A shared volume is removed from shared memory once no live process of
+    the node is attached to it anymore. Processes still using a removed
+    volume keep their memory map until they end.
+
+    Returns
+    -------
+    int
+        Number of shared volumes removed.
+    """
+    n_removed = 0
+    for shared_path in sorted(_attached):
+        _shared_ref_path(shared_path, os.getpid()).unlink(missing_ok=True)
+        _attached.discard(shared_path)
+
+        in_use = False
+        for ref_path in SHARED_DIR.glob(f"{shared_path.name}.*.ref"):
+            pid = ref_path.name[len(shared_path.name) + 1 : -len(".ref")]
+            if pid.isdigit() and _is_alive(int(pid)):
+                in_use = True
+            else:
+                # Left by a process that ended without releasing
+                ref_path.unlink(missing_ok=True)
+
+        if not in_use and shared_path.exists():
+            shared_path.unlink(missing_ok=True)
+            n_removed += 1
+    return n_removed
+
+
+def extract_sections(
+    volume: np.ndarray, section_numbers: list[int | float], axis: str
+) -> dict[int, np.ndarray]:
+    """Extract the planes of some sections of a volume.
+
+    All the planes are gathered at once and copied into one contiguous
+    buffer, so that no reorientation of the volume is needed afterwards.
+    This matters for sagittal sections, which are strided views of the
+    volume (and scattered on disk if the volume is memory-mapped).
+
+    Parameters
+    ----------
+    volume
+        Volume of shape `(528, 320, 456)`, possibly memory-mapped.
+    section_numbers
+        Section numbers of the planes to extract.
+    axis
+        Axis of the experiment, either "coronal" or "sagittal".
+
+    Returns
+    -------
+    planes : dict[int, np.ndarray]
+        Contiguous plane of every (unique) section number. Sagittal planes
+        have the shape `(528, 320)`.
+    """
+    section_axis = SECTION_AXES[axis]
+    unique_numbers = list(dict.fromkeys(int(s) for s in section_numbers))
+    planes = np.take(volume, unique_numbers, axis=section_axis)
+    planes = np.ascontiguousarray(np.moveaxis(planes, section_axis, 0))
+    return dict(zip(unique_numbers, planes))
@@ -0,0 +1,512 @@
+# Copyright 2021, Blue Brain Project, EPFL
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Worker running the full pipeline for the jobs of a file-based queue.
+
+The queue is a directory containing one sub-directory per job state
+(`pending`, `running`, `done` and `failed`). Every job is a JSON file that
+moves from one sub-directory to the next. Jobs are claimed by renaming them,
+so several workers can serve the same queue.
+
+Running jobs record their worker and a heartbeat, so that the jobs of a
+worker that died (e.g. killed or on a failed node) can be given back to the
+queue, see `requeue_stale`.
+
+A worker stays alive between jobs: the heavy libraries are imported once,
+the interpolator models are cached by `interpolate_gene` and the reference
+volumes are kept in shared memory, so queued experiments have almost no
+setup cost.
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Any
+
+logger = logging.getLogger("worker")
+
+STATES = ("pending", "running", "done", "failed")
+
+# Seconds between two heartbeats of a running job
+HEARTBEAT_INTERVAL = 30.0
+# Seconds without heartbeat after which the worker of a job is considered dead
+STALE_TIMEOUT = 300.0
+
+
+def parse_args():
+    """Parse arguments."""
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    serve = subparsers.add_parser("serve", help="Run the jobs of a queue.")
+    serve.add_argument(
+        "queue_dir",
+        type=Path,
+        help="""\
+        Path to the queue directory.
+        """,
+    )
+    serve.add_argument(
+        "config_path",
+        type=Path,
+        help="""\
+        Path to a JSON file containing the default parameters of the jobs,
+        i.e. keyword arguments of `full_pipeline.main` (e.g. "nissl_path",
+        "ccfv2_path", "output_dir", ...).
+        """,
+    )
+    serve.add_argument(
+        "--poll-interval",
+        type=float,
+        default=5.0,
+        help="""\
+        Number of seconds to wait before looking for new jobs.
+        """,
+    )
+    serve.add_argument(
+        "--stale-timeout",
+        type=float,
+        default=STALE_TIMEOUT,
+        help="""\
+        Running jobs without a heartbeat for this number of seconds are
+        given back to the queue when the worker starts.
+        """,
+    )
+    serve.add_argument(
+        "--once",
+        action="store_true",
+        help="""\
+        If True, the worker stops as soon as the queue is empty.
+        """,
+    )
+
+    submit = subparsers.add_parser("submit", help="Add a job to a queue.")
+    submit.add_argument(
+        "queue_dir",
+        type=Path,
+        help="""\
+        Path to the queue directory.
+        """,
+    )
+    submit.add_argument(
+        "experiment_id",
+        type=int,
+        help="""\
+        Experiment ID from Allen Brain to use.
+        """,
+    )
+    submit.add_argument(
+        "-p",
+        "--param",
+        type=str,
+        action="append",
+        default=[],
+        metavar="KEY=VALUE",
+        help="""\
+        Parameter of the job overriding the default of the worker, e.g.
+        "interpolator_name=linear". Values are parsed as JSON if possible.
+        Can be repeated.
+        """,
+    )
+
+    status = subparsers.add_parser("status", help="Show the jobs of a queue.")
+    status.add_argument(
+        "queue_dir",
+        type=Path,
+        help="""\
+        Path to the queue directory.
+        """,
+    )
+
+    requeue = subparsers.add_parser(
+        "requeue", help="Give the jobs of dead workers back to a queue."
+    )
+    requeue.add_argument(
+        "queue_dir",
+        type=Path,
+        help="""\
+        Path to the queue directory.
+        """,
+    )
+    requeue.add_argument(
+        "--stale-timeout",
+        type=float,
+        default=STALE_TIMEOUT,
+        help="""\
+        Running jobs without a heartbeat for this number of seconds are
+        given back to the queue.
+        """,
+    )
+    return parser.parse_args()
+
+
+# Running jobs are updated by the scheduler logs and by the heartbeat
+_job_lock = threading.RLock()
+
+
+def write_job(path: Path, job: dict[str, Any]) -> None:
+    """Write a job file atomically, so that readers never see half of it."""
+    with _job_lock:
+        tmp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(job, f, indent=True)
+        os.replace(tmp_path, path)
+
+
+def parse_param(param: str) -> tuple[str, Any]:
+    """Parse a KEY=VALUE parameter, the value being parsed as JSON if possible."""
+    key, sep, value = param.partition("=")
+    if not sep:
+        raise ValueError(f"The parameter {param} is not of the form KEY=VALUE.")
+    try:
+        value = json.loads(value)
+    except json.JSONDecodeError:
+        pass
+    return key.replace("-", "_"), value
+
+
+def submit(queue_dir: Path | str, experiment_id: int, params: dict[str, Any]) -> Path:
+    """Add a job to the queue.
+
+    Parameters
+    ----------
+    queue_dir
+        Path to the queue directory.
+    experiment_id
+        Experiment ID from Allen Brain to use.
+    params
+        Parameters of the job overriding the defaults of the worker.
+
+    Returns
+    -------
+    job_path : Path
+        Path to the pending job file.
+    """
+    pending_dir = Path(queue_dir) / "pending"
+    pending_dir.mkdir(parents=True, exist_ok=True)
+    # Jobs are run in submission order, hence the timestamp first
+    job_id = f"{time.time_ns()}-{experiment_id}-{uuid.uuid4().hex[:8]}"
+    job = {
+        "id": job_id,
+        "experiment_id": experiment_id,
+        "params": params,
+        "submitted": time.time(),
+    }
+    job_path = pending_dir / f"{job_id}.json"
+    write_job(job_path, job)
+    return job_path
+
+
+def claim(queue_dir: Path) -> Path | None:
+    """Move the oldest pending job to the running jobs.
+
+    Returns
+    -------
+    job_path : Path or None
+        Path to the claimed job file, None if there is no pending job.
+    """
+    running_dir = queue_dir / "running"
+    running_dir.mkdir(parents=True, exist_ok=True)
+    for pending_path in sorted((queue_dir / "pending").glob("*.json")):
+        running_path = running_dir / pending_path.name
+        try:
+            os.rename(pending_path, running_path)
+        except FileNotFoundError:
+            # Claimed by another worker in the meantime
+            continue
+        return running_path
+    return None
+
+
+class StageProgress(logging.Handler):
+    """Record the progress of the pipeline stages in the job file.
+
+    The scheduler logs "<stage>: <status>" messages, they are stored
+    under the "stages" key of the job.
+    """
+
+    def __init__(self, job_path: Path, job: dict[str, Any]) -> None:
+        super().__init__()
+        self.job_path = job_path
+        self.job = job
+        self.job.setdefault("stages", {})
+
+    def emit(self, record: logging.LogRecord) -> None:
+        stage, sep, status = record.getMessage().partition(": ")
+        if not sep:
+            return
+        with _job_lock:
+            self.job["stages"][stage] = status.split(",")[0]
+            write_job(self.job_path, self.job)
+
+
+class Heartbeat(threading.Thread):
+    """Update the heartbeat of a running job until stopped."""
+
+    def __init__(self, job_path: Path, job: dict[str, Any]) -> None:
+        super().__init__(name="heartbeat", daemon=True)
+        self.job_path = job_path
+        self.job = job
+        self.stopped = threading.Event()
+
+    def run(self) -> None:
+        while not self.stopped.wait(HEARTBEAT_INTERVAL):
+            with _job_lock:
+                self.job["heartbeat"] = time.time()
+                write_job(self.job_path, self.job)
+
+    def stop(self) -> None:
+        self.stopped.set()
+        self.join()
+
+
+def is_stale(job: dict[str, Any], stale_timeout: float) -> bool:
+    """Check whether the worker of a running job is dead.
+
+    The worker is dead if it ran on this node and its process is gone, or
+    if the heartbeat of the job is older than `stale_timeout` seconds.
+    """
+    node, _, pid = job.get("worker", "").rpartition(":")
+    if node == os.uname().nodename and pid.isdigit():
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            return True
+        except PermissionError:
+            pass
+    last_seen = job.get("heartbeat", job.get("started", job["submitted"]))
+    return time.time() - last_seen > stale_timeout
+
+
+def requeue_stale(queue_dir: Path | str, stale_timeout: float) -> list[Path]:
+    """Move the running jobs of dead workers back to the pending jobs.
+
+    Parameters
+    ----------
+    queue_dir
+        Path to the queue directory.
+    stale_timeout
+        Running jobs without a heartbeat for this number of seconds are
+        considered dead.
+
+    Returns
+    -------
+    job_paths : list[Path]
+        Paths to the requeued job files.
+    """
+    queue_dir = Path(queue_dir)
+    requeued = []
+    for running_path in sorted((queue_dir / "running").glob("*.json")):
+        try:
+            with open(running_path) as f:
+                job = json.load(f)
+        except FileNotFoundError:
+            # Finished in the meantime
+            continue
+        if not is_stale(job, stale_timeout):
+            continue
+
+        job["state"] = "pending"
+        job["requeued"] = job.get("requeued", 0) + 1
+        for key in ("worker", "started", "heartbeat", "stages"):
+            job.pop(key, None)
+        # The job is first taken out of the running jobs and updated, then
+        # moved to the pending jobs in one step, so that it can only be
+        # claimed once updated
+        requeue_path = running_path.with_name(f".{running_path.name}.{os.getpid()}")
+        try:
+            os.rename(running_path, requeue_path)
+        except FileNotFoundError:
+            # Requeued by another worker in the meantime
+            continue
+        write_job(requeue_path, job)
+        pending_path = queue_dir / "pending" / running_path.name
+        os.rename(requeue_path, pending_path)
+        logger.warning(f"Job {job['id']}: Requeued, its worker is dead")
+        requeued.append(pending_path)
+    return requeued
+
+
+def run_job(
+    queue_dir: Path, job_path: Path, defaults: dict[str, Any]
+) -> dict[str, Any]:
+    """Run a claimed job through `full_pipeline.main`.
+
+    The job file is then moved to the done or failed jobs.
+
+    Returns
+    -------
+    job : dict
+        Job with its final state, timings and exit code.
+    """
+    from full_pipeline import main as full_pipeline_main
+
+    with open(job_path) as f:
+        job = json.load(f)
+
+    kwargs = {**defaults, **job["params"], "experiment_id": job["experiment_id"]}
+    kwargs.setdefault("shared_memory", True)
+    # The shared volumes are removed when the worker stops
+    kwargs.setdefault("keep_shared", True)
+    job["state"] = "running"
+    job["worker"] = f"{os.uname().nodename}:{os.getpid()}"
+    job["started"] = time.time()
+    job["heartbeat"] = job["started"]
+    write_job(job_path, job)
+
+    heartbeat = Heartbeat(job_path, job)
+    heartbeat.start()
+    progress = StageProgress(job_path, job)
+    dag_logger = logging.getLogger("dag")
+    dag_logger.addHandler(progress)
+    try:
+        exit_code = full_pipeline_main(**kwargs)
+    except KeyboardInterrupt:
+        # The job is given back to the queue
+        heartbeat.stop()
+        os.replace(job_path, queue_dir / "pending" / job_path.name)
+        raise
+    except Exception as exc:
+        logger.exception(f"Job {job['id']} failed")
+        job["error"] = repr(exc)
+        exit_code = 1
+    finally:
+        heartbeat.stop()
+        dag_logger.removeHandler(progress)
+
+    job["exit_code"] = exit_code
+    job["finished"] = time.time()
+    job["state"] = "failed" if exit_code else "done"
+    final_dir = queue_dir / job["state"]
+    final_dir.mkdir(parents=True, exist_ok=True)
+    write_job(job_path, job)
+    os.replace(job_path, final_dir / job_path.name)
+    return job
+
+
+def serve(
+    queue_dir: Path | str,
+    config_path: Path | str,
+    poll_interval: float = 5.0,
+    stale_timeout: float = STALE_TIMEOUT,
+    once: bool = False,
+) -> int:
+    """Run the jobs of a queue until interrupted.
+
+    Parameters
+    ----------
+    queue_dir
+        Path to the queue directory.
+    config_path
+        Path to the JSON file containing the default parameters of the jobs.
+    poll_interval
+        Number of seconds to wait before looking for new jobs.
+    stale_timeout
+        Running jobs without a heartbeat for this number of seconds are
+        given back to the queue when the worker starts.
+    once
+        If True, stop as soon as the queue is empty.
+    """
+    queue_dir = Path(queue_dir)
+    for state in STATES:
+        (queue_dir / state).mkdir(parents=True, exist_ok=True)
+    with open(config_path) as f:
+        defaults = json.load(f)
+
+    requeue_stale(queue_dir, stale_timeout)
+    logger.info(f"Serving the jobs of {queue_dir}")
+    try:
+        while True:
+            job_path = claim(queue_dir)
+            if job_path is None:
+                if once:
+                    break
+                time.sleep(poll_interval)
+                continue
+
+            logger.info(f"Job {job_path.stem}: Started")
+            job = run_job(queue_dir, job_path, defaults)
+            logger.info(
+                f"Job {job['id']}: {job['state'].capitalize()} in "
+                f"{job['finished'] - job['started']:.1f}s"
+            )
+    except KeyboardInterrupt:
+        logger.info("Worker stopped")
+    finally:
+        from utils import release_shared
+
+        n_released = release_shared()
+        logger.info(f"Removed {n_released} volumes from shared memory")
+
+    return 0
+
+
+def status(queue_dir: Path | str) -> int:
+    """Print the state of the jobs of a queue."""
+    queue_dir = Path(queue_dir)
+    for state in STATES:
+        job_paths = sorted((queue_dir / state).glob("*.json"))
+        print(f"{state}: {len(job_paths)}")
+        for job_path in job_paths:
+            with open(job_path) as f:
+                job = json.load(f)
+            line = f"    {job['id']} (experiment {job['experiment_id']})"
+            if state == "running":
+                stages = job.get("stages", {})
+                done = sum(s in {"Done", "Skipped"} for s in stages.values())
+                current = [
+                    name for name, s in stages.items() if s in {"Started", "Saving"}
+                ]
+                line += f" {done} stages done, running {', '.join(current)}"
+                if is_stale(job, STALE_TIMEOUT):
+                    line += " (stale, see requeue)"
+            elif "finished" in job:
+                line += f" in {job['finished'] - job['started']:.1f}s"
+                if "error" in job:
+                    line += f" ({job['error']})"
+            print(line)
+    return 0
+
+
+def main(command: str, **kwargs) -> int:
+    """Implement main function."""
+    if command == "serve":
+        return serve(**kwargs)
+    elif command == "requeue":
+        job_paths = requeue_stale(kwargs["queue_dir"], kwargs["stale_timeout"])
+        logger.info(f"{len(job_paths)} jobs requeued")
+        return 0
+    elif command == "submit":
+        params = dict(parse_param(param) for param in kwargs["param"])
+        job_path = submit(kwargs["queue_dir"], kwargs["experiment_id"], params)
+        logger.info(f"Job {job_path.stem} submitted")
+        return 0
+    else:
+        return status(**kwargs)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
+    )
+    args = parse_args()
+    kwargs = vars(args)
+    sys.exit(main(**kwargs))